@@ -12,22 +12,1471 @@
 """
 
 import os
+import re
+import sys
 import math
+import argparse
+import json
+import hashlib
+import shutil
+import threading
+import time
+import concurrent.futures
 
-from qgis.PyQt.QtCore import QCoreApplication,QFileInfo
+import numpy as np
+from osgeo import gdal, gdal_array, ogr, osr
+
+from qgis.PyQt.QtCore import QCoreApplication
 from qgis.core import (QgsProcessing,
                        QgsProcessingException,
                        QgsProcessingAlgorithm,
-                       QgsProcessingParameterFeatureSource,
                        QgsProcessingParameterRasterLayer,
                        QgsProcessingParameterNumber,
+                       QgsProcessingParameterBoolean,
+                       QgsProcessingParameterDefinition,
+                       QgsProcessingParameterFile,
+                       QgsProcessingParameterEnum,
+                       QgsProcessingParameterString,
                        QgsProcessingParameterRasterDestination,
-                       QgsCoordinateReferenceSystem,
-                       QgsProcessingOutputLayerDefinition,
-                       QgsRasterLayer,
-                       QgsProcessingParameterFolderDestination
+                       QgsProcessingParameterFolderDestination,
+                       QgsProcessingParameterVectorDestination,
+                       QgsProcessingOutputNumber,
+                       QgsProcessingFeedback
                        )
-from qgis import processing
+
+# grids are processed in square blocks of this many cells
+BLOCK_SIZE = 2048
+
+# default size limit of a filter cache folder (GB)
+CACHE_SIZE = 20
+
+# default creation options for the filtered grids (the predictor is chosen by data type, see OutputRaster)
+CREATION_OPTIONS = 'TILED=YES COMPRESS=DEFLATE BIGTIFF=IF_SAFER'
+
+# filtered output data types and no data values for each input grid
+FILTERED_GRIDS = {
+    'DEPTH': (gdal.GDT_Float32, -9999),
+    'VELOCITY': (gdal.GDT_Float32, -9999),
+    'DV': (gdal.GDT_Float32, -9999),
+    'LEVEL': (gdal.GDT_Float32, -9999),
+    'HAZARD': (gdal.GDT_Int16, -9999),
+}
+
+# ARR (2019) general flood hazard vulnerability limits (DV, depth, velocity) of hazard classes H1 to H5,
+# anything beyond H5 is H6
+HAZARD_LIMITS = [
+    (0.3, 0.3, 2.0),
+    (0.6, 0.5, 2.0),
+    (0.6, 1.2, 2.0),
+    (1.0, 2.0, 2.0),
+    (4.0, 4.0, 4.0),
+]
+
+# criteria raster values - criteria flags hold bit i for criteria i
+KEEP = 0
+REMOVE = 1
+NO_DATA = 255
+
+
+def filtered_path(raster_path, output_folder):
+    return os.path.join(output_folder, os.path.basename(raster_path[:-4])+'_filtered'+raster_path[-4:])
+
+
+def hazard_path(depth_path):
+    """
+    Returns the path of the hazard grid derived from a depth grid.
+    """
+    root, extension = os.path.splitext(depth_path)
+    return root + '_hazard' + extension
+
+
+def hazard_classes(depth, velocity, dv):
+    """
+    Returns the ARR hazard class (1 to 6) of each cell.
+    """
+    classes = np.ones(depth.shape, dtype='int16')
+    for dv_limit, depth_limit, velocity_limit in HAZARD_LIMITS:
+        classes += (dv > dv_limit) | (depth > depth_limit) | (velocity > velocity_limit)
+    return classes
+
+
+def blocks(width, height, block_size=BLOCK_SIZE):
+    """
+    Yields (col_0, row_0, width, height) windows covering a grid.
+    """
+    for row_0 in range(0, height, block_size):
+        for col_0 in range(0, width, block_size):
+            yield col_0, row_0, min(block_size, width - col_0), min(block_size, height - row_0)
+
+
+def read_block(band, window):
+    """
+    Returns the values of a band in a window and a mask of the cells holding data.
+    """
+    values = band.ReadAsArray(*window)
+    valid = np.ones(values.shape, dtype=bool)
+    if values.dtype.kind == 'f':
+        valid &= ~np.isnan(values)
+    nodata = band.GetNoDataValue()
+    if nodata is not None:
+        valid &= values != nodata
+    return values, valid
+
+
+def criteria_flags(depth, dv, valid, criteria):
+    """
+    Returns the criteria flags of a block: bit i is set where a cell meets the i-th (depth cutoff, DV cutoff)
+    criteria, and cells where depth or DV has no data are NO_DATA.
+    """
+    flags = np.zeros(depth.shape, dtype='uint8')
+    for i, (depth_cutoff, dv_cutoff) in enumerate(criteria):
+        flags |= (((depth < depth_cutoff) & (dv < dv_cutoff)) << i).astype('uint8')
+    flags[~valid] = NO_DATA
+    return flags
+
+
+def criteria_block(flags, valid):
+    """
+    Returns REMOVE where a cell meets any of the criteria, KEEP elsewhere.
+    """
+    return np.where(valid & (flags != 0), REMOVE, KEEP).astype('uint8')
+
+
+def output_driver(path):
+    """
+    Returns the GDAL driver for a raster path from its extension, defaulting to GeoTIFF.
+    """
+    extension = os.path.splitext(path)[1].lower().lstrip('.')
+    for i in range(gdal.GetDriverCount()):
+        driver = gdal.GetDriver(i)
+        metadata = driver.GetMetadata() or {}
+        if metadata.get(gdal.DCAP_RASTER) and extension in (metadata.get(gdal.DMD_EXTENSIONS) or '').split():
+            return driver
+    return gdal.GetDriverByName('GTiff')
+
+
+def vector_driver(path):
+    """
+    Returns the OGR driver for a vector path from its extension, defaulting to GeoPackage.
+    """
+    extension = os.path.splitext(path)[1].lower().lstrip('.')
+    for i in range(ogr.GetDriverCount()):
+        driver = ogr.GetDriver(i)
+        metadata = driver.GetMetadata() or {}
+        if metadata.get(gdal.DCAP_VECTOR) and metadata.get(gdal.DCAP_CREATE) and extension in (metadata.get(gdal.DMD_EXTENSIONS) or '').split():
+            return driver
+    return ogr.GetDriverByName('GPKG')
+
+
+class OutputRaster:
+    """
+    A single band output grid written block by block. Formats that can't be written incrementally
+    (e.g. ASCII grids) are built in memory and copied out on close. Compressed GeoTIFFs get the
+    floating point predictor (3) for float grids and horizontal differencing (2) for integer grids,
+    unless the options set a predictor.
+    """
+    def __init__(self, path, like, data_type, nodata, options=None):
+        self.path = path
+        self.driver = output_driver(path)
+        self.options = list(options or [])
+        settings = dict(option.upper().split('=', 1) for option in self.options if '=' in option)
+        if self.driver.ShortName == 'GTiff' and settings.get('COMPRESS', 'NONE') != 'NONE' and 'PREDICTOR' not in settings:
+            floating = data_type in (gdal.GDT_Float32, gdal.GDT_Float64)
+            self.options.append('PREDICTOR=3' if floating else 'PREDICTOR=2')
+        if self.driver.GetMetadataItem(gdal.DCAP_CREATE):
+            self.dataset = self.driver.Create(path, like.RasterXSize, like.RasterYSize, 1, data_type, options=self.options)
+            self.copy = False
+        else:
+            self.dataset = gdal.GetDriverByName('MEM').Create('', like.RasterXSize, like.RasterYSize, 1, data_type)
+            self.copy = True
+        if self.dataset is None:
+            raise QgsProcessingException(f"Could not create {path}")
+        self.dataset.SetGeoTransform(like.GetGeoTransform())
+        self.dataset.SetProjection(like.GetProjection())
+        self.band = self.dataset.GetRasterBand(1)
+        self.band.SetNoDataValue(nodata)
+        self.nodata = nodata
+
+    def write(self, values, window):
+        self.band.WriteArray(values, window[0], window[1])
+
+    def close(self):
+        self.band.FlushCache()
+        if self.copy:
+            self.driver.CreateCopy(self.path, self.dataset, options=self.options)
+        self.band = None
+        self.dataset = None
+
+
+def connected_components(n, a, b):
+    """
+    Returns the component of each of n nodes joined by the edges (a, b), identified by the smallest node
+    in the component. Components are found by repeatedly hooking roots together and pointer jumping.
+    """
+    labels = np.arange(n)
+    if len(a) == 0:
+        return labels
+    while True:
+        label_a, label_b = labels[a], labels[b]
+        low = np.minimum(label_a, label_b)
+        hooked = labels.copy()
+        np.minimum.at(hooked, label_a, low)
+        np.minimum.at(hooked, label_b, low)
+        while True:
+            jumped = hooked[hooked]
+            if np.array_equal(jumped, hooked):
+                break
+            hooked = jumped
+        if np.array_equal(hooked, labels):
+            return labels
+        labels = hooked
+
+
+def _unique_pairs(a, b, n):
+    if len(a) == 0:
+        return a, b
+    keys = np.unique(a.astype('int64') * n + b)
+    return keys // n, keys % n
+
+
+# (slice of a cell, slice of its neighbour) for the neighbours above and to the left of each cell
+NEIGHBOURS = {
+    4: [
+        ((slice(None), slice(1, None)), (slice(None), slice(None, -1))),
+        ((slice(1, None), slice(None)), (slice(None, -1), slice(None))),
+    ],
+}
+NEIGHBOURS[8] = NEIGHBOURS[4] + [
+    ((slice(1, None), slice(1, None)), (slice(None, -1), slice(None, -1))),
+    ((slice(1, None), slice(None, -1)), (slice(None, -1), slice(1, None))),
+]
+
+
+def label_tile(values, valid, connectivity=4):
+    """
+    Labels the connected regions of equal value in a tile.
+
+    Returns (labels, cells, touching): labels numbers the regions 1..n (0 where there's no data), cells
+    is the number of cells in each label and touching flags the labels next to a region of another value.
+    """
+    # runs of equal values along each row, then runs joined between rows
+    start = valid.copy()
+    start[:, 1:] &= ~(valid[:, :-1] & (values[:, 1:] == values[:, :-1]))
+    runs = np.cumsum(start.ravel()).reshape(values.shape)
+    runs[~valid] = 0
+    n_runs = int(runs.max()) + 1 if runs.size else 1
+
+    pairs_a, pairs_b = [], []
+    touching = np.zeros(n_runs, dtype=bool)
+    for i, (cell, neighbour) in enumerate(NEIGHBOURS[connectivity]):
+        both = valid[cell] & valid[neighbour]
+        same = both & (values[cell] == values[neighbour])
+        differ = both & ~same
+        touching[runs[cell][differ]] = True
+        touching[runs[neighbour][differ]] = True
+        if i > 0: # runs are already joined along rows
+            pairs_a.append(runs[cell][same])
+            pairs_b.append(runs[neighbour][same])
+    a, b = _unique_pairs(np.concatenate(pairs_a), np.concatenate(pairs_b), n_runs)
+
+    # number the components 1..n, with 0 (no data) staying 0
+    _, run_labels = np.unique(connected_components(n_runs, a, b), return_inverse=True)
+    run_labels = run_labels.ravel()
+    labels = run_labels[runs]
+    n_labels = int(run_labels.max()) + 1
+    cells = np.bincount(labels.ravel(), minlength=n_labels)
+    cells[0] = 0
+    touching = np.bincount(run_labels, weights=touching, minlength=n_labels) > 0
+    return labels, cells, touching
+
+
+def _seam_pairs(labels_a, values_a, valid_a, labels_b, values_b, valid_b, connectivity):
+    """
+    Returns (same_a, same_b, differ) for the cells facing each other across a tile seam, where same_a and
+    same_b are the labels of joined regions and differ are labels next to a region of another value.
+    """
+    offsets = [(slice(None), slice(None))]
+    if connectivity == 8:
+        offsets += [(slice(1, None), slice(None, -1)), (slice(None, -1), slice(1, None))]
+    same_a, same_b, differ = [], [], []
+    for side_a, side_b in offsets:
+        both = valid_a[side_a] & valid_b[side_b]
+        same = both & (values_a[side_a] == values_b[side_b])
+        same_a.append(labels_a[side_a][same])
+        same_b.append(labels_b[side_b][same])
+        differ.append(labels_a[side_a][both & ~same])
+        differ.append(labels_b[side_b][both & ~same])
+    return np.concatenate(same_a), np.concatenate(same_b), np.concatenate(differ)
+
+
+class TiledComponents:
+    """
+    Connected regions of equal value across a grid, labelled one tile at a time.
+
+    read_tile(window) returns the (values, valid) arrays of a window. Each tile is labelled on its own,
+    keeping only its edge rows and columns, and regions are joined across tile seams with a union-find
+    over the tile labels, so only a few tiles are held in memory. Tiles are labelled again on request
+    (labels()) unless the tile labels were written to label_output and loaded back with load().
+    """
+    def __init__(self, read_tile, windows, width, connectivity=4, feedback=None, label_output=None):
+        self.read_tile = read_tile
+        self.windows = windows
+        self.connectivity = connectivity
+        self.label_band = None
+
+        offsets, cells, touching = [], [np.zeros(1, dtype='int64')], [np.zeros(1, dtype=bool)]
+        pairs_a, pairs_b, differ = [], [], []
+        n = 1 # label 0 is no data
+        previous_bottom = None
+        top = bottom = None
+        left = None
+        for i, window in enumerate(windows):
+            col_0, row_0, tile_width, tile_height = window
+            values, valid = read_tile(window)
+            if col_0 == 0:
+                # edges of a new row of tiles, keeping the bottom edge of the last one
+                if top is not None:
+                    previous_bottom = bottom
+                top = [np.zeros(width, dtype='int64'), np.zeros(width, dtype=values.dtype), np.zeros(width, dtype=bool)]
+                bottom = [np.zeros(width, dtype='int64'), np.zeros(width, dtype=values.dtype), np.zeros(width, dtype=bool)]
+                left = None
+
+            labels, tile_cells, tile_touching = label_tile(values, valid, connectivity)
+            offsets.append(n - 1)
+            global_labels = np.where(labels > 0, labels + (n - 1), 0)
+            n += len(tile_cells) - 1
+            if label_output is not None:
+                label_output.write(global_labels.astype('uint32'), window)
+            cells.append(tile_cells[1:])
+            touching.append(tile_touching[1:])
+
+            # seam with the tile to the left
+            if left is not None:
+                a, b, d = _seam_pairs(*left, global_labels[:, 0], values[:, 0], valid[:, 0], connectivity)
+                pairs_a.append(a)
+                pairs_b.append(b)
+                differ.append(d)
+            left = (global_labels[:, -1], values[:, -1], valid[:, -1])
+
+            for edge, row in ((top, 0), (bottom, -1)):
+                edge[0][col_0:col_0 + tile_width] = global_labels[row]
+                edge[1][col_0:col_0 + tile_width] = values[row]
+                edge[2][col_0:col_0 + tile_width] = valid[row]
+
+            # the row of tiles is complete
+            if col_0 + tile_width == width and previous_bottom is not None:
+                a, b, d = _seam_pairs(*previous_bottom, *top, connectivity)
+                pairs_a.append(a)
+                pairs_b.append(b)
+                differ.append(d)
+                previous_bottom = None
+
+            if feedback is not None:
+                if feedback.isCanceled():
+                    break
+                feedback.setProgress(30 * (i + 1) / len(windows))
+
+        self.offsets = offsets
+        self.count = n
+        cells = np.concatenate(cells)
+        touching = np.concatenate(touching)
+        if differ:
+            touching[np.concatenate(differ)] = True
+        a = np.concatenate(pairs_a) if pairs_a else np.zeros(0, dtype='int64')
+        b = np.concatenate(pairs_b) if pairs_b else np.zeros(0, dtype='int64')
+        a, b = _unique_pairs(a, b, n)
+
+        # each tile label's region, and the size of each region
+        self.roots = connected_components(n, a, b)
+        self.cells = np.bincount(self.roots, weights=cells, minlength=n).astype('int64')
+        self.touching = np.bincount(self.roots, weights=touching, minlength=n) > 0
+
+    def save(self, path):
+        """
+        Saves the region table for load().
+        """
+        temp_path = path + '.tmp'
+        with open(temp_path, 'wb') as outfile:
+            np.savez(
+                outfile,
+                offsets=np.array(self.offsets, dtype='int64'),
+                roots=self.roots,
+                cells=self.cells,
+                touching=self.touching,
+                connectivity=self.connectivity,
+            )
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path, label_band, windows):
+        """
+        Returns the regions saved to path, reading tile labels from label_band instead of labelling again.
+        """
+        with np.load(path) as saved:
+            components = cls.__new__(cls)
+            components.read_tile = None
+            components.windows = windows
+            components.connectivity = int(saved['connectivity'])
+            components.offsets = saved['offsets'].tolist()
+            components.roots = saved['roots']
+            components.cells = saved['cells']
+            components.touching = saved['touching']
+        components.count = len(components.roots)
+        components.label_band = label_band
+        return components
+
+    def labels(self, i, values=None, valid=None):
+        """
+        Returns the region (root label) of each cell of tile i, 0 where there's no data. The tile values
+        can be passed in if they've already been read.
+        """
+        if self.label_band is not None:
+            return self.roots[self.label_band.ReadAsArray(*self.windows[i])]
+        if values is None:
+            values, valid = self.read_tile(self.windows[i])
+        labels, _, _ = label_tile(values, valid, self.connectivity)
+        return self.roots[np.where(labels > 0, labels + self.offsets[i], 0)]
+
+    def last_tiles(self):
+        """
+        Returns the index of the last tile holding each region, indexed by root label.
+        """
+        labels = np.arange(self.count)
+        tiles = np.searchsorted(np.array(self.offsets), labels, side='left') - 1
+        last_tiles = np.zeros(self.count, dtype='int64')
+        np.maximum.at(last_tiles, self.roots, tiles)
+        return last_tiles
+
+    def small(self, threshold):
+        """
+        Returns a flag for each root label of the regions smaller than threshold cells that border a
+        region of another value.
+        """
+        small = (self.cells < threshold) & self.touching
+        small[0] = False
+        return small
+
+    def areas(self, cell_area=1.0):
+        """
+        Returns the (root labels, areas) of every region.
+        """
+        roots = np.flatnonzero(self.cells)
+        return roots, self.cells[roots] * cell_area
+
+
+def file_fingerprint(path):
+    stat = os.stat(path)
+    return [os.path.normcase(os.path.abspath(path)), stat.st_size, stat.st_mtime]
+
+
+class FilterCache:
+    """
+    Cached criteria flags, region labels and region table of one filter run, so re-runs with another area
+    threshold skip the criteria and labelling pass. Entries are keyed by the depth and DV files and the
+    criteria, connectivity and block size, and are written to a subfolder of cache_folder:
+
+        flags.tif       criteria flags (bit i set where criteria i is met, NO_DATA where there's no data)
+        labels.tif      tile labels before joining across tile seams
+        components.npz  the region of each tile label and the size of each region
+
+    components.npz is written last, so an entry is complete once it exists, and its modification time is
+    the entry's last use. Least recently used entries are evicted once the cache exceeds max_bytes, except
+    those used within MIN_AGE seconds, which another run (e.g. a batch worker sharing the cache folder)
+    may still be reading.
+    """
+    OPTIONS = ['TILED=YES', 'COMPRESS=DEFLATE', 'BIGTIFF=IF_SAFER']
+    MIN_AGE = 24 * 3600
+
+    def __init__(self, cache_folder, grids, criteria, connectivity, block_size=BLOCK_SIZE, max_bytes=CACHE_SIZE * 1e9):
+        key = [file_fingerprint(grids['DEPTH']), file_fingerprint(grids['DV']), [list(c) for c in criteria], connectivity, block_size]
+        self.cache_folder = cache_folder
+        self.max_bytes = max_bytes
+        self.folder = os.path.join(cache_folder, hashlib.sha1(json.dumps(key).encode('utf-8')).hexdigest()[:16])
+        self.flags_path = os.path.join(self.folder, 'flags.tif')
+        self.labels_path = os.path.join(self.folder, 'labels.tif')
+        self.components_path = os.path.join(self.folder, 'components.npz')
+        self.datasets = []
+
+    def exists(self):
+        return os.path.isfile(self.components_path)
+
+    def create(self, like):
+        """
+        Returns the (flags, labels) OutputRasters for a new entry.
+        """
+        os.makedirs(self.folder, exist_ok=True)
+        return (
+            OutputRaster(self.flags_path, like, gdal.GDT_Byte, NO_DATA, self.OPTIONS),
+            OutputRaster(self.labels_path, like, gdal.GDT_UInt32, 0, self.OPTIONS),
+        )
+
+    def flags_reader(self):
+        """
+        Returns a function reading the cached criteria flags of a window.
+        """
+        dataset = gdal.Open(self.flags_path)
+        self.datasets.append(dataset)
+        band = dataset.GetRasterBand(1)
+        def read_flags(window):
+            flags = band.ReadAsArray(*window)
+            return flags, flags != NO_DATA
+        return read_flags
+
+    def components(self, windows):
+        dataset = gdal.Open(self.labels_path)
+        self.datasets.append(dataset)
+        return TiledComponents.load(self.components_path, dataset.GetRasterBand(1), windows)
+
+    def close(self):
+        self.datasets = []
+
+    def discard(self):
+        """
+        Removes an incomplete entry, e.g. after a cancelled run.
+        """
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    @staticmethod
+    def entry_size(folder):
+        return sum(entry.stat().st_size for entry in os.scandir(folder) if entry.is_file())
+
+    def touch(self):
+        """
+        Marks the entry as used.
+        """
+        os.utime(self.components_path)
+
+    def evict(self, feedback=None):
+        """
+        Removes least recently used complete entries until the cache fits within max_bytes, never this one
+        or any used within MIN_AGE seconds.
+        """
+        entries = []
+        recent = time.time() - self.MIN_AGE
+        for entry in os.scandir(self.cache_folder):
+            components_path = os.path.join(entry.path, 'components.npz')
+            if entry.is_dir() and entry.path != self.folder and os.path.isfile(components_path):
+                entries.append((os.stat(components_path).st_mtime, entry.path, self.entry_size(entry.path)))
+        size = self.entry_size(self.folder)
+        total = size + sum(entry_size for _, _, entry_size in entries)
+        evicted = 0
+        for last_used, folder, entry_size in sorted(entries):
+            if total <= self.max_bytes or last_used > recent:
+                break
+            shutil.rmtree(folder, ignore_errors=True)
+            total -= entry_size
+            evicted += 1
+        if feedback is not None:
+            feedback.pushInfo(f"Cache entry {self.folder}: {size / 1e9:.2f} GB, cache {total / 1e9:.2f} GB of {self.max_bytes / 1e9:.2f} GB ({evicted} entries evicted).")
+
+def grid_header(path):
+    """
+    Returns the (width, height) and geotransform of a grid, opening it only to read its header.
+    """
+    dataset = gdal.Open(path)
+    if dataset is None:
+        raise QgsProcessingException(f"Could not open {path}")
+    return (dataset.RasterXSize, dataset.RasterYSize), dataset.GetGeoTransform()
+
+
+def is_aligned(header, like_header):
+    """
+    Returns True if two grid headers describe the same cells (geotransforms within a thousandth of a cell).
+    """
+    (size, geotransform), (like_size, like_geotransform) = header, like_header
+    return size == like_size and np.allclose(geotransform, like_geotransform, rtol=0, atol=abs(like_geotransform[1]) * 1e-3)
+
+
+def check_aligned(grids):
+    """
+    Raises QgsProcessingException unless every grid of an event is on the cells of its DEPTH grid.
+    """
+    depth_header = grid_header(grids['DEPTH'])
+    for key, path in grids.items():
+        if key != 'DEPTH' and not is_aligned(grid_header(path), depth_header):
+            raise QgsProcessingException(f"The {key} grid {path} isn't aligned with the depth grid {grids['DEPTH']}")
+
+
+def output_nodata(band, data_type, default):
+    """
+    Returns the no data value of a source band if the output data type can hold it, otherwise default.
+    """
+    nodata = band.GetNoDataValue()
+    if nodata is None or math.isnan(nodata):
+        return default
+    if data_type in (gdal.GDT_Byte, gdal.GDT_Int16, gdal.GDT_UInt16, gdal.GDT_Int32, gdal.GDT_UInt32):
+        info = np.iinfo(gdal_array.GDALTypeCodeToNumericTypeCode(data_type))
+        if nodata != int(nodata) or not info.min <= nodata <= info.max:
+            return default
+    return nodata
+
+
+class MaskedGridWriter:
+    """
+    Applies the filter to the blocks of each grid on a bounded thread pool. Each grid's source and output
+    are only used by one thread at a time, so the grids are masked and compressed in parallel while the
+    filter of the next block is worked out. At most max_pending blocks are queued to bound memory use.
+
+    Outputs without a source are derived from the other grids of their group: the HAZARD output without a
+    HAZARD grid is worked out from depth, velocity and DV, so these are written together.
+    """
+    def __init__(self, sources, outputs, max_workers=None, max_pending=16):
+        self.sources = sources
+        self.outputs = outputs
+        derived = ['DEPTH', 'VELOCITY', 'DV', 'HAZARD']
+        if 'HAZARD' in sources:
+            self.groups = [(key,) for key in outputs]
+        else:
+            self.groups = [(key,) for key in outputs if key not in derived] + [tuple(derived)]
+        self.locks = {group: threading.Lock() for group in self.groups}
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers or min(len(self.groups), os.cpu_count() or 1))
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.futures = []
+
+    def write(self, window, keep):
+        for group in self.groups:
+            self.slots.acquire()
+            future = self.executor.submit(self._write, group, window, keep)
+            future.add_done_callback(lambda f: self.slots.release())
+            self.futures.append(future)
+        # surface errors early and drop finished futures
+        done = [future for future in self.futures if future.done()]
+        for future in done:
+            future.result()
+        self.futures = [future for future in self.futures if not future.done()]
+
+    def _write(self, group, window, keep):
+        with self.locks[group]:
+            if group == ('FILTER',):
+                self.outputs['FILTER'].write(keep.astype('float32'), window)
+                return
+            grid_blocks = {key: read_block(self.sources[key].GetRasterBand(1), window) for key in group if key in self.sources}
+            if 'HAZARD' in group and 'HAZARD' not in self.sources:
+                (depth, depth_valid), (velocity, velocity_valid), (dv, dv_valid) = grid_blocks['DEPTH'], grid_blocks['VELOCITY'], grid_blocks['DV']
+                grid_blocks['HAZARD'] = hazard_classes(depth, velocity, dv), depth_valid & velocity_valid & dv_valid
+            for key in group:
+                values, valid = grid_blocks[key]
+                output = self.outputs[key]
+                output.write(np.where(keep & valid, values, output.nodata), window)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        for future in self.futures:
+            future.result()
+        self.futures = []
+        for output in self.outputs.values():
+            output.close()
+
+
+def criteria_reader(depth_band, dv_band, criteria, flags_output=None):
+    """
+    Returns a function reading the criteria flags of a window from the depth and DV grids, optionally
+    writing them to flags_output as they're read.
+    """
+    def read_flags(window):
+        depth, depth_valid = read_block(depth_band, window)
+        dv, dv_valid = read_block(dv_band, window)
+        valid = depth_valid & dv_valid
+        flags = criteria_flags(depth, dv, valid, criteria)
+        if flags_output is not None:
+            flags_output.write(flags, window)
+        return flags, valid
+    return read_flags
+
+
+def tile_reader(read_flags):
+    """
+    Returns a function reading the criteria raster (REMOVE or KEEP) of a window from its criteria flags.
+    """
+    def read_tile(window):
+        flags, valid = read_flags(window)
+        return criteria_block(flags, valid), valid
+    return read_tile
+
+
+def filter_flood_grids(grids, criteria, area, filter_path, output_folder, feedback, block_size=BLOCK_SIZE, connectivity=4, cache_folder=None, creation_options=CREATION_OPTIONS, cache_size=CACHE_SIZE):
+    """
+    Filters the raw flood grids in blocks without intermediate grids on disk.
+
+    grids is {'DEPTH': path, 'VELOCITY': path, 'DV': path, 'LEVEL': path, 'HAZARD': path}, where HAZARD can be
+    left out to derive the ARR hazard classes from depth, velocity and DV, and criteria is
+    a list of (depth cutoff, DV cutoff) pairs; cells meeting any of them are removed, then ponds and
+    islands smaller than area are sieved out. Writes the filter (1 where kept) to filter_path and each
+    grid masked by the filter to output_folder. Returns {key: output path}.
+
+    With a cache_folder, the criteria and regions are cached (see FilterCache) so re-runs with only a
+    different area threshold go straight to writing the outputs; the cache is kept within cache_size GB by
+    evicting the least recently used entries. creation_options (space separated
+    KEY=VALUE) apply to the filter and filtered grids, which keep the no data value of their inputs.
+    Every grid must be on the cells of the depth grid.
+    """
+    check_aligned(grids)
+    depth_dataset = gdal.Open(grids['DEPTH'])
+    dv_dataset = gdal.Open(grids['DV'])
+    width, height = depth_dataset.RasterXSize, depth_dataset.RasterYSize
+    windows = list(blocks(width, height, block_size))
+    depth_band, dv_band = depth_dataset.GetRasterBand(1), dv_dataset.GetRasterBand(1)
+
+    # pass 1: label the regions of the criteria raster to find ponds and islands
+    cache = FilterCache(cache_folder, grids, criteria, connectivity, block_size, cache_size * 1e9) if cache_folder else None
+    if cache is not None and cache.exists():
+        feedback.pushInfo(f"Using cached criteria and regions from {cache.folder}...")
+        cache.touch()
+    else:
+        feedback.pushInfo("Labelling ponds and islands...")
+        if cache is not None:
+            flags_output, label_output = cache.create(depth_dataset)
+            read_flags = criteria_reader(depth_band, dv_band, criteria, flags_output)
+        else:
+            label_output = None
+            read_flags = criteria_reader(depth_band, dv_band, criteria)
+        components = TiledComponents(tile_reader(read_flags), windows, width, connectivity, feedback, label_output)
+        if cache is not None:
+            flags_output.close()
+            label_output.close()
+            if feedback.isCanceled():
+                cache.discard()
+                return {}
+            components.save(cache.components_path)
+            cache.evict(feedback)
+
+    if cache is not None:
+        read_flags = cache.flags_reader()
+        components = cache.components(windows)
+    read_tile = tile_reader(read_flags)
+    pixel_size = abs(depth_dataset.GetGeoTransform()[1])
+    small = components.small(math.floor(area / pixel_size**2))
+    feedback.pushInfo(f"Removing {int(small.sum())} ponds and islands of {len(components.areas()[0])} regions...")
+
+    if feedback.isCanceled():
+        return {}
+
+    # pass 2: filter and masked grids
+    feedback.pushInfo("Writing filtered grids...")
+    os.makedirs(output_folder, exist_ok=True)
+    options = creation_options.split() if creation_options else []
+    sources = {key: gdal.Open(path) for key, path in grids.items()}
+    outputs = {'FILTER': OutputRaster(filter_path, depth_dataset, gdal.GDT_Float32, 0, options)}
+    for key, path in grids.items():
+        data_type, nodata = FILTERED_GRIDS[key]
+        nodata = output_nodata(sources[key].GetRasterBand(1), data_type, nodata)
+        outputs[key] = OutputRaster(filtered_path(path, output_folder), depth_dataset, data_type, nodata, options)
+    if 'HAZARD' not in grids:
+        feedback.pushInfo("Deriving ARR hazard classes from depth, velocity and DV...")
+        data_type, nodata = FILTERED_GRIDS['HAZARD']
+        outputs['HAZARD'] = OutputRaster(filtered_path(hazard_path(grids['DEPTH']), output_folder), depth_dataset, data_type, nodata, options)
+
+    writer = MaskedGridWriter(sources, outputs)
+    try:
+        for i, window in enumerate(windows):
+            if feedback.isCanceled():
+                break
+            block, valid = read_tile(window)
+            # small regions take the other value
+            remove = (block == REMOVE) ^ small[components.labels(i, block, valid)]
+            writer.write(window, valid & ~remove)
+            feedback.setProgress(30 + 70 * (i + 1) / len(windows))
+    finally:
+        writer.close()
+    if cache is not None:
+        cache.close()
+    return {key: output.path for key, output in outputs.items()}
+
+
+# default filter settings, as in the FloodFilter parameters
+DEFAULT_CRITERIA = [(0.01, 0.125), (0.3, 0.02)]
+DEFAULT_AREA = 500
+
+# file name suffixes of each grid of an event, e.g. <event>_d_Max.tif (matched ignoring case)
+DEFAULT_PATTERNS = {
+    'DEPTH': '_d_Max',
+    'VELOCITY': '_V_Max',
+    'DV': '_DV_Max',
+    'LEVEL': '_h_Max',
+    'HAZARD': '_Z0_Max',
+}
+GRID_EXTENSIONS = ('.tif', '.tiff', '.flt', '.asc')
+
+
+class PrintFeedback(QgsProcessingFeedback):
+    """
+    Processing feedback for command line runs, printing messages prefixed with the event name.
+    """
+    def __init__(self, prefix=''):
+        super().__init__()
+        self.prefix = prefix
+
+    def pushInfo(self, info):
+        print(f'{self.prefix}{info}', flush=True)
+
+    def reportError(self, error, fatalError=False):
+        print(f'{self.prefix}ERROR: {error}', flush=True)
+
+
+def discover_events(folder, feedback, patterns=None):
+    """
+    Finds the events in a folder from the depth grid names. Returns {event: {key: path}} with the grids
+    found for each event; HAZARD is left out if there's no hazard grid (it's then derived). Events missing
+    a grid are reported to feedback and skipped.
+    """
+    patterns = {**DEFAULT_PATTERNS, **(patterns or {})}
+    files = {}
+    for name in os.listdir(folder):
+        stem, extension = os.path.splitext(name)
+        if extension.lower() in GRID_EXTENSIONS and not stem.lower().endswith('_filtered'):
+            files[stem.lower()] = os.path.join(folder, name)
+
+    events = {}
+    depth_suffix = patterns['DEPTH'].lower()
+    for stem, path in sorted(files.items()):
+        if not stem.endswith(depth_suffix):
+            continue
+        event = os.path.basename(path)[:len(stem) - len(depth_suffix)]
+        grids = {}
+        for key, suffix in patterns.items():
+            grid = files.get(event.lower() + suffix.lower())
+            if grid is not None:
+                grids[key] = grid
+        missing = [key for key in ('DEPTH', 'VELOCITY', 'DV', 'LEVEL') if key not in grids]
+        if missing:
+            feedback.reportError(f"Skipping {event}: no {', '.join(missing)} grid")
+            continue
+        events[event] = grids
+    return events
+
+
+def block_size_for_memory(memory):
+    """
+    Returns a block size keeping the blocks in flight (queued for writing and being labelled) within
+    memory bytes, allowing 128 bytes a cell.
+    """
+    block_size = int(math.sqrt(memory / (128 * 18))) // 256 * 256
+    return max(256, min(4096, block_size))
+
+
+def event_fingerprint(grids, settings):
+    return {
+        'grids': {key: file_fingerprint(path) for key, path in sorted(grids.items())},
+        'criteria': [list(c) for c in settings.get('criteria', DEFAULT_CRITERIA)],
+        'area': settings.get('area', DEFAULT_AREA),
+        'connectivity': settings.get('connectivity', 4),
+        'creation_options': settings.get('creation_options', CREATION_OPTIONS),
+    }
+
+
+def run_filter_event(event, settings):
+    """
+    Filters one event's grids unless its outputs are up to date. event is {'name', 'grids', 'output_folder'}
+    and optionally 'filter' (defaults to <name>_filter.tif in the output folder).
+    """
+    name = event['name']
+    feedback = PrintFeedback(f'[{name}] ')
+    output_folder = event['output_folder']
+    filter_path = event.get('filter') or os.path.join(output_folder, f'{name}_filter.tif')
+    state_path = os.path.join(output_folder, f'{name}_filter.json')
+
+    fingerprint = event_fingerprint(event['grids'], settings)
+    if os.path.isfile(state_path):
+        with open(state_path) as infile:
+            state = json.load(infile)
+        if state['fingerprint'] == fingerprint and all(os.path.isfile(path) for path in state['outputs'].values()):
+            feedback.pushInfo("Up to date, skipping.")
+            return {'name': name, 'skipped': True, 'outputs': state['outputs']}
+
+    memory = settings.get('memory_per_worker')
+    block_size = block_size_for_memory(memory * 1e9) if memory else BLOCK_SIZE
+    outputs = filter_flood_grids(
+        event['grids'],
+        settings.get('criteria', DEFAULT_CRITERIA),
+        settings.get('area', DEFAULT_AREA),
+        filter_path,
+        output_folder,
+        feedback,
+        block_size=block_size,
+        connectivity=settings.get('connectivity', 4),
+        cache_folder=settings.get('cache_folder'),
+        creation_options=settings.get('creation_options', CREATION_OPTIONS),
+        cache_size=settings.get('cache_size', CACHE_SIZE),
+    )
+    if not outputs:
+        raise QgsProcessingException("Filtering was cancelled")
+
+    with open(state_path, 'w') as outfile:
+        json.dump({'fingerprint': fingerprint, 'outputs': outputs}, outfile, indent=2)
+    return {'name': name, 'skipped': False, 'outputs': outputs}
+
+
+def _run_filter_event_safe(event, settings):
+    try:
+        return run_filter_event(event, settings)
+    except Exception as e:
+        return {'name': event['name'], 'error': str(e)}
+
+
+def _init_filter_worker(settings):
+    """
+    Sizes the GDAL block cache of a worker process to a quarter of its memory budget.
+    """
+    if settings.get('memory_per_worker'):
+        gdal.SetCacheMax(int(settings['memory_per_worker'] * 1e9 / 4))
+
+
+def run_filter_manifest(manifest, workers=None, feedback=None):
+    """
+    Filters every event in a manifest (a dict or the path to a JSON file) across a pool of worker
+    processes. Events are listed, or discovered in folders by grid name suffix, and events whose inputs
+    and settings haven't changed since their last run are skipped.
+
+    Manifest format:
+        {
+            "criteria": [[0.01, 0.125], [0.3, 0.02]],   (optional, (depth cutoff, DV cutoff) pairs)
+            "area": 500,                              (optional, pond/island area threshold)
+            "connectivity": 4,                        (optional, 4 or 8)
+            "cache_folder": "C:/filter_cache",        (optional, see FilterCache)
+            "cache_size": 20,                         (optional, GB)
+            "creation_options": "TILED=YES COMPRESS=DEFLATE",   (optional)
+            "workers": 4,                             (optional)
+            "memory_per_worker": 4,                   (optional, GB)
+            "folders": [                              (optional, events found by grid name suffix)
+                {
+                    "folder": "C:/project/results",
+                    "output_folder": "C:/project/results_filtered",
+                    "patterns": {"DV": "_VD_Max"}     (optional, overrides DEFAULT_PATTERNS)
+                }
+            ],
+            "events": [                               (optional, events listed explicitly)
+                {
+                    "name": "1pct_60min_TP01",
+                    "grids": {"DEPTH": "...", "VELOCITY": "...", "DV": "...", "LEVEL": "...", "HAZARD": "..."},
+                    "output_folder": "C:/project/results_filtered",
+                    "filter": "C:/project/results_filtered/1pct_60min_TP01_filter.tif"   (optional)
+                }
+            ]
+        }
+
+    Discovery messages go to feedback (printed by default). Returns a list of event summaries; failed events
+    have an 'error' entry.
+    """
+    feedback = feedback or PrintFeedback()
+    if not isinstance(manifest, dict):
+        with open(manifest) as infile:
+            manifest = json.load(infile)
+    settings = {key: value for key, value in manifest.items() if key not in ('folders', 'events')}
+    workers = workers or settings.get('workers') or 1
+
+    events = list(manifest.get('events', []))
+    for entry in manifest.get('folders', []):
+        for name, grids in discover_events(entry['folder'], feedback, entry.get('patterns')).items():
+            events.append({'name': name, 'grids': grids, 'output_folder': entry.get('output_folder', entry['folder'])})
+
+    if workers == 1 or len(events) == 1:
+        _init_filter_worker(settings)
+        return [_run_filter_event_safe(event, settings) for event in events]
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=_init_filter_worker, initargs=(settings,)) as executor:
+        return list(executor.map(_run_filter_event_safe, events, [settings] * len(events)))
+
+
+# durations in event names, e.g. 1pct_60min_TP01 or 1pct_2hr_TP01
+DURATION_PATTERN = r'(?<![a-z\d.])(\d+(?:\.\d+)?)\s*(min|m|hr|h)(?![a-z])'
+
+
+def event_duration(name, pattern=DURATION_PATTERN):
+    """
+    Returns the duration (minutes) in an event name, or -1 if there isn't one.
+    """
+    match = re.search(pattern, name, re.IGNORECASE)
+    if match is None:
+        return -1
+    value, unit = float(match.group(1)), match.group(2).lower()
+    return int(round(value * 60 if unit.startswith('h') else value))
+
+
+def discover_filtered_events(folder, patterns=None):
+    """
+    Finds the filtered grids of each event in a folder of filter outputs. Returns {event: {key: path}}.
+    """
+    patterns = {**DEFAULT_PATTERNS, **(patterns or {})}
+    files = {}
+    for name in os.listdir(folder):
+        stem, extension = os.path.splitext(name)
+        if extension.lower() in GRID_EXTENSIONS and stem.lower().endswith('_filtered'):
+            files[stem.lower()[:-len('_filtered')]] = os.path.join(folder, name)
+
+    events = {}
+    depth_suffix = patterns['DEPTH'].lower()
+    for stem, path in sorted(files.items()):
+        if not stem.endswith(depth_suffix):
+            continue
+        event = os.path.basename(path)[:len(stem) - len(depth_suffix)]
+        grids = {}
+        for key, suffix in patterns.items():
+            grid = files.get(event.lower() + suffix.lower())
+            if grid is not None:
+                grids[key] = grid
+        # hazard derived by the filter
+        if 'HAZARD' not in grids and stem + '_hazard' in files:
+            grids['HAZARD'] = files[stem + '_hazard']
+        events[event] = grids
+    return events
+
+
+def envelope_grids(events, output_folder, name, feedback, keys=('DEPTH', 'LEVEL', 'VELOCITY', 'HAZARD'), critical_key='DEPTH', block_size=BLOCK_SIZE, creation_options=CREATION_OPTIONS):
+    """
+    Writes the peak envelope of each grid type across events, and the critical event (the event with the
+    peak critical_key value) and its duration for each cell, streaming every event's grids block by block.
+
+    events is {event: {key: path}} of aligned grids. Writes <name>_<key>_envelope, <name>_critical_event
+    (index into <name>_events.csv, -1 where dry) and <name>_critical_duration (minutes) to output_folder.
+    Only the running maxima of one block are held in memory, and each event's grid is only open while its
+    block is read, so the number of open files doesn't grow with the number of events. Returns {output: path}.
+    """
+    names = sorted(events)
+    if not names:
+        raise QgsProcessingException("No events to envelope")
+    keys = [key for key in keys if all(key in events[event] for event in names)]
+    if critical_key not in keys:
+        raise QgsProcessingException(f"Not every event has a {critical_key} grid")
+    like = gdal.Open(events[names[0]][critical_key])
+    width, height = like.RasterXSize, like.RasterYSize
+    like_header = ((width, height), like.GetGeoTransform())
+    for key in keys:
+        for event in names:
+            if not is_aligned(grid_header(events[event][key]), like_header):
+                raise QgsProcessingException(f"The {key} grid of {event} isn't aligned with the other events")
+
+    os.makedirs(output_folder, exist_ok=True)
+    options = creation_options.split() if creation_options else []
+    extension = os.path.splitext(events[names[0]][critical_key])[1]
+    outputs = {}
+    for key in keys:
+        data_type, nodata = FILTERED_GRIDS[key]
+        outputs[key] = OutputRaster(os.path.join(output_folder, f'{name}_{key.lower()}_envelope{extension}'), like, data_type, nodata, options)
+    outputs['CRITICAL_EVENT'] = OutputRaster(os.path.join(output_folder, f'{name}_critical_event{extension}'), like, gdal.GDT_Int16, -1, options)
+    outputs['CRITICAL_DURATION'] = OutputRaster(os.path.join(output_folder, f'{name}_critical_duration{extension}'), like, gdal.GDT_Int32, -1, options)
+    durations = np.array([event_duration(event) for event in names], dtype='int32')
+
+    windows = list(blocks(width, height, block_size))
+    for i, window in enumerate(windows):
+        if feedback.isCanceled():
+            break
+        rows, cols = window[3], window[2]
+        for key in keys:
+            peak = np.full((rows, cols), -np.inf)
+            critical = np.full((rows, cols), -1, dtype='int16')
+            for e, event in enumerate(names):
+                dataset = gdal.Open(events[event][key])
+                values, valid = read_block(dataset.GetRasterBand(1), window)
+                dataset = None
+                higher = valid & (values > peak)
+                peak[higher] = values[higher]
+                critical[higher] = e
+            wet = critical >= 0
+            outputs[key].write(np.where(wet, peak, outputs[key].nodata), window)
+            if key == critical_key:
+                outputs['CRITICAL_EVENT'].write(critical, window)
+                outputs['CRITICAL_DURATION'].write(np.where(wet, durations[critical], -1), window)
+        feedback.setProgress(100 * (i + 1) / len(windows))
+
+    for output in outputs.values():
+        output.close()
+
+    index_path = os.path.join(output_folder, f'{name}_events.csv')
+    with open(index_path, 'w', newline='') as outfile:
+        outfile.write('index,event,duration_min\n')
+        for e, event in enumerate(names):
+            outfile.write(f'{e},{event},{durations[e]}\n')
+
+    paths = {key: output.path for key, output in outputs.items()}
+    paths['EVENTS'] = index_path
+    return paths
+
+
+# afflux band edges (m) of the difference classes, and the classes of cells wet in only one result set
+AFFLUX_BANDS = [-0.1, -0.05, -0.01, 0.01, 0.05, 0.1]
+WAS_WET_NOW_DRY = 1
+WAS_DRY_NOW_WET = 2
+
+
+def afflux_class_names(bands=AFFLUX_BANDS):
+    """
+    Returns {class: description} of the difference classes.
+    """
+    names = {WAS_WET_NOW_DRY: 'Was wet, now dry', WAS_DRY_NOW_WET: 'Was dry, now wet'}
+    edges = [None] + list(bands) + [None]
+    for i, (low, high) in enumerate(zip(edges[:-1], edges[1:])):
+        if low is None:
+            names[3 + i] = f'< {high:g}'
+        elif high is None:
+            names[3 + i] = f'> {low:g}'
+        else:
+            names[3 + i] = f'{low:g} to {high:g}'
+    return names
+
+
+def aligned_dataset(dataset, like, resampling='near'):
+    """
+    Returns dataset on the grid of like, resampled on the fly through a warped VRT if they differ.
+    """
+    if dataset.GetGeoTransform() == like.GetGeoTransform() and (dataset.RasterXSize, dataset.RasterYSize) == (like.RasterXSize, like.RasterYSize):
+        return dataset
+    gt = like.GetGeoTransform()
+    bounds = (gt[0], gt[3] + like.RasterYSize * gt[5], gt[0] + like.RasterXSize * gt[1], gt[3])
+    return gdal.Warp(
+        '', dataset, format='VRT', outputBounds=bounds, width=like.RasterXSize, height=like.RasterYSize,
+        dstSRS=like.GetProjection() or None, resampleAlg=resampling,
+    )
+
+
+def difference_grids(base_path, developed_path, difference_path, class_path, feedback, bands=AFFLUX_BANDS, block_size=BLOCK_SIZE, creation_options=CREATION_OPTIONS, resampling='near'):
+    """
+    Writes the difference (developed - base) where both are wet, and its class: WAS_WET_NOW_DRY,
+    WAS_DRY_NOW_WET, or the afflux band where both are wet. The developed grid is resampled onto the base
+    grid if they aren't aligned. Returns {class: area}.
+    """
+    base = gdal.Open(base_path)
+    developed = aligned_dataset(gdal.Open(developed_path), base, resampling)
+    base_band, developed_band = base.GetRasterBand(1), developed.GetRasterBand(1)
+    options = creation_options.split() if creation_options else []
+    difference_output = OutputRaster(difference_path, base, gdal.GDT_Float32, -9999, options)
+    class_output = OutputRaster(class_path, base, gdal.GDT_Byte, 0, options)
+    edges = np.array(bands, dtype='float64')
+    counts = np.zeros(3 + len(bands) + 1, dtype='int64')
+
+    for window in blocks(base.RasterXSize, base.RasterYSize, block_size):
+        if feedback.isCanceled():
+            break
+        base_values, base_wet = read_block(base_band, window)
+        developed_values, developed_wet = read_block(developed_band, window)
+        both = base_wet & developed_wet
+        difference = np.where(both, developed_values.astype('float64') - base_values, 0)
+        classes = np.zeros(difference.shape, dtype='uint8')
+        classes[both] = 3 + np.digitize(difference[both], edges)
+        classes[base_wet & ~developed_wet] = WAS_WET_NOW_DRY
+        classes[~base_wet & developed_wet] = WAS_DRY_NOW_WET
+        difference_output.write(np.where(both, difference, -9999), window)
+        class_output.write(classes, window)
+        counts += np.bincount(classes.ravel(), minlength=len(counts))
+
+    difference_output.close()
+    class_output.close()
+    gt = base.GetGeoTransform()
+    cell_area = abs(gt[1] * gt[5])
+    return {c: counts[c] * cell_area for c in afflux_class_names(bands)}
+
+
+def pair_events(base_folder, developed_folder, feedback, rename=None, patterns=None):
+    """
+    Pairs the filtered events of two folders by name. rename is an optional (base text, developed text)
+    substitution from base to developed event names. Returns [(event, base grids, developed grids)];
+    base events without a developed result are reported to feedback.
+    """
+    base_events = discover_filtered_events(base_folder, patterns)
+    developed_events = discover_filtered_events(developed_folder, patterns)
+    pairs = []
+    for event, grids in base_events.items():
+        developed_event = event.replace(*rename) if rename else event
+        if developed_event in developed_events:
+            pairs.append((event, grids, developed_events[developed_event]))
+        else:
+            feedback.reportError(f"No developed result for {event}")
+    return pairs
+
+
+def _difference_pair(pair, keys, output_folder, settings):
+    event, base_grids, developed_grids = pair
+    feedback = PrintFeedback(f'[{event}] ')
+    summary = []
+    try:
+        for key in keys:
+            if key not in base_grids or key not in developed_grids:
+                continue
+            extension = os.path.splitext(base_grids[key])[1]
+            areas = difference_grids(
+                base_grids[key],
+                developed_grids[key],
+                os.path.join(output_folder, f'{event}_{key.lower()}_difference{extension}'),
+                os.path.join(output_folder, f'{event}_{key.lower()}_difference_class{extension}'),
+                feedback,
+                bands=settings.get('bands', AFFLUX_BANDS),
+                block_size=settings.get('block_size', BLOCK_SIZE),
+                creation_options=settings.get('creation_options', CREATION_OPTIONS),
+                resampling=settings.get('resampling', 'near'),
+            )
+            summary += [(event, key, c, area) for c, area in areas.items()]
+    except Exception as e:
+        return {'name': event, 'error': str(e)}
+    return {'name': event, 'summary': summary}
+
+
+def difference_folders(base_folder, developed_folder, output_folder, keys=('LEVEL', 'DEPTH'), rename=None, workers=1, feedback=None, **settings):
+    """
+    Writes difference and difference class grids for every event in both folders of filtered results,
+    across a pool of worker processes, and a CSV of the area of each class for every event and grid.
+    Pairing messages go to feedback (printed by default). Returns a list of event results; failed events
+    have an 'error' entry.
+    """
+    feedback = feedback or PrintFeedback()
+    os.makedirs(output_folder, exist_ok=True)
+    pairs = pair_events(base_folder, developed_folder, feedback, rename)
+    if workers == 1 or len(pairs) == 1:
+        results = [_difference_pair(pair, keys, output_folder, settings) for pair in pairs]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(_difference_pair, pairs, [keys] * len(pairs), [output_folder] * len(pairs), [settings] * len(pairs)))
+
+    names = afflux_class_names(settings.get('bands', AFFLUX_BANDS))
+    with open(os.path.join(output_folder, 'difference_summary.csv'), 'w', newline='') as outfile:
+        outfile.write('event,grid,class,description,area\n')
+        for result in results:
+            for event, key, c, area in result.get('summary', []):
+                outfile.write(f'{event},{key},{c},{names[c]},{area:.1f}\n')
+    return results
+
+
+def polygonize_mask(mask_path, extent_path, feedback, connectivity=4, tolerance=1.0, min_area=0, block_size=BLOCK_SIZE, batch_size=10000, layer_name='flood_extent'):
+    """
+    Writes the flood extent polygons of a filter mask (1 where kept) to a vector file in the format of its
+    extension (GeoPackage if it isn't recognised), one tile at a time.
+
+    The kept cells are labelled across tiles (see TiledComponents) and each tile is polygonized by region.
+    Polygons of regions within one tile are written straight away. The pieces of regions spanning tiles
+    are merged at the end of each row of tiles, once the seams between them are closed, so each open region
+    holds one polygon plus the pieces of the current row, and written after the last tile of the region. Polygons are simplified with tolerance (map
+    units, topology preserving) and those smaller than min_area dropped. Features are written in
+    transactions of batch_size. Returns the number of polygons written.
+    """
+    mask_dataset = gdal.Open(mask_path)
+    mask_band = mask_dataset.GetRasterBand(1)
+    width, height = mask_dataset.RasterXSize, mask_dataset.RasterYSize
+    gt = mask_dataset.GetGeoTransform()
+    windows = list(blocks(width, height, block_size))
+
+    def read_tile(window):
+        values, valid = read_block(mask_band, window)
+        keep = valid & (values > 0)
+        return keep.astype('uint8'), keep
+
+    feedback.pushInfo("Labelling flood extents...")
+    components = TiledComponents(read_tile, windows, width, connectivity)
+    last_tiles = components.last_tiles()
+
+    driver = vector_driver(extent_path)
+    if os.path.exists(extent_path):
+        driver.DeleteDataSource(extent_path)
+    extent = driver.CreateDataSource(extent_path)
+    if extent is None:
+        raise QgsProcessingException(f"Could not create {extent_path}")
+    srs = osr.SpatialReference(wkt=mask_dataset.GetProjection()) if mask_dataset.GetProjection() else None
+    layer_options = ['SPATIAL_INDEX=YES'] if 'SPATIAL_INDEX' in (driver.GetMetadataItem(gdal.DS_LAYER_CREATIONOPTIONLIST) or '') else []
+    layer = extent.CreateLayer(layer_name, srs, ogr.wkbMultiPolygon, options=layer_options)
+    layer.CreateField(ogr.FieldDefn('region', ogr.OFTInteger64))
+    layer.CreateField(ogr.FieldDefn('area', ogr.OFTReal))
+    definition = layer.GetLayerDefn()
+
+    written = 0
+    pending = 0
+    pieces = {}
+    memory_driver = ogr.GetDriverByName('Memory')
+
+    def merge(region_pieces):
+        if len(region_pieces) == 1:
+            return region_pieces[0]
+        collection = ogr.Geometry(ogr.wkbMultiPolygon)
+        for piece in region_pieces:
+            # merged pieces of earlier rows may be multipolygons
+            if piece.GetGeometryType() == ogr.wkbMultiPolygon:
+                for j in range(piece.GetGeometryCount()):
+                    collection.AddGeometry(piece.GetGeometryRef(j))
+            else:
+                collection.AddGeometry(piece)
+        return collection.UnionCascaded()
+
+    options = ['8CONNECTED=8'] if connectivity == 8 else []
+    layer.StartTransaction()
+
+    def write(region, geometry):
+        nonlocal written, pending
+        if tolerance:
+            geometry = geometry.SimplifyPreserveTopology(tolerance)
+        area = geometry.GetArea()
+        if geometry.IsEmpty() or area < min_area:
+            return
+        feature = ogr.Feature(definition)
+        feature.SetField('region', int(region))
+        feature.SetField('area', area)
+        feature.SetGeometry(ogr.ForceToMultiPolygon(geometry))
+        layer.CreateFeature(feature)
+        written += 1
+        pending += 1
+        if pending >= batch_size:
+            layer.CommitTransaction()
+            layer.StartTransaction()
+            pending = 0
+
+    feedback.pushInfo("Polygonizing flood extents...")
+    for i, window in enumerate(windows):
+        if feedback.isCanceled():
+            break
+        values, keep = read_tile(window)
+        labels = components.labels(i, values, keep)
+        col_0, row_0, tile_width, tile_height = window
+
+        tile = gdal.GetDriverByName('MEM').Create('', tile_width, tile_height, 1, gdal.GDT_Int32)
+        tile.SetGeoTransform((gt[0] + col_0 * gt[1] + row_0 * gt[2], gt[1], gt[2], gt[3] + col_0 * gt[4] + row_0 * gt[5], gt[4], gt[5]))
+        tile.GetRasterBand(1).WriteArray(labels.astype('int32'))
+        tile_mask = gdal.GetDriverByName('MEM').Create('', tile_width, tile_height, 1, gdal.GDT_Byte)
+        tile_mask.GetRasterBand(1).WriteArray(values)
+        polygons = memory_driver.CreateDataSource('').CreateLayer('polygons', None, ogr.wkbPolygon)
+        polygons.CreateField(ogr.FieldDefn('region', ogr.OFTInteger64))
+        gdal.Polygonize(tile.GetRasterBand(1), tile_mask.GetRasterBand(1), polygons, 0, options)
+
+        for polygon in polygons:
+            region = polygon.GetField('region')
+            pieces.setdefault(region, []).append(polygon.GetGeometryRef().Clone())
+
+        # regions ending in this tile are complete
+        for region in [r for r in pieces if last_tiles[r] <= i]:
+            write(region, merge(pieces.pop(region)))
+        # at the end of a row of tiles, dissolve the closed seams of the regions still open
+        if i + 1 == len(windows) or windows[i + 1][1] != row_0:
+            for region, region_pieces in pieces.items():
+                if len(region_pieces) > 1:
+                    pieces[region] = [merge(region_pieces)]
+        feedback.setProgress(100 * (i + 1) / len(windows))
+
+    layer.CommitTransaction()
+    extent = None
+    feedback.pushInfo(f"Wrote {written} flood extent polygons to {extent_path}")
+    return written
+
+
+# resolution options of FloodFilter: full resolution or coarsened previews
+PREVIEW_MODES = ['Full resolution', 'Preview (4x coarser)', 'Preview (8x coarser)']
+PREVIEW_FACTORS = [1, 4, 8]
+
+
+def coarse_coverage(window, factor, width, height):
+    """
+    Returns the fraction of each coarse cell of a window covered by the grid (cells on the right and bottom
+    edges are cut short when the grid size isn't a multiple of factor).
+    """
+    col_0, row_0, coarse_width, coarse_height = window
+    cols = np.minimum(factor, width - (col_0 + np.arange(coarse_width)) * factor) / factor
+    rows = np.minimum(factor, height - (row_0 + np.arange(coarse_height)) * factor) / factor
+    return np.outer(rows, cols)
+
+
+def coarse_reader(band, factor):
+    """
+    Returns a function reading a window of the grid coarsened by factor, averaging the cells of each coarse
+    cell (GDAL uses overviews if the grid has them).
+    """
+    width, height = band.XSize, band.YSize
+    nodata = band.GetNoDataValue()
+    def valid_cells(values):
+        valid = np.ones(values.shape, dtype=bool)
+        if values.dtype.kind == 'f':
+            valid &= ~np.isnan(values)
+        if nodata is not None:
+            valid &= values != nodata
+        return valid
+    def read_coarse(window):
+        col_0, row_0, coarse_width, coarse_height = window
+        x, y = col_0 * factor, row_0 * factor
+        full_cols = min(coarse_width, (width - x) // factor)
+        full_rows = min(coarse_height, (height - y) // factor)
+        values = np.zeros((coarse_height, coarse_width))
+        valid = np.zeros(values.shape, dtype=bool)
+        if full_cols and full_rows:
+            block = band.ReadAsArray(
+                x, y, full_cols * factor, full_rows * factor,
+                buf_xsize=full_cols, buf_ysize=full_rows, resample_alg=gdal.GRIORA_Average,
+            )
+            values[:full_rows, :full_cols] = block
+            valid[:full_rows, :full_cols] = valid_cells(block)
+        # coarse cells cut short by the right or bottom edge average the cells they cover, rather than
+        # stretching the edge of the window over the whole coarse row or column
+        edges = [
+            (slice(0, full_rows), slice(full_cols, coarse_width)),
+            (slice(full_rows, coarse_height), slice(0, full_cols)),
+            (slice(full_rows, coarse_height), slice(full_cols, coarse_width)),
+        ]
+        for rows, cols in edges:
+            n_rows, n_cols = rows.stop - rows.start, cols.stop - cols.start
+            if not n_rows or not n_cols:
+                continue
+            x_0, y_0 = x + cols.start * factor, y + rows.start * factor
+            block = band.ReadAsArray(x_0, y_0, min(n_cols * factor, width - x_0), min(n_rows * factor, height - y_0))
+            block_valid = valid_cells(block)
+            shape = (n_rows, block.shape[0] // n_rows, n_cols, block.shape[1] // n_cols)
+            sums = np.where(block_valid, block, 0).astype('float64').reshape(shape).sum(axis=(1, 3))
+            counts = block_valid.reshape(shape).sum(axis=(1, 3))
+            values[rows, cols] = sums / np.maximum(counts, 1)
+            valid[rows, cols] = counts > 0
+        return values, valid
+    return read_coarse
+
+
+def preview_filter(grids, criteria, area, factor, filter_path, feedback, block_size=BLOCK_SIZE, connectivity=4):
+    """
+    Runs the filter on the depth and DV grids coarsened by factor, with the area threshold scaled to the
+    coarse cells, and writes the coarse filter to filter_path. Returns the wet area (cells with depth and
+    DV) removed by each criteria, by any criteria, removed and restored by the sieve, and kept. Coarse cells
+    on the right and bottom edges only count the area they cover.
+    """
+    check_aligned(grids)
+    depth_dataset = gdal.Open(grids['DEPTH'])
+    dv_dataset = gdal.Open(grids['DV'])
+    gt = depth_dataset.GetGeoTransform()
+    width = math.ceil(depth_dataset.RasterXSize / factor)
+    height = math.ceil(depth_dataset.RasterYSize / factor)
+    like = gdal.GetDriverByName('MEM').Create('', width, height, 1, gdal.GDT_Byte)
+    like.SetGeoTransform((gt[0], gt[1] * factor, gt[2] * factor, gt[3], gt[4] * factor, gt[5] * factor))
+    like.SetProjection(depth_dataset.GetProjection())
+    windows = list(blocks(width, height, block_size))
+
+    read_depth = coarse_reader(depth_dataset.GetRasterBand(1), factor)
+    read_dv = coarse_reader(dv_dataset.GetRasterBand(1), factor)
+    def read_flags(window):
+        depth, depth_valid = read_depth(window)
+        dv, dv_valid = read_dv(window)
+        valid = depth_valid & dv_valid
+        return criteria_flags(depth, dv, valid, criteria), valid
+    read_tile = tile_reader(read_flags)
+
+    feedback.pushInfo(f"Labelling ponds and islands at {factor}x coarser resolution...")
+    components = TiledComponents(read_tile, windows, width, connectivity)
+    pixel_size = abs(gt[1]) * factor
+    small = components.small(math.floor(area / pixel_size**2))
+
+    counts = {'wet': 0, 'criteria': 0, 'sieve removed': 0, 'sieve restored': 0, 'kept': 0}
+    for c in range(len(criteria)):
+        counts[f'criteria {c + 1}'] = 0
+    output = OutputRaster(filter_path, like, gdal.GDT_Float32, 0)
+    for i, window in enumerate(windows):
+        if feedback.isCanceled():
+            break
+        flags, valid = read_flags(window)
+        remove = criteria_block(flags, valid) == REMOVE
+        flipped = small[components.labels(i, remove.astype('uint8'), valid)]
+        # small regions take the other value
+        keep = valid & ~(remove ^ flipped)
+        output.write(keep.astype('float32'), window)
+
+        coverage = coarse_coverage(window, factor, depth_dataset.RasterXSize, depth_dataset.RasterYSize)
+        counts['wet'] += float(coverage[valid].sum())
+        counts['criteria'] += float(coverage[valid & remove].sum())
+        for c in range(len(criteria)):
+            counts[f'criteria {c + 1}'] += float(coverage[valid & ((flags >> c) & 1).astype(bool)].sum())
+        counts['sieve removed'] += float(coverage[valid & ~remove & flipped].sum())
+        counts['sieve restored'] += float(coverage[valid & remove & flipped].sum())
+        counts['kept'] += float(coverage[keep].sum())
+        feedback.setProgress(100 * (i + 1) / len(windows))
+    output.close()
+
+    cell_area = abs(like.GetGeoTransform()[1] * like.GetGeoTransform()[5])
+    return {key: count * cell_area for key, count in counts.items()}
 
 class FloodFilter(QgsProcessingAlgorithm):
     DEPTH_C1 = 'DEPTH_C1'
@@ -35,6 +1484,14 @@ class FloodFilter(QgsProcessingAlgorithm):
     DEPTH_C2 = 'DEPTH_C2'
     DV_C2 = 'DV_C2'
     AREA = 'AREA'
+    EIGHT_CONNECTED = 'EIGHT_CONNECTED'
+    CACHE_FOLDER = 'CACHE_FOLDER'
+    CACHE_SIZE = 'CACHE_SIZE'
+    CREATION_OPTIONS = 'CREATION_OPTIONS'
+    EXTENT = 'EXTENT'
+    SIMPLIFY = 'SIMPLIFY'
+    EXTENT_AREA = 'EXTENT_AREA'
+    PREVIEW = 'PREVIEW'
     DEPTH = 'DEPTH'
     VELOCITY = 'VELOCITY'
     DV = 'DV'
@@ -42,6 +1499,16 @@ class FloodFilter(QgsProcessingAlgorithm):
     HAZARD = 'HAZARD'
     LEVEL = 'LEVEL'
     OUTPUT_FOLDER = 'OUTPUT_FOLDER'
+    # removed area statistics of previews
+    AREA_OUTPUTS = {
+        'wet': 'WET_AREA',
+        'criteria': 'CRITERIA_AREA',
+        'criteria 1': 'CRITERIA_1_AREA',
+        'criteria 2': 'CRITERIA_2_AREA',
+        'sieve removed': 'SIEVE_REMOVED_AREA',
+        'sieve restored': 'SIEVE_RESTORED_AREA',
+        'kept': 'KEPT_AREA',
+    }
 
     def tr(self, string):
         return QCoreApplication.translate('Processing', string)
@@ -105,6 +1572,46 @@ class FloodFilter(QgsProcessingAlgorithm):
                 500,
             )
         )
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                self.PREVIEW,
+                self.tr('Resolution (previews write a coarse filter and removed area statistics only)'),
+                options=PREVIEW_MODES,
+                defaultValue=0,
+            )
+        )
+        eight_connected = QgsProcessingParameterBoolean(
+            self.EIGHT_CONNECTED,
+            self.tr('Join ponds/islands diagonally (8-connectedness)'),
+            False,
+        )
+        eight_connected.setFlags(eight_connected.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(eight_connected)
+        cache_folder = QgsProcessingParameterFile(
+            self.CACHE_FOLDER,
+            self.tr('Cache folder for criteria and regions (speeds up re-runs, leave blank for none)'),
+            behavior=QgsProcessingParameterFile.Folder,
+            optional=True,
+        )
+        cache_folder.setFlags(cache_folder.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(cache_folder)
+        cache_size = QgsProcessingParameterNumber(
+            self.CACHE_SIZE,
+            self.tr('Cache size limit (GB)'),
+            QgsProcessingParameterNumber.Double,
+            CACHE_SIZE,
+            minValue=0,
+        )
+        cache_size.setFlags(cache_size.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(cache_size)
+        creation_options = QgsProcessingParameterString(
+            self.CREATION_OPTIONS,
+            self.tr('Creation options for filtered grids (space separated KEY=VALUE)'),
+            CREATION_OPTIONS,
+            optional=True,
+        )
+        creation_options.setFlags(creation_options.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(creation_options)
         self.addParameter(
             QgsProcessingParameterRasterLayer(
                 self.DEPTH,
@@ -129,8 +1636,9 @@ class FloodFilter(QgsProcessingAlgorithm):
         self.addParameter(
             QgsProcessingParameterRasterLayer(
                 self.HAZARD,
-                self.tr('Raw Hazard grid'),
-                [QgsProcessing.TypeRaster]
+                self.tr('Raw Hazard grid (leave blank to derive ARR hazard classes from depth, velocity and DV)'),
+                [QgsProcessing.TypeRaster],
+                optional=True,
             )
         )
         self.addParameter(
@@ -152,106 +1660,162 @@ class FloodFilter(QgsProcessingAlgorithm):
                 self.tr('Folder for Filtered Outputs')
             )
         )
+        self.addParameter(
+            QgsProcessingParameterVectorDestination(
+                self.EXTENT,
+                self.tr('Flood extent polygons'),
+                QgsProcessing.TypeVectorPolygon,
+                optional=True,
+                createByDefault=False,
+            )
+        )
+        simplify = QgsProcessingParameterNumber(
+            self.SIMPLIFY,
+            self.tr('Flood extent simplification tolerance (map units, 0 for none)'),
+            QgsProcessingParameterNumber.Double,
+            1.0,
+            minValue=0,
+        )
+        simplify.setFlags(simplify.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(simplify)
+        extent_area = QgsProcessingParameterNumber(
+            self.EXTENT_AREA,
+            self.tr('Minimum flood extent polygon area'),
+            QgsProcessingParameterNumber.Double,
+            0,
+            minValue=0,
+        )
+        extent_area.setFlags(extent_area.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(extent_area)
+        for key, name in self.AREA_OUTPUTS.items():
+            self.addOutput(QgsProcessingOutputNumber(name, self.tr(f'Preview {key} area')))
 
     def processAlgorithm(self, parameters, context, feedback):
 
-        depth_raster = QgsRasterLayer(parameters['DEPTH'])#, os.path.basename(parameters['DEPTH'])[:-4])
-        velocity_raster = QgsRasterLayer(parameters['VELOCITY'])#, os.path.basename(parameters['VELOCITY'])[:-4])
-        dv_raster = QgsRasterLayer(parameters['DV'])#, os.path.basename(parameters['DV'])[:-4])
-        
-        filtered = processing.run(
-            "gdal:rastercalculator",
-            {
-                'INPUT_A': depth_raster,
-                'BAND_A': '1',
-                'INPUT_B': dv_raster,
-                'BAND_B': '1',
-                'FORMULA': f"logical_or(logical_and((A < {parameters['DEPTH_C1']}),(B < {parameters['DV_C1']})),logical_and((A < {parameters['DEPTH_C2']}),(B < {parameters['DV_C2']})))",
-                'RTYPE': '1',
-                'OUTPUT': 'TEMPORARY_OUTPUT'
-            },
-            is_child_algorithm=True,
-            context=context,
-            feedback=feedback
-        )
+        layers = {key: self.parameterAsRasterLayer(parameters, key, context) for key in FILTERED_GRIDS}
+        grids = {key: layer.source() for key, layer in layers.items() if layer is not None}
+        criteria = [
+            (self.parameterAsDouble(parameters, self.DEPTH_C1, context), self.parameterAsDouble(parameters, self.DV_C1, context)),
+            (self.parameterAsDouble(parameters, self.DEPTH_C2, context), self.parameterAsDouble(parameters, self.DV_C2, context)),
+        ]
+        area = self.parameterAsDouble(parameters, self.AREA, context)
+        connectivity = 8 if self.parameterAsBoolean(parameters, self.EIGHT_CONNECTED, context) else 4
+        cache_folder = self.parameterAsFile(parameters, self.CACHE_FOLDER, context)
+        cache_size = self.parameterAsDouble(parameters, self.CACHE_SIZE, context)
+        creation_options = self.parameterAsString(parameters, self.CREATION_OPTIONS, context)
+        factor = PREVIEW_FACTORS[self.parameterAsEnum(parameters, self.PREVIEW, context)]
+        filter_path = self.parameterAsOutputLayer(parameters, self.FILTER, context)
 
-        sieve = processing.run(
-            "gdal:sieve", 
-            {
-                'INPUT': filtered['OUTPUT'],
-                'THRESHOLD': math.floor(parameters['AREA'] / depth_raster.rasterUnitsPerPixelX()**2),
-                'EIGHT_CONNECTEDNESS': False,
-                'NO_MASK': False,
-                'MASK_LAYER': None,
-                'EXTRA': '',
-                'OUTPUT': 'TEMPORARY_OUTPUT'
-            },
-            is_child_algorithm=True,
-            context=context,
-            feedback=feedback
-        )
-        
-        mask = processing.run(
-            "gdal:rastercalculator",
-            {
-                'INPUT_A': sieve['OUTPUT'],
-                'BAND_A': '1',
-                'FORMULA': 'A==0',
-                'RTYPE': '1',
-                'NO_DATA': 0,
-                'OUTPUT': 'TEMPORARY_OUTPUT'
-            },
-            is_child_algorithm=True,
-            context=context,
-            feedback=feedback
-        )
+        if factor > 1:
+            stats = preview_filter(grids, criteria, area, factor, filter_path, feedback, connectivity=connectivity)
+            if feedback.isCanceled():
+                return {}
+            wet = stats['wet'] or 1
+            feedback.pushInfo(f"Wet area: {stats['wet']:.0f}")
+            for key, value in stats.items():
+                if key != 'wet':
+                    feedback.pushInfo(f"  {key}: {value:.0f} ({100 * value / wet:.1f}%)")
+            return {self.FILTER: filter_path, **{self.AREA_OUTPUTS[key]: value for key, value in stats.items()}}
 
-        if feedback.isCanceled():
-            return {}
-            
-        filter_final = processing.run(
-            "native:rasterbooleanand", 
-            {
-                'INPUT': [mask['OUTPUT']],
-                'REF_LAYER': mask['OUTPUT'],
-                'NODATA_AS_FALSE': False,
-                'NO_DATA': 0,
-                'DATA_TYPE': 5,
-                'OUTPUT': parameters['FILTER']
-            },
-            is_child_algorithm=True,
-            context=context,
-            feedback=feedback
-        )
+        output_folder = self.parameterAsString(parameters, self.OUTPUT_FOLDER, context)
+
+        outputs = filter_flood_grids(grids, criteria, area, filter_path, output_folder, feedback, connectivity=connectivity, cache_folder=cache_folder, creation_options=creation_options, cache_size=cache_size)
 
         if feedback.isCanceled():
             return {}
 
-        orig_rasters = {
-            parameters['DEPTH']: '5',
-            parameters['VELOCITY']: '5',
-            parameters['DV']: '5',
-            parameters['LEVEL']: '5',
-            parameters['HAZARD']: '1',
+        results = {
+            'FILTER': outputs['FILTER'],
         }
 
-        for orig_raster, rtype in orig_rasters.items():
-            filtered_result = processing.run(
-                    "gdal:rastercalculator",
-                    {
-                        'INPUT_A': filter_final['OUTPUT'],
-                        'BAND_A': '1',
-                        'INPUT_B': orig_raster,
-                        'BAND_B': '1',
-                        'FORMULA': 'A*B',
-                        'RTYPE': rtype,
-                        'OUTPUT': os.path.join(parameters['OUTPUT_FOLDER'], os.path.basename(orig_raster[:-4])+'_filtered'+orig_raster[-4:])
-                    },
-                    is_child_algorithm=True,
-                    context=context,
-                    feedback=feedback
-                )
-
-        return {
-            'FILTER': filter_final['OUTPUT'],
-        }
+        if parameters.get(self.EXTENT):
+            extent_path = self.parameterAsOutputLayer(parameters, self.EXTENT, context)
+            polygonize_mask(
+                outputs['FILTER'],
+                extent_path,
+                feedback,
+                connectivity=connectivity,
+                tolerance=self.parameterAsDouble(parameters, self.SIMPLIFY, context),
+                min_area=self.parameterAsDouble(parameters, self.EXTENT_AREA, context),
+            )
+            results['EXTENT'] = extent_path
+
+        return results
+
+
+def main(argv=None):
+    """
+    Command line entry point for running the flood filter outside of the QGIS GUI.
+    """
+    parser = argparse.ArgumentParser(description='Flood grid filtering')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    batch_parser = subparsers.add_parser('batch', help='Filter a manifest of events')
+    batch_parser.add_argument('manifest', help='JSON event manifest (see run_filter_manifest)')
+    batch_parser.add_argument('--workers', type=int, help='Number of worker processes')
+
+    envelope_parser = subparsers.add_parser('envelope', help='Peak envelope and critical event of filtered results')
+    envelope_parser.add_argument('folders', nargs='+', help='Folders of filtered results')
+    envelope_parser.add_argument('--output-folder', required=True)
+    envelope_parser.add_argument('--name', default='envelope', help='Output name prefix')
+    envelope_parser.add_argument('--critical', choices=list(FILTERED_GRIDS), default='DEPTH', help='Grid deciding the critical event')
+    envelope_parser.add_argument('--block-size', type=int, default=BLOCK_SIZE)
+
+    difference_parser = subparsers.add_parser('difference', help='Afflux/difference grids between two folders of filtered results')
+    difference_parser.add_argument('base_folder', help='Filtered results of the base (e.g. existing) case')
+    difference_parser.add_argument('developed_folder', help='Filtered results of the developed case')
+    difference_parser.add_argument('--output-folder', required=True)
+    difference_parser.add_argument('--grids', nargs='+', choices=list(FILTERED_GRIDS), default=['LEVEL', 'DEPTH'])
+    difference_parser.add_argument('--rename', nargs=2, metavar=('BASE', 'DEVELOPED'), help='Text replaced in base event names to find the developed event')
+    difference_parser.add_argument('--bands', type=float, nargs='+', default=AFFLUX_BANDS, help='Afflux band edges (m)')
+    difference_parser.add_argument('--resampling', default='near', help='Resampling of developed grids not aligned with the base grids')
+    difference_parser.add_argument('--workers', type=int, default=1, help='Number of worker processes')
+
+    polygonize_parser = subparsers.add_parser('polygonize', help='Flood extent polygons of a filter mask')
+    polygonize_parser.add_argument('mask', help='Filter mask (1 where kept)')
+    polygonize_parser.add_argument('extent', help='Output vector file (format from the extension, GeoPackage by default)')
+    polygonize_parser.add_argument('--eight-connected', action='store_true')
+    polygonize_parser.add_argument('--tolerance', type=float, default=1.0, help='Simplification tolerance (map units)')
+    polygonize_parser.add_argument('--min-area', type=float, default=0, help='Minimum polygon area')
+    polygonize_parser.add_argument('--block-size', type=int, default=BLOCK_SIZE)
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'batch':
+        results = run_filter_manifest(args.manifest, workers=args.workers)
+        failed = [result for result in results if 'error' in result]
+        for result in results:
+            if 'error' in result:
+                print(f"{result['name']}: FAILED - {result['error']}")
+            else:
+                print(f"{result['name']}: {'up to date' if result['skipped'] else 'filtered'}")
+        sys.exit(1 if failed else 0)
+
+    elif args.command == 'envelope':
+        events = {}
+        for folder in args.folders:
+            events.update(discover_filtered_events(folder))
+        outputs = envelope_grids(events, args.output_folder, args.name, PrintFeedback(), critical_key=args.critical, block_size=args.block_size)
+        for path in outputs.values():
+            print(f"Wrote {path}")
+
+    elif args.command == 'difference':
+        results = difference_folders(
+            args.base_folder, args.developed_folder, args.output_folder, keys=args.grids, rename=args.rename,
+            workers=args.workers, bands=sorted(args.bands), resampling=args.resampling,
+        )
+        failed = [result for result in results if 'error' in result]
+        for result in failed:
+            print(f"{result['name']}: FAILED - {result['error']}")
+        print(f"Differenced {len(results) - len(failed)} of {len(results)} events")
+        sys.exit(1 if failed else 0)
+
+    elif args.command == 'polygonize':
+        polygonize_mask(
+            args.mask, args.extent, PrintFeedback(), connectivity=8 if args.eight_connected else 4,
+            tolerance=args.tolerance, min_area=args.min_area, block_size=args.block_size,
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -12,28 +12,57 @@ Report issues at https://github.com/danielcopelin/flood_scripts_public/blob/main
 """
 
 
+import io
 import os
+import sys
+import argparse
+import socket
+import threading
+import socketserver
+import concurrent.futures
 import glob
+import json
+import time
+import re
+import hashlib
+import zipfile
+import warnings
 import pandas as pd
+import numpy as np
 import datetime
+import collections
 
-from qgis.PyQt.QtCore import QCoreApplication
+from osgeo import gdal, ogr
+from qgis.PyQt.QtCore import QCoreApplication, QVariant
 from qgis.core import (
-    QgsRasterLayer,
+    QgsApplication,
+    QgsCoordinateTransform,
+    QgsFeature,
+    QgsFeatureSink,
+    QgsField,
+    QgsFields,
+    QgsGeometry,
+    QgsLineString,
+    QgsProject,
+    QgsVectorFileWriter,
+    QgsVectorLayer,
+    QgsProcessingFeedback,
     QgsProcessing,
+    QgsProcessingException,
     QgsProcessingAlgorithm,
+    QgsProcessingParameterBoolean,
     QgsProcessingParameterCrs,
     QgsProcessingParameterEnum,
     QgsProcessingParameterFeatureSource,
     QgsProcessingParameterField,
     QgsProcessingParameterFile,
+    QgsProcessingParameterNumber,
+    QgsProcessingParameterString,
     QgsProcessingParameterFolderDestination,
-    QgsProcessingParameterVectorDestination,
+    QgsProcessingParameterFeatureSink,
     QgsProcessingParameterDefinition,
     QgsCoordinateReferenceSystem,
-    edit,
 )
-from qgis import processing
 
 
 DEFAULT_GRID_LOCATION = 'H:/03_Work/03_Code/QRA_SEQ_IFD/QRA_SEQ_IFDUpdate/IFD_data'
@@ -310,130 +339,1519 @@ RAINFALL_FACTORS = [
 ] # ARR Book 1 Chapter 6 Table 1.6.1 and 1.6.5
 
 
-def rainfall_factor(duration, degrees_warming):
-    rainfall_factors = dict(zip(DURATIONS['QRA SEQ'], RAINFALL_FACTORS))
-    rainfall_factor = (1+rainfall_factors[duration]/100.0)**degrees_warming ## ARR Book 1 Chapter 6 Eqn 1.6.1
+SCENARIO_LAYOUTS = [
+    'Scenario suffixed fields',
+    'Long format',
+]
 
-    return rainfall_factor
 
-def createBomCSVs(input_layer, results_dict, grid_set, depth_or_intensity, id_field, output_folder, climate_scenario, feedback, context):
+DURATION_MINUTES = dict(zip(DURATIONS['QRA SEQ'], [int(d) for d in DURATIONS['LIMB']]))
 
-    aeps_naming = dict(zip(AEPS['QRA SEQ'], AEPS['BOM']))
-    durations_naming = dict(zip(DURATIONS['QRA SEQ'], DURATIONS['BOM']))
-    numerical_durations = dict(zip(DURATIONS['QRA SEQ'], DURATIONS['LIMB']))
 
-    date = datetime.datetime.today().strftime('%d %B %Y')
+AEP_PERCENTS = dict(zip(AEPS['QRA SEQ'], [63.2, 50, 39.35, 20, 18.13, 10, 5, 2, 1, 0.5, 0.2, 0.1, 0.05]))
 
-    for feature in input_layer.getFeatures():
-        feature_id = feature[id_field]
-        if input_layer.crs().isGeographic():
-            header_template = '\n'.join(
-                [ f'QRA SEQ 2024 IFD ({grid_set})',
-                '',
-                f'IFD Design Rainfall {depth_or_intensity} (mm{"/hr" if depth_or_intensity == "Intensity" else ""}) - {0}',
-                'Issued:,{1}',
-                'Location Label:,{2}',
-                'Requested coordinate:,Latitude,{3:.4f},Longitude,{4:.4f}',
-                'Nearest grid cell:,Latitude,{5},Longitude,{6}',
-                '',
-                ',,Annual Exceedance Probability (AEP)\n'
-                ]
+
+def duration_minutes(duration):
+    """
+    Returns the length in minutes of a QRA SEQ duration, or of a non-standard duration such as '100min'.
+    """
+    if duration in DURATION_MINUTES:
+        return DURATION_MINUTES[duration]
+    return float(re.fullmatch(r'([\d.]+)min', duration).group(1))
+
+
+def aep_percent(aep):
+    """
+    Returns the AEP (%) of a QRA SEQ AEP, or of a non-standard AEP such as '3pct'.
+    """
+    if aep in AEP_PERCENTS:
+        return AEP_PERCENTS[aep]
+    return float(re.fullmatch(r'([\d.]+)pct', aep).group(1))
+
+
+def duration_label(duration, style):
+    if duration in DURATION_MINUTES:
+        return dict(zip(DURATIONS['QRA SEQ'], DURATIONS[style]))[duration]
+    minutes = duration_minutes(duration)
+    if style == 'BOM':
+        return f'{minutes:g} min' if minutes < 60 else f'{minutes / 60:g} hour'
+    elif style == 'URBS':
+        return f'{minutes:g}m' if minutes < 60 else f'{minutes / 60:g}h'
+    return duration
+
+
+def aep_label(aep, style):
+    if aep in AEP_PERCENTS:
+        return dict(zip(AEPS['QRA SEQ'], AEPS[style]))[aep]
+    percent = aep_percent(aep)
+    if style == 'BOM':
+        return f'{percent:g}%'
+    elif style == 'URBS':
+        return f'ARI{100 / percent:g}'
+    return aep
+
+
+def parse_numbers(text):
+    """
+    Parses a comma or space separated list of numbers, e.g. '100, 240'.
+    """
+    try:
+        return [float(value) for value in re.split(r'[,\s]+', text.strip()) if value]
+    except ValueError:
+        raise QgsProcessingException(f"Could not read a list of numbers from {text!r}")
+
+
+def _bracket(value, standard, values):
+    """
+    Returns the standard entries either side of value, where values holds their numeric equivalents.
+    """
+    order = np.argsort(values)
+    sorted_values = np.asarray(values)[order]
+    if value < sorted_values[0] or value > sorted_values[-1]:
+        return None
+    upper = int(np.searchsorted(sorted_values, value))
+    lower = upper if sorted_values[upper] == value else upper - 1
+    return {standard[order[lower]], standard[order[upper]]}
+
+
+def ifd_axes(aeps, durations, extra_aeps=(), extra_durations=()):
+    """
+    Adds non-standard AEPs (%) and durations (minutes) to the selected QRA SEQ ones.
+
+    Returns (extract_aeps, extract_durations, output_aeps, output_durations): the standard AEPs and durations
+    to extract, including the neighbours needed to interpolate each non-standard value, and the AEPs and
+    durations to report, in standard order.
+    """
+    extract_aeps, extract_durations = set(aeps), set(durations)
+    output_aeps, output_durations = list(aeps), list(durations)
+
+    for percent in extra_aeps:
+        neighbours = _bracket(percent, AEPS['QRA SEQ'], [AEP_PERCENTS[a] for a in AEPS['QRA SEQ']])
+        if neighbours is None:
+            raise QgsProcessingException(f"AEP {percent:g}% is outside the range of the IFD grids")
+        extract_aeps |= neighbours
+        aep = next((a for a in AEPS['QRA SEQ'] if AEP_PERCENTS[a] == percent), f'{percent:g}pct')
+        if aep not in output_aeps:
+            output_aeps.append(aep)
+
+    for minutes in extra_durations:
+        neighbours = _bracket(minutes, DURATIONS['QRA SEQ'], [DURATION_MINUTES[d] for d in DURATIONS['QRA SEQ']])
+        if neighbours is None:
+            raise QgsProcessingException(f"Duration {minutes:g} min is outside the range of the IFD grids")
+        extract_durations |= neighbours
+        duration = next((d for d in DURATIONS['QRA SEQ'] if DURATION_MINUTES[d] == minutes), f'{minutes:g}min')
+        if duration not in output_durations:
+            output_durations.append(duration)
+
+    extract_aeps = [a for a in AEPS['QRA SEQ'] if a in extract_aeps]
+    extract_durations = [d for d in DURATIONS['QRA SEQ'] if d in extract_durations]
+    output_aeps.sort(key=aep_percent, reverse=True)
+    output_durations.sort(key=duration_minutes)
+    return extract_aeps, extract_durations, output_aeps, output_durations
+
+
+def _interpolation_weights(x, x_new):
+    """
+    Returns the lower/upper indices and weights for linear interpolation of increasing x at x_new.
+    """
+    upper = np.clip(np.searchsorted(x, x_new), 1, len(x) - 1) if len(x) > 1 else np.zeros(len(x_new), dtype='int64')
+    lower = np.maximum(upper - 1, 0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        weight = np.where(x[upper] != x[lower], (x_new - x[lower]) / (x[upper] - x[lower]), 0.0)
+    return lower, upper, weight
+
+
+def interpolate_ifd_cube(cube, aeps, durations, new_aeps, new_durations):
+    """
+    Interpolates a (feature, aep, duration) cube onto new AEPs and durations in one vectorized step.
+    Depths are interpolated log-log: log depth against log duration, then log depth against log AEP.
+    Standard AEPs and durations come through unchanged.
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        log_cube = np.log(cube)
+
+        x = np.log([duration_minutes(d) for d in durations])
+        lower, upper, weight = _interpolation_weights(x, np.log([duration_minutes(d) for d in new_durations]))
+        log_cube = log_cube[:, :, lower] * (1 - weight) + log_cube[:, :, upper] * weight
+
+        # AEPs run from frequent to rare, so interpolate on -log(AEP) which increases along the axis
+        x = -np.log([aep_percent(a) for a in aeps])
+        lower, upper, weight = _interpolation_weights(x, -np.log([aep_percent(a) for a in new_aeps]))
+        log_cube = log_cube[:, lower, :] * (1 - weight)[np.newaxis, :, np.newaxis] + log_cube[:, upper, :] * weight[np.newaxis, :, np.newaxis]
+
+    return np.exp(log_cube)
+
+
+def climate_factors(durations, degrees_warming):
+    """
+    Returns the climate change rainfall factor for each duration as an array, for broadcasting over the
+    duration axis of an IFD result cube.
+    """
+    # non-standard durations take the factor interpolated against log duration
+    standard_minutes = np.log([DURATION_MINUTES[d] for d in DURATIONS['QRA SEQ']])
+    percentages = np.interp(np.log([duration_minutes(d) for d in durations]), standard_minutes, RAINFALL_FACTORS)
+    return (1 + percentages / 100.0) ** degrees_warming ## ARR Book 1 Chapter 6 Eqn 1.6.1
+
+
+def summarise_ifd_cube(base_cube, adjusted_cube, aeps, durations, factors, feedback):
+    """
+    Logs summary statistics of the extracted and climate adjusted depths rather than a line per feature.
+    """
+    feedback.pushInfo(f"Climate change rainfall factors: {factors.min():.3f} ({durations[int(factors.argmin())]}) to {factors.max():.3f} ({durations[int(factors.argmax())]}).")
+    missing = np.isnan(base_cube).all(axis=(1, 2)).sum()
+    if missing:
+        feedback.pushInfo(f"{missing} of {base_cube.shape[0]} features have no IFD values (outside the grids or in nodata cells).")
+    with np.errstate(invalid='ignore'), warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        for a, aep in enumerate(aeps):
+            if np.isnan(base_cube[:, a]).all():
+                continue
+            feedback.pushInfo(
+                f"{aep}: base {np.nanmin(base_cube[:, a]):.1f} to {np.nanmax(base_cube[:, a]):.1f} mm, "
+                f"adjusted {np.nanmin(adjusted_cube[:, a]):.1f} to {np.nanmax(adjusted_cube[:, a]):.1f} mm "
+                f"(mean change {np.nanmean(adjusted_cube[:, a] - base_cube[:, a]):.2f} mm)"
             )
-            if feature.geometry().type() == 0: # points
-                lat, lon = feature.geometry().get().y(), feature.geometry().get().x()
-                near_lat, near_lon = 0, 0
-            elif feature.geometry().type() == 2: # polygons
-                lat, lon = feature.geometry().centroid().get().y(), feature.geometry().centroid().get().x()
-                near_lat, near_lon = 0, 0
-            header = header_template.format(grid_set, date, feature_id, lat, lon, near_lat, near_lon)
 
-        else:
-            header_template = '\n'.join(
-                [ f'QRA SEQ 2024 IFD ({grid_set})',
-                '',
-                f'IFD Design Rainfall {depth_or_intensity} (mm{"/hr" if depth_or_intensity == "Intensity" else ""}) - {0}',
-                'Issued:,{1}',
-                'Location Label:,{2}',
-                'Requested coordinate:,Easting,{3:.1f},Northing,{4:.1f},Zone,{5}',
-                'Nearest grid cell:,Latitude,{6},Longitude,{7}',
-                '',
-                ',,Annual Exceedance Probability (AEP)\n'
-                ]
+
+def grid_name_key(aep, duration):
+    return f'IFD_{"ARI" if aep in ("2y", "5y") else "AEP"}_{aep}_{duration}'
+
+
+def grid_cache_folder():
+    """
+    Folder for the IFD tool's cached files, kept alongside the active QGIS user profile. Outside of QGIS
+    (no application started, so no profile) the files go to the user's home folder rather than the
+    working directory.
+    """
+    settings_folder = QgsApplication.qgisSettingsDirPath() if QgsApplication.instance() is not None else ''
+    if not settings_folder:
+        return os.path.join(os.path.expanduser('~'), '.ifd_tool_cache')
+    return os.path.join(settings_folder, 'ifd_tool_cache')
+
+
+class GridIndex:
+    """
+    Persistent index of an IFD grid folder. Maps each (aep, duration) to the grid file path, geotransform,
+    shape, CRS, data type and nodata value so that runs don't need to list the folder or open grids to
+    find them.
+
+    The index is cached as JSON in the user profile and rebuilt when the folder's modification time
+    changes. Individual entries are refreshed when a grid's size or modification time no longer matches.
+    """
+    VERSION = 1
+
+    def __init__(self, grid_folder, folder_mtime, entries):
+        self.grid_folder = grid_folder
+        self.folder_mtime = folder_mtime
+        self.entries = entries
+
+    @staticmethod
+    def cache_path(grid_folder, cache_folder=None):
+        folder_hash = hashlib.sha1(os.path.normcase(os.path.abspath(grid_folder)).encode('utf-8')).hexdigest()[:16]
+        return os.path.join(cache_folder or grid_cache_folder(), f'grid_index_{folder_hash}.json')
+
+    @classmethod
+    def load(cls, grid_folder, cache_folder=None, feedback=None):
+        """
+        Returns the cached index for grid_folder, rebuilding it if it's missing or out of date.
+        """
+        if not os.path.isdir(grid_folder):
+            raise QgsProcessingException(f"IFD grid folder {grid_folder} not found")
+        cache_path = cls.cache_path(grid_folder, cache_folder)
+        folder_mtime = os.stat(grid_folder).st_mtime
+        try:
+            with open(cache_path) as infile:
+                cached = json.load(infile)
+            if cached['version'] == cls.VERSION and cached['grid_folder'] == grid_folder and cached['folder_mtime'] == folder_mtime:
+                entries = {tuple(key.split('|')): entry for key, entry in cached['entries'].items()}
+                return cls(grid_folder, folder_mtime, entries)
+        except (OSError, ValueError, KeyError):
+            pass
+
+        if feedback is not None:
+            feedback.pushInfo(f"Indexing grid folder {grid_folder}...")
+        index = cls.build(grid_folder, folder_mtime)
+        index.save(cache_path)
+        return index
+
+    @classmethod
+    def build(cls, grid_folder, folder_mtime):
+        grids = glob.glob(os.path.join(grid_folder, "*.tiff"))
+        entries = {}
+        for aep in AEPS['QRA SEQ']:
+            for duration in DURATIONS['QRA SEQ']:
+                grid_match = [g for g in grids if grid_name_key(aep, duration) in g]
+                if grid_match:
+                    entries[(aep, duration)] = cls.describe(grid_match[0])
+        return cls(grid_folder, folder_mtime, entries)
+
+    @staticmethod
+    def describe(grid_path):
+        stat = os.stat(grid_path)
+        dataset = gdal.Open(grid_path)
+        if dataset is None:
+            raise QgsProcessingException(f"Could not open grid {grid_path}")
+        band = dataset.GetRasterBand(1)
+        return {
+            'path': grid_path,
+            'size': stat.st_size,
+            'mtime': stat.st_mtime,
+            'geotransform': list(dataset.GetGeoTransform()),
+            'shape': [dataset.RasterYSize, dataset.RasterXSize],
+            'crs': dataset.GetProjection(),
+            'dtype': gdal.GetDataTypeName(band.DataType),
+            'nodata': band.GetNoDataValue(),
+        }
+
+    def save(self, cache_path=None):
+        cache_path = cache_path or self.cache_path(self.grid_folder)
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        temp_path = cache_path + '.tmp'
+        with open(temp_path, 'w') as outfile:
+            json.dump(
+                {
+                    'version': self.VERSION,
+                    'grid_folder': self.grid_folder,
+                    'folder_mtime': self.folder_mtime,
+                    'entries': {'|'.join(key): entry for key, entry in self.entries.items()},
+                },
+                outfile,
             )
-            if feature.geometry().type() == 0: # points
-                easting, northing = feature.geometry().get().x(), feature.geometry().get().y()
-                near_lat, near_lon = 0, 0
-            elif feature.geometry().type() == 2: # polygons
-                easting, northing = feature.geometry().centroid().get().x(), feature.geometry().centroid().get().y()
-                near_lat, near_lon = 0, 0
+        os.replace(temp_path, cache_path)
+
+    def fingerprint(self):
+        """
+        Returns a hash of the name, size and modification time (read from disk) of every indexed grid.
+        """
+        files = []
+        for key, entry in sorted(self.entries.items()):
+            stat = os.stat(entry['path'])
+            files.append(['|'.join(key), os.path.basename(entry['path']), stat.st_size, stat.st_mtime])
+        return hashlib.sha1(json.dumps(files).encode('utf-8')).hexdigest()
+
+    def crs(self):
+        """
+        Returns the CRS (as WKT) of the indexed grids, or '' if the grids don't define one.
+        """
+        return next((entry['crs'] for entry in self.entries.values() if entry['crs']), '')
+
+    def grid_paths(self, aeps, durations):
+        """
+        Returns {(aep, duration): path} for the grids found, refreshing any entries whose file has changed.
+        """
+        grid_paths = {}
+        changed = False
+        for aep in aeps:
+            for duration in durations:
+                entry = self.entries.get((aep, duration))
+                if entry is None:
+                    continue
+                stat = os.stat(entry['path'])
+                if stat.st_size != entry['size'] or stat.st_mtime != entry['mtime']:
+                    entry = self.entries[(aep, duration)] = self.describe(entry['path'])
+                    changed = True
+                grid_paths[(aep, duration)] = entry['path']
+        if changed:
+            self.save()
+        return grid_paths
+
+
+class GridMirror:
+    """
+    Opt-in local mirror of network IFD grids. Grids are copied into the cache folder on first use and
+    reused while the source file's size and modification time are unchanged and the local copy still
+    matches its checksum. Least recently used grids are evicted once the cache exceeds max_bytes.
+    """
+    MANIFEST = 'mirror_manifest.json'
+
+    def __init__(self, cache_folder, max_bytes):
+        self.cache_folder = cache_folder
+        self.max_bytes = max_bytes
+        os.makedirs(cache_folder, exist_ok=True)
+        try:
+            with open(os.path.join(cache_folder, self.MANIFEST)) as infile:
+                self.manifest = json.load(infile)
+        except (OSError, ValueError):
+            self.manifest = {}
+
+    def resolve(self, source_path):
+        """
+        Returns the path of a valid local copy of source_path, mirroring it first if required.
+        """
+        source_stat = os.stat(source_path)
+        entry = self.manifest.get(source_path)
+        if entry is None or not self._valid(entry, source_stat):
+            entry = self._mirror(source_path, source_stat)
+        entry['last_used'] = time.time()
+        self.manifest[source_path] = entry
+        return entry['local']
+
+    def _valid(self, entry, source_stat):
+        if entry['size'] != source_stat.st_size or entry['mtime'] != source_stat.st_mtime:
+            return False
+        try:
+            local_stat = os.stat(entry['local'])
+        except OSError:
+            return False
+        if local_stat.st_size != entry['size']:
+            return False
+        # only re-hash the local copy if something has touched it since it was mirrored
+        if local_stat.st_mtime != entry['local_mtime']:
+            if file_checksum(entry['local']) != entry['sha1']:
+                return False
+            entry['local_mtime'] = local_stat.st_mtime
+        return True
+
+    def _mirror(self, source_path, source_stat):
+        path_hash = hashlib.sha1(source_path.encode('utf-8')).hexdigest()[:16]
+        local_path = os.path.join(self.cache_folder, f'{path_hash}_{os.path.basename(source_path)}')
+        temp_path = local_path + '.tmp'
+        checksum = hashlib.sha1()
+        with open(source_path, 'rb') as infile, open(temp_path, 'wb') as outfile:
+            for block in iter(lambda: infile.read(1 << 20), b''):
+                checksum.update(block)
+                outfile.write(block)
+        os.replace(temp_path, local_path)
+        return {
+            'local': local_path,
+            'size': source_stat.st_size,
+            'mtime': source_stat.st_mtime,
+            'sha1': checksum.hexdigest(),
+            'local_mtime': os.stat(local_path).st_mtime,
+        }
+
+    def evict(self, keep=(), feedback=None):
+        """
+        Removes least recently used grids until the cache fits within max_bytes. Grids in keep are never evicted.
+        """
+        total = sum(entry['size'] for entry in self.manifest.values())
+        for source_path, entry in sorted(self.manifest.items(), key=lambda item: item[1].get('last_used', 0)):
+            if total <= self.max_bytes:
+                break
+            if source_path in keep:
+                continue
             try:
-                zone = input_layer.crs().toProj().split()[1].split("=")[1]
-            except:
-                zone = 0
-            header = header_template.format(grid_set, date, feature_id, easting, northing, zone, near_lat, near_lon)  
+                os.remove(entry['local'])
+            except OSError:
+                pass
+            del self.manifest[source_path]
+            total -= entry['size']
+        if total > self.max_bytes and feedback is not None:
+            feedback.pushInfo(f"Grids used by this run ({total / 1e9:.2f} GB) exceed the local cache size.")
 
-        feature_results_dict = results_dict[feature_id]
-        aeps = feature_results_dict.keys()
-        durations = feature_results_dict[list(aeps)[0]].keys()
+    def save(self):
+        manifest_path = os.path.join(self.cache_folder, self.MANIFEST)
+        with open(manifest_path + '.tmp', 'w') as outfile:
+            json.dump(self.manifest, outfile)
+        os.replace(manifest_path + '.tmp', manifest_path)
 
-        csv_file = os.path.join(output_folder, f'ifd_{grid_set}_{climate_scenario.split(":")[0]}_{feature_id}.csv')
-        df = pd.DataFrame.from_dict(feature_results_dict)
-        df['Duration'] = df.index.map(durations_naming)
-        df.rename(columns=aeps_naming, inplace=True)
-
-        df.index = df.index.str.lstrip('0')
-        df.index.name = 'Duration in min'
-        df.reset_index(inplace=True)
-        df.set_index('Duration', drop=True, inplace=True)
-
-        if depth_or_intensity == 'Intensity':
-            df[[c for c in df.columns if 'Duration'not in c]] = df[[c for c in df.columns if 'Duration'not in c]].divide([float(numerical_durations[d])/60.0 for d in durations], axis=0)
-
-        with open(csv_file, 'w') as outfile:
-            outfile.write(header)
-        if depth_or_intensity == 'Intensity':
-            df.to_csv(csv_file, mode='a', float_format="%.3f")
+
+def file_checksum(path):
+    checksum = hashlib.sha1()
+    with open(path, 'rb') as infile:
+        for block in iter(lambda: infile.read(1 << 20), b''):
+            checksum.update(block)
+    return checksum.hexdigest()
+
+
+def geometry_to_ogr(geometry):
+    return ogr.CreateGeometryFromWkb(bytes(geometry.asWkb()))
+
+
+class PointSampler:
+    """
+    Samples the grid cell containing each point (same as native:rastersampling).
+    """
+    def __init__(self, geotransform, shape, xs, ys):
+        inv_geotransform = gdal.InvGeoTransform(geotransform)
+        xs = np.asarray(xs, dtype='float64')
+        ys = np.asarray(ys, dtype='float64')
+        cols = np.floor(inv_geotransform[0] + inv_geotransform[1] * xs + inv_geotransform[2] * ys).astype('int64')
+        rows = np.floor(inv_geotransform[3] + inv_geotransform[4] * xs + inv_geotransform[5] * ys).astype('int64')
+        self.inside = (rows >= 0) & (rows < shape[0]) & (cols >= 0) & (cols < shape[1])
+        self.rows = rows[self.inside]
+        self.cols = cols[self.inside]
+        self.count = len(xs)
+
+    def sample(self, array):
+        values = np.full(self.count, np.nan)
+        values[self.inside] = array[self.rows, self.cols]
+        return values
+
+
+class CellWeightMatrix:
+    """
+    Sparse features x cells matrix of the fraction of each grid cell covered by each polygon, stored as
+    (feature, cell, weight) triplets. Built once per pixel geometry, after which the area-weighted mean
+    for each grid is a single sparse mat-vec.
+
+    Cells wholly inside a polygon get a weight of 1. Cells crossed by the polygon boundary are weighted
+    by their exact intersection area, so subcatchments only a few cells across are still weighted correctly.
+    """
+    def __init__(self, geotransform, shape, geometries):
+        cell_area = abs(geotransform[1] * geotransform[5] - geotransform[2] * geotransform[4])
+        feature_index, cell_index, weights = [], [], []
+        for i, geometry in enumerate(geometries):
+            if not geometry.IsValid():
+                geometry = geometry.MakeValid()
+            col_0, row_0, width, height = pixel_window(geotransform, shape, geometry.GetEnvelope())
+            if not width or not height:
+                continue
+
+            window = (geotransform, col_0, row_0, width, height)
+            touched = rasterize_geometry(geometry, *window, all_touched=True)
+            boundary = rasterize_geometry(geometry.Boundary(), *window, all_touched=True) & touched
+
+            # cells touched by the polygon but not its boundary are fully covered
+            rows, cols = np.nonzero(touched & ~boundary)
+            cell_weights = [np.ones(len(rows))]
+            cell_rows, cell_cols = [rows], [cols]
+
+            rows, cols = np.nonzero(boundary)
+            fractions = np.array([
+                geometry.Intersection(cell_polygon(geotransform, row + row_0, col + col_0)).GetArea() / cell_area
+                for row, col in zip(rows, cols)
+            ])
+            keep = fractions > 0
+            cell_weights.append(fractions[keep])
+            cell_rows.append(rows[keep])
+            cell_cols.append(cols[keep])
+
+            rows, cols = np.concatenate(cell_rows), np.concatenate(cell_cols)
+            feature_index.append(np.full(len(rows), i, dtype='int64'))
+            cell_index.append((rows + row_0) * shape[1] + (cols + col_0))
+            weights.append(np.concatenate(cell_weights))
+
+        self.count = len(geometries)
+        self.feature_index = np.concatenate(feature_index) if feature_index else np.empty(0, dtype='int64')
+        self.cell_index = np.concatenate(cell_index) if cell_index else np.empty(0, dtype='int64')
+        self.weights = np.concatenate(weights) if weights else np.empty(0)
+
+    def sample(self, array):
+        values = array.ravel()[self.cell_index]
+        valid = ~np.isnan(values)
+        totals = np.bincount(self.feature_index[valid], weights=self.weights[valid] * values[valid], minlength=self.count)
+        covered = np.bincount(self.feature_index[valid], weights=self.weights[valid], minlength=self.count)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(covered > 0, totals / covered, np.nan)
+
+
+def cell_polygon(geotransform, row, col):
+    ring = ogr.Geometry(ogr.wkbLinearRing)
+    for r, c in ((row, col), (row, col + 1), (row + 1, col + 1), (row + 1, col), (row, col)):
+        ring.AddPoint_2D(*gdal.ApplyGeoTransform(geotransform, c, r))
+    polygon = ogr.Geometry(ogr.wkbPolygon)
+    polygon.AddGeometry(ring)
+    return polygon
+
+
+def rasterize_geometry(geometry, geotransform, col_0, row_0, width, height, all_touched=False):
+    """
+    Burns a single geometry into an in-memory raster covering the given pixel window. Returns a boolean mask.
+    """
+    target = gdal.GetDriverByName('MEM').Create('', width, height, 1, gdal.GDT_Byte)
+    target.SetGeoTransform(offset_geotransform(geotransform, col_0, row_0))
+    source = ogr.GetDriverByName('Memory').CreateDataSource('')
+    layer = source.CreateLayer('geometry')
+    feature = ogr.Feature(layer.GetLayerDefn())
+    feature.SetGeometry(geometry)
+    layer.CreateFeature(feature)
+    gdal.RasterizeLayer(target, [1], layer, burn_values=[1], options=['ALL_TOUCHED=TRUE'] if all_touched else [])
+    return target.GetRasterBand(1).ReadAsArray().astype(bool)
+
+
+class FeatureLocations:
+    """
+    Locations of the input features in the grid CRS, built in memory so the input geometries are never
+    rewritten. Point layers are held as coordinate arrays and polygon layers as OGR geometries.
+    """
+    def __init__(self, geometry_type, xs=None, ys=None, geometries=None):
+        if geometry_type not in (0, 2):
+            raise QgsProcessingException("Input layer must be a point or polygon layer.")
+        self.geometry_type = geometry_type
+        self.xs = xs
+        self.ys = ys
+        self.geometries = geometries
+        self.count = len(xs) if geometry_type == 0 else len(geometries)
+
+    @classmethod
+    def from_features(cls, features, geometry_type, source_crs, target_crs, transform_context=None):
+        """
+        Points and polygons are both transformed with transform_context (defaults to the project's), so
+        they use the same datum transformations as the rest of QGIS.
+        """
+        transform_context = transform_context or QgsProject.instance().transformContext()
+        if geometry_type == 0: # point
+            # first vertex, so multipoints are sampled at their first point like native:rastersampling
+            coordinates = np.array([[p.x(), p.y()] for p in (f.geometry().vertexAt(0) for f in features)], dtype='float64').reshape(-1, 2)
+            if source_crs != target_crs:
+                coordinates = transform_coordinates(coordinates, source_crs, target_crs, transform_context)
+            return cls(geometry_type, xs=coordinates[:, 0], ys=coordinates[:, 1])
+
+        # polygons are only transformed into the grid CRS to build the cell weights
+        transform = None
+        if source_crs != target_crs:
+            transform = QgsCoordinateTransform(source_crs, target_crs, transform_context)
+        geometries = []
+        for feature in features:
+            geometry = QgsGeometry(feature.geometry())
+            if transform is not None:
+                geometry.transform(transform)
+            geometries.append(geometry_to_ogr(geometry))
+        return cls(geometry_type, geometries=geometries)
+
+    def points(self):
+        """
+        Returns the point coordinates, or polygon centroids, as (xs, ys) arrays.
+        """
+        if self.geometry_type == 0:
+            return self.xs, self.ys
+        centroids = np.array([g.Centroid().GetPoint_2D() for g in self.geometries], dtype='float64').reshape(-1, 2)
+        return centroids[:, 0], centroids[:, 1]
+
+    def envelope(self):
+        if self.geometry_type == 0:
+            return self.xs.min(), self.xs.max(), self.ys.min(), self.ys.max()
+        return layer_envelope(self.geometries)
+
+    def sampler(self, geotransform, shape):
+        if self.geometry_type == 0:
+            return PointSampler(geotransform, shape, self.xs, self.ys)
+        return CellWeightMatrix(geotransform, shape, self.geometries)
+
+
+def nearest_cell_centres(geotransform, shape, xs, ys):
+    """
+    Returns the centres of the grid cells containing each (x, y) as an (n, 2) array, NaN outside the grid.
+    """
+    inv_geotransform = gdal.InvGeoTransform(geotransform)
+    cols = np.floor(inv_geotransform[0] + inv_geotransform[1] * xs + inv_geotransform[2] * ys)
+    rows = np.floor(inv_geotransform[3] + inv_geotransform[4] * xs + inv_geotransform[5] * ys)
+    centres = np.column_stack([
+        geotransform[0] + (cols + 0.5) * geotransform[1] + (rows + 0.5) * geotransform[2],
+        geotransform[3] + (cols + 0.5) * geotransform[4] + (rows + 0.5) * geotransform[5],
+    ])
+    centres[(rows < 0) | (rows >= shape[0]) | (cols < 0) | (cols >= shape[1])] = np.nan
+    return centres
+
+
+def transform_coordinates(coordinates, source_crs, target_crs, transform_context=None):
+    """
+    Transforms an (n, 2) array of coordinates between QGIS CRSs with the given transform context (defaults
+    to the project's), the same way polygon geometries are transformed. The points are transformed in one
+    call as the vertices of a line string.
+    """
+    if not len(coordinates):
+        return np.empty((0, 2), dtype='float64')
+    transform = QgsCoordinateTransform(source_crs, target_crs, transform_context or QgsProject.instance().transformContext())
+    line = QgsLineString(coordinates[:, 0].tolist(), coordinates[:, 1].tolist())
+    line.transform(transform)
+    # a 2D WKB line string is a 9 byte header (byte order, type, point count) followed by the x, y pairs
+    wkb = bytes(line.asWkb())
+    return np.frombuffer(wkb, dtype='<f8' if wkb[0] == 1 else '>f8', offset=9).reshape(-1, 2).astype('float64')
+
+
+def offset_geotransform(geotransform, col_0, row_0):
+    """
+    Returns the geotransform of a window whose top left cell is (row_0, col_0) in the parent grid.
+    """
+    return (
+        geotransform[0] + col_0 * geotransform[1] + row_0 * geotransform[2],
+        geotransform[1],
+        geotransform[2],
+        geotransform[3] + col_0 * geotransform[4] + row_0 * geotransform[5],
+        geotransform[4],
+        geotransform[5],
+    )
+
+
+def pixel_window(geotransform, shape, envelope, halo=0):
+    """
+    Returns the (col_0, row_0, width, height) window of cells covering an (min_x, max_x, min_y, max_y)
+    envelope, grown by halo cells and clipped to the grid.
+    """
+    inv_geotransform = gdal.InvGeoTransform(geotransform)
+    min_x, max_x, min_y, max_y = envelope
+    corners = [gdal.ApplyGeoTransform(inv_geotransform, x, y) for x in (min_x, max_x) for y in (min_y, max_y)]
+    col_0 = max(int(np.floor(min(c[0] for c in corners))) - halo, 0)
+    col_1 = min(int(np.ceil(max(c[0] for c in corners))) + halo, shape[1])
+    row_0 = max(int(np.floor(min(c[1] for c in corners))) - halo, 0)
+    row_1 = min(int(np.ceil(max(c[1] for c in corners))) + halo, shape[0])
+    return col_0, row_0, max(col_1 - col_0, 0), max(row_1 - row_0, 0)
+
+
+def layer_envelope(geometries):
+    envelopes = np.array([g.GetEnvelope() for g in geometries])
+    return envelopes[:, 0].min(), envelopes[:, 1].max(), envelopes[:, 2].min(), envelopes[:, 3].max()
+
+
+def read_grid(dataset, window=None):
+    """
+    Reads band 1 of a grid, or the (col_0, row_0, width, height) window of it, as float64 with nodata
+    cells set to NaN.
+    """
+    band = dataset.GetRasterBand(1)
+    array = band.ReadAsArray(*window) if window else band.ReadAsArray()
+    array = array.astype('float64')
+    nodata = band.GetNoDataValue()
+    if nodata is not None:
+        array[array == nodata] = np.nan
+    return array
+
+
+def extract_ifd_cube(grid_paths, aeps, durations, locations, feedback, datasets=None):
+    """
+    Opens each grid once and extracts the values for every feature in a single pass. Only the window
+    of each grid covering the features (plus a one cell halo) is read. Opened grids are kept in datasets,
+    if given, for reuse by later calls.
+    Returns an array of shape (features, aeps, durations), NaN where a grid or value is missing.
+    """
+    cube = np.full((locations.count, len(aeps), len(durations)), np.nan)
+    envelope = locations.envelope()
+    samplers = {}
+    total = len(grid_paths)
+    for n, ((aep, duration), grid_path) in enumerate(grid_paths.items()):
+        dataset = datasets.get(grid_path) if datasets is not None else None
+        if dataset is None:
+            dataset = gdal.Open(grid_path)
+            if dataset is None:
+                raise QgsProcessingException(f"Could not open grid {grid_path}")
+            if datasets is not None:
+                datasets[grid_path] = dataset
+        geotransform = dataset.GetGeoTransform()
+        shape = (dataset.RasterYSize, dataset.RasterXSize)
+
+        # grids normally share pixel geometry, so the window and sampler are only built once
+        key = (geotransform, shape)
+        if key not in samplers:
+            window = pixel_window(geotransform, shape, envelope, halo=1)
+            window_geotransform = offset_geotransform(geotransform, window[0], window[1])
+            samplers[key] = (window, locations.sampler(window_geotransform, (window[3], window[2])))
+
+        window, sampler = samplers[key]
+        if window[2] and window[3]:
+            cube[:, aeps.index(aep), durations.index(duration)] = sampler.sample(read_grid(dataset, window))
+        dataset = None
+
+        feedback.setProgress(100.0 * (n + 1) / total)
+        if feedback.isCanceled():
+            break
+
+    return cube
+
+class IFDCube:
+    """
+    Reader for a chunked, compressed IFD cube, which packs every AEP x duration grid of a grid set into a
+    single file with axes (aep, duration, y, x). The file is a zip archive holding meta.json and one deflated
+    .npy member per spatial chunk, so each chunk carries the whole AEP x duration table for its cells and a
+    point's full table is a single chunk read. Build cubes with build_ifd_cube().
+
+    Decoded chunks are kept in a least recently used cache of up to max_cache_bytes.
+    """
+    EXTENSION = '.ifdcube'
+
+    def __init__(self, path, max_cache_bytes=256e6):
+        self.path = path
+        self.archive = zipfile.ZipFile(path)
+        self.meta = json.loads(self.archive.read('meta.json'))
+        self.aeps = self.meta['aeps']
+        self.durations = self.meta['durations']
+        self.geotransform = tuple(self.meta['geotransform'])
+        self.shape = tuple(self.meta['shape'])
+        self.crs = self.meta['crs']
+        self.chunk_size = self.meta['chunk_size']
+        self.members = set(self.archive.namelist())
+        self.max_cache_bytes = max_cache_bytes
+        self._chunks = collections.OrderedDict()
+        self._cache_bytes = 0
+
+    @staticmethod
+    def read_meta(path):
+        with zipfile.ZipFile(path) as archive:
+            return json.loads(archive.read('meta.json'))
+
+    def keys(self):
+        return {(aep, duration) for aep in self.aeps for duration in self.durations}
+
+    def chunk(self, chunk_row, chunk_col):
+        """
+        Returns the float64 (aep, duration, y, x) array for a chunk, or None if the chunk holds no data.
+        """
+        key = (chunk_row, chunk_col)
+        if key in self._chunks:
+            self._chunks.move_to_end(key)
+            return self._chunks[key]
+        name = f'{chunk_row}_{chunk_col}.npy'
+        if name not in self.members:
+            values = None
         else:
-            df.to_csv(csv_file, mode='a', float_format="%.1f")
+            data = np.load(io.BytesIO(self.archive.read(name)))
+            if self.meta['scale']:
+                values = data.astype('float64') * self.meta['scale']
+                values[data == self.meta['nodata']] = np.nan
+            else:
+                values = data.astype('float64')
+        self._chunks[key] = values
+        self._cache_bytes += values.nbytes if values is not None else 0
+        while self._cache_bytes > self.max_cache_bytes and len(self._chunks) > 1:
+            _, evicted = self._chunks.popitem(last=False)
+            self._cache_bytes -= evicted.nbytes if evicted is not None else 0
+        return values
+
+    def read_window(self, window):
+        """
+        Returns the (aep, duration, height, width) array for a (col_0, row_0, width, height) pixel window.
+        """
+        col_0, row_0, width, height = window
+        stack = np.full((len(self.aeps), len(self.durations), height, width), np.nan)
+        size = self.chunk_size
+        for chunk_row in range(row_0 // size, (row_0 + height - 1) // size + 1):
+            for chunk_col in range(col_0 // size, (col_0 + width - 1) // size + 1):
+                values = self.chunk(chunk_row, chunk_col)
+                if values is None:
+                    continue
+                # overlap of the chunk and the window in grid coordinates
+                r_0, r_1 = max(row_0, chunk_row * size), min(row_0 + height, chunk_row * size + values.shape[2])
+                c_0, c_1 = max(col_0, chunk_col * size), min(col_0 + width, chunk_col * size + values.shape[3])
+                stack[:, :, r_0 - row_0:r_1 - row_0, c_0 - col_0:c_1 - col_0] = \
+                    values[:, :, r_0 - chunk_row * size:r_1 - chunk_row * size, c_0 - chunk_col * size:c_1 - chunk_col * size]
+        return stack
+
+    def sample_points(self, xs, ys):
+        """
+        Returns the (points, aep, duration) values of the cells containing each point, reading each chunk once.
+        """
+        sampler = PointSampler(self.geotransform, self.shape, xs, ys)
+        values = np.full((sampler.count, len(self.aeps), len(self.durations)), np.nan)
+        point_index = np.flatnonzero(sampler.inside)
+        chunk_rows, chunk_cols = sampler.rows // self.chunk_size, sampler.cols // self.chunk_size
+        for chunk_row, chunk_col in set(zip(chunk_rows.tolist(), chunk_cols.tolist())):
+            chunk = self.chunk(chunk_row, chunk_col)
+            if chunk is None:
+                continue
+            in_chunk = (chunk_rows == chunk_row) & (chunk_cols == chunk_col)
+            rows = sampler.rows[in_chunk] - chunk_row * self.chunk_size
+            cols = sampler.cols[in_chunk] - chunk_col * self.chunk_size
+            values[point_index[in_chunk]] = np.moveaxis(chunk[:, :, rows, cols], -1, 0)
+        return values
+
+    def sample_weights(self, weights, window, pairs):
+        """
+        Returns the (features, pairs) area-weighted means of the (aep index, duration index) pairs for a
+        CellWeightMatrix built on a (col_0, row_0, width, height) window. Chunks are read one at a time and
+        only the requested pairs of the cells with weights are taken from each, so memory doesn't grow
+        with the window or the number of grids in the cube.
+        """
+        col_0, row_0, width, _ = window
+        rows = weights.cell_index // width + row_0
+        cols = weights.cell_index % width + col_0
+        aep_index = np.array([i for i, _ in pairs], dtype='int64')
+        duration_index = np.array([j for _, j in pairs], dtype='int64')
+        totals = np.zeros((weights.count, len(pairs)))
+        covered = np.zeros((weights.count, len(pairs)))
+        chunk_rows, chunk_cols = rows // self.chunk_size, cols // self.chunk_size
+        for chunk_row, chunk_col in set(zip(chunk_rows.tolist(), chunk_cols.tolist())):
+            chunk = self.chunk(chunk_row, chunk_col)
+            if chunk is None:
+                continue
+            in_chunk = (chunk_rows == chunk_row) & (chunk_cols == chunk_col)
+            chunk_rows_in, chunk_cols_in = rows[in_chunk] - chunk_row * self.chunk_size, cols[in_chunk] - chunk_col * self.chunk_size
+            values = chunk[aep_index[:, np.newaxis], duration_index[:, np.newaxis], chunk_rows_in, chunk_cols_in]
+            features, cell_weights = weights.feature_index[in_chunk], weights.weights[in_chunk]
+            for p, pair_values in enumerate(values):
+                valid = ~np.isnan(pair_values)
+                totals[:, p] += np.bincount(features[valid], weights=cell_weights[valid] * pair_values[valid], minlength=weights.count)
+                covered[:, p] += np.bincount(features[valid], weights=cell_weights[valid], minlength=weights.count)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(covered > 0, totals / covered, np.nan)
+
+    def close(self):
+        self.archive.close()
+
+
+def build_ifd_cube(grid_folder, output_path, chunk_size=64, quantize=False, scale=0.1, feedback=None):
+    """
+    Packs every AEP x duration grid in grid_folder into a single chunked, compressed IFD cube file.
+    With quantize, values are stored as int16 multiples of scale (default 0.1 mm) to cut the size by 4x.
+
+    The cube is built in a temporary file and only moved to output_path once complete, so a cancelled or
+    failed build never leaves a partial cube behind. Returns None if cancelled.
+    """
+    grid_index = GridIndex.load(grid_folder, feedback=feedback)
+    if not grid_index.entries:
+        raise QgsProcessingException(f"No IFD grids found in {grid_folder}")
+    aeps = [aep for aep in AEPS['QRA SEQ'] if any((aep, d) in grid_index.entries for d in DURATIONS['QRA SEQ'])]
+    durations = [d for d in DURATIONS['QRA SEQ'] if any((aep, d) in grid_index.entries for aep in AEPS['QRA SEQ'])]
+    first = next(iter(grid_index.entries.values()))
+    for (aep, duration), entry in grid_index.entries.items():
+        if entry['shape'] != first['shape'] or entry['geotransform'] != first['geotransform']:
+            raise QgsProcessingException(f"Grid for {aep} {duration} doesn't share the pixel geometry of the other grids")
+
+    nodata = -32768
+    datasets = {key: gdal.Open(entry['path']) for key, entry in grid_index.entries.items()}
+    temp_path = output_path + '.tmp'
+    try:
+        completed = _write_ifd_cube(temp_path, grid_index, datasets, aeps, durations, first, chunk_size, quantize, scale, nodata, feedback)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    if not completed:
+        os.remove(temp_path)
+        return None
+    os.replace(temp_path, output_path)
+    return output_path
+
+
+def _write_ifd_cube(path, grid_index, datasets, aeps, durations, first, chunk_size, quantize, scale, nodata, feedback):
+    height, width = first['shape']
+    with zipfile.ZipFile(path, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr('meta.json', json.dumps({
+            'aeps': aeps,
+            'durations': durations,
+            'geotransform': first['geotransform'],
+            'shape': first['shape'],
+            'crs': grid_index.crs(),
+            'chunk_size': chunk_size,
+            'scale': scale if quantize else None,
+            'nodata': nodata if quantize else None,
+            'grid_fingerprint': grid_index.fingerprint(),
+        }))
+
+        # read one strip of chunks from every grid at a time
+        n_strips = (height + chunk_size - 1) // chunk_size
+        for chunk_row in range(n_strips):
+            strip_height = min(chunk_size, height - chunk_row * chunk_size)
+            strip = np.full((len(aeps), len(durations), strip_height, width), np.nan, dtype='float32')
+            for (aep, duration), dataset in datasets.items():
+                strip[aeps.index(aep), durations.index(duration)] = read_grid(dataset, (0, chunk_row * chunk_size, width, strip_height))
+
+            for chunk_col in range((width + chunk_size - 1) // chunk_size):
+                chunk = strip[:, :, :, chunk_col * chunk_size:(chunk_col + 1) * chunk_size]
+                if np.isnan(chunk).all():
+                    continue
+                if quantize:
+                    steps = np.round(chunk / scale)
+                    if np.nanmax(np.abs(steps)) > 32767:
+                        raise QgsProcessingException(f"IFD values up to {np.nanmax(np.abs(chunk)):.1f} mm don't fit int16 at a scale of {scale} mm, use a larger scale")
+                    chunk = np.where(np.isnan(chunk), nodata, steps).astype('int16')
+                buffer = io.BytesIO()
+                np.save(buffer, np.ascontiguousarray(chunk))
+                archive.writestr(f'{chunk_row}_{chunk_col}.npy', buffer.getvalue())
+
+            if feedback is not None:
+                feedback.setProgress(100.0 * (chunk_row + 1) / n_strips)
+                if feedback.isCanceled():
+                    return False
+
+    return True
+
+
+def extract_ifd_cube_from_cube(ifd_cube, aeps, durations, locations, feedback):
+    """
+    Same as extract_ifd_cube() but reads the values from an IFDCube.
+    """
+    cube = np.full((locations.count, len(aeps), len(durations)), np.nan)
+    pairs = [
+        (a, d, ifd_cube.aeps.index(aep), ifd_cube.durations.index(duration))
+        for a, aep in enumerate(aeps) for d, duration in enumerate(durations)
+        if aep in ifd_cube.aeps and duration in ifd_cube.durations
+    ]
+    if locations.geometry_type == 0: # point
+        values = ifd_cube.sample_points(locations.xs, locations.ys)
+        for a, d, i, j in pairs:
+            cube[:, a, d] = values[:, i, j]
+    else: # polygon
+        window = pixel_window(ifd_cube.geotransform, ifd_cube.shape, locations.envelope(), halo=1)
+        if not window[2] or not window[3]:
+            return cube
+        weights = locations.sampler(offset_geotransform(ifd_cube.geotransform, window[0], window[1]), (window[3], window[2]))
+        values = ifd_cube.sample_weights(weights, window, [(i, j) for _, _, i, j in pairs])
+        for p, (a, d, _, _) in enumerate(pairs):
+            cube[:, a, d] = values[:, p]
+    return cube
+
+class IFDGridSource:
+    """
+    The IFD grids of one grid set. Values are read from a packed IFD cube if the base grid folder has one
+    for the grid set and it was built from the current grids, otherwise from the individual grids through
+    the grid index.
+
+    Grids can be resolved through a local GridMirror, or through local_paths (a {source path: local path}
+    mapping already mirrored by another process). With keep_open, opened grids are kept for reuse by
+    later extractions in the same process.
+    """
+    def __init__(self, base_grid_folder, grid_set_short, mirror=None, local_paths=None, keep_open=False, feedback=None):
+        self.grid_folder = os.path.join(base_grid_folder, GRID_SETS[grid_set_short])
+        self.mirror = mirror
+        self.local_paths = local_paths
+        self.datasets = {} if keep_open else None
+
+        cube_path = os.path.join(base_grid_folder, grid_set_short + IFDCube.EXTENSION)
+        self.index = None
+        if os.path.isfile(cube_path) and os.path.isdir(self.grid_folder):
+            # only use the cube if it was built from the grids as they are now
+            self.index = GridIndex.load(self.grid_folder, feedback=feedback)
+            if IFDCube.read_meta(cube_path).get('grid_fingerprint') != self.index.fingerprint():
+                if feedback is not None:
+                    feedback.reportError(f"IFD cube {cube_path} is out of date with the grids in {self.grid_folder}, reading the grids instead. Rebuild it with build-cube.")
+                cube_path = None
+        if cube_path is not None and os.path.isfile(cube_path):
+            if feedback is not None:
+                feedback.pushInfo(f"Reading IFD cube {cube_path}...")
+            self.cube_source_path = cube_path
+            self.cube = IFDCube(self._resolve([cube_path], feedback)[cube_path])
+            self.index = None
+            self.available = self.cube.keys()
+            self.crs_wkt = self.cube.crs
+            self.geotransform, self.shape = self.cube.geotransform, self.cube.shape
+        else:
+            self.cube_source_path = None
+            self.cube = None
+            self.index = self.index or GridIndex.load(self.grid_folder, feedback=feedback)
+            if not self.index.entries:
+                raise QgsProcessingException(f"No IFD grids found in {self.grid_folder}")
+            self.available = set(self.index.entries)
+            self.crs_wkt = self.index.crs()
+            first = next(iter(self.index.entries.values()))
+            self.geotransform, self.shape = tuple(first['geotransform']), tuple(first['shape'])
+
+    def memory_map(self, stack_folder=None, feedback=None):
+        """
+        Materialises the grid set as a memory-mapped stack (see MemoryMappedGrids) and extracts from it
+        from now on.
+        """
+        grids = MemoryMappedGrids(self, stack_folder, feedback)
+        if self.cube is not None:
+            self.cube.close()
+        self.cube = grids
+        self.datasets = {} if self.datasets is not None else None
+
+    def _resolve(self, source_paths, feedback=None):
+        """
+        Returns {source path: path to read} for the given grid paths.
+        """
+        if self.local_paths is not None:
+            return {path: self.local_paths.get(path, path) for path in source_paths}
+        if self.mirror is not None:
+            resolved = {path: self.mirror.resolve(path) for path in source_paths}
+            self.mirror.evict(keep=set(source_paths), feedback=feedback)
+            self.mirror.save()
+            return resolved
+        return {path: path for path in source_paths}
+
+    def mirror_paths(self, aeps, durations, feedback=None):
+        """
+        Mirrors the grids needed for the given AEPs and durations. Returns {source path: local path}.
+        """
+        if self.cube is not None:
+            return {self.cube_source_path: self.cube.path}
+        return self._resolve(list(self.index.grid_paths(aeps, durations).values()), feedback)
+
+    def extract(self, aeps, durations, locations, feedback):
+        if self.cube is not None:
+            return extract_ifd_cube_from_cube(self.cube, aeps, durations, locations, feedback)
+        grid_paths = self.index.grid_paths(aeps, durations)
+        resolved = self._resolve(list(grid_paths.values()), feedback)
+        grid_paths = {key: resolved[path] for key, path in grid_paths.items()}
+        feedback.pushInfo(f"Extracting {len(grid_paths)} grids...")
+        return extract_ifd_cube(grid_paths, aeps, durations, locations, feedback, datasets=self.datasets)
+
+    def nearest_cells(self, locations, grid_crs):
+        """
+        Returns the (latitude, longitude) of the grid cell centre nearest each feature (or its centroid) as an
+        (n, 2) array, computed in one step from the grid geotransform.
+        """
+        xs, ys = locations.points()
+        centres = nearest_cell_centres(self.geotransform, self.shape, xs, ys)
+        if not grid_crs.isGeographic():
+            inside = ~np.isnan(centres[:, 0])
+            centres[inside] = transform_coordinates(centres[inside], grid_crs, QgsCoordinateReferenceSystem('EPSG:4283'))
+        return centres[:, ::-1]
+
+    def close(self):
+        if self.cube is not None:
+            self.cube.close()
+        self.datasets = {} if self.datasets is not None else None
+
+
+def interpolate_extras(cube, extract_aeps, extract_durations, aeps, durations, available, feedback):
+    """
+    Interpolates the extracted cube onto the reported AEPs and durations if any are non-standard.
+    Returns the cube and the (aep, duration) pairs that have values.
+    """
+    if extract_aeps == aeps and extract_durations == durations:
+        return cube, available
+    extras = [a for a in aeps if a not in AEP_PERCENTS] + [d for d in durations if d not in DURATION_MINUTES]
+    feedback.pushInfo(f"Interpolating {', '.join(extras)} (log-log) from the extracted grids...")
+    cube = interpolate_ifd_cube(cube, extract_aeps, extract_durations, aeps, durations)
+    available = {
+        (aep, duration) for aep in aeps for duration in durations
+        if (aep, duration) in available or aep not in AEP_PERCENTS or duration not in DURATION_MINUTES
+    }
+    return cube, available
+
+
+def apply_climate_scenarios(cube, aeps, durations, climate_scenarios, feedback):
+    """
+    Derives each climate scenario from the base (feature, aep, duration) cube by applying its factors
+    to the whole cube at once. Returns {scenario: cube}.
+    """
+    scenario_cubes = {}
+    for climate_scenario in climate_scenarios:
+        factors = climate_factors(durations, CLIMATE_SCENARIOS[climate_scenario])
+        scenario_cubes[climate_scenario] = cube * factors[np.newaxis, np.newaxis, :]
+        feedback.pushInfo(f"{climate_scenario}:")
+        summarise_ifd_cube(cube, scenario_cubes[climate_scenario], aeps, durations, factors, feedback)
+    return scenario_cubes
+
+
+class IFDResultLayout:
+    """
+    Fields of the GIS IFD results. With a single climate scenario there's one field per AEP and duration.
+    With several, fields are either suffixed with the scenario index or written in long format, with one
+    feature per input feature and scenario.
+    """
+    def __init__(self, input_fields, aeps, durations, available, geometry_type, climate_scenarios, scenario_layout, feedback):
+        suffix = '1' if geometry_type == 0 else 'mean'
+        self.ifd_fields = [(a, d) for a, aep in enumerate(aeps) for d, duration in enumerate(durations) if (aep, duration) in available]
+        self.long_format = scenario_layout == 'Long format'
+        self.fields = QgsFields(input_fields)
+        if len(climate_scenarios) == 1 or self.long_format:
+            scenario_suffixes = {climate_scenario: '' for climate_scenario in climate_scenarios}
+        else:
+            scenario_suffixes = {climate_scenario: f'_s{list(CLIMATE_SCENARIOS).index(climate_scenario)}' for climate_scenario in climate_scenarios}
+            for climate_scenario, scenario_suffix in scenario_suffixes.items():
+                feedback.pushInfo(f"Fields suffixed {scenario_suffix} hold {climate_scenario}")
+        if self.long_format:
+            self.fields.append(QgsField('climate', QVariant.String))
+            self.fields.append(QgsField('warming', QVariant.Double))
+            self.scenario_groups = [[climate_scenario] for climate_scenario in climate_scenarios]
+        else:
+            self.scenario_groups = [climate_scenarios]
+        for climate_scenario in self.scenario_groups[0]:
+            for a, d in self.ifd_fields:
+                self.fields.append(QgsField(f'{aeps[a]}_{durations[d]}_{suffix}{scenario_suffixes[climate_scenario]}', QVariant.Double))
+
+    def features(self, features, scenario_cubes):
+        for scenario_group in self.scenario_groups:
+            for i, feature in enumerate(features):
+                attributes = feature.attributes()
+                if self.long_format:
+                    attributes += [scenario_group[0], CLIMATE_SCENARIOS[scenario_group[0]]]
+                for climate_scenario in scenario_group:
+                    values = scenario_cubes[climate_scenario][i]
+                    attributes += [None if np.isnan(values[a, d]) else float(values[a, d]) for a, d in self.ifd_fields]
+                out_feature = QgsFeature(self.fields)
+                out_feature.setGeometry(feature.geometry())
+                out_feature.setAttributes(attributes)
+                yield out_feature
+
+
+OUTPUT_FORMATS = [
+    'BoM CSV',
+    'URBS',
+    'Long format CSV (all features)',
+    'Long format Parquet (all features)',
+]
+
+
+class TableWriter:
+    """
+    Writes small text files through a bounded thread pool so formatting and file I/O overlap. At most
+    max_pending files are queued at once to bound memory use.
+    """
+    def __init__(self, max_workers=None, max_pending=256):
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers or min(8, (os.cpu_count() or 1) + 4))
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.futures = []
+
+    def write(self, path, text):
+        self.slots.acquire()
+        future = self.executor.submit(self._write, path, text)
+        future.add_done_callback(lambda f: self.slots.release())
+        self.futures.append(future)
+
+    @staticmethod
+    def _write(path, text):
+        with open(path, 'w', newline='') as outfile:
+            outfile.write(text)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        for future in self.futures:
+            future.result()
+        self.futures = []
+
+
+def table_values(cube, durations, depth_or_intensity):
+    """
+    Returns the (feature, aep, duration) cube as depths, or as intensities in mm/hr.
+    """
+    if depth_or_intensity == 'Intensity':
+        hours = np.array([duration_minutes(duration) for duration in durations], dtype='float64') / 60.0
+        return cube / hours[np.newaxis, np.newaxis, :]
+    return cube
+
+
+def format_rows(row_labels, values, float_format):
+    """
+    Formats a table of values (rows, columns) as CSV lines, with a label in front of each row and
+    missing values left blank.
+    """
+    text = np.char.mod(float_format, np.nan_to_num(values))
+    text[np.isnan(values)] = ''
+    return [','.join(labels + list(row)) for labels, row in zip(row_labels, text.tolist())]
 
-    return None
 
+def feature_location(feature):
+    geometry = feature.geometry()
+    if geometry.type() == 0: # points
+        point = geometry.get() if not geometry.isMultipart() else geometry.centroid().get()
+    else: # polygons
+        point = geometry.centroid().get()
+    return point.x(), point.y()
 
-def createURBS(input_layer, results_dict, grid_set, depth_or_intensity, id_field, output_folder, climate_scenario, feedback, context):
 
-    aeps_naming = dict(zip(AEPS['QRA SEQ'], AEPS['URBS']))
-    durations_naming = dict(zip(DURATIONS['QRA SEQ'], DURATIONS['URBS']))
-    numerical_durations = dict(zip(DURATIONS['QRA SEQ'], DURATIONS['LIMB']))
+def createBomCSVs(input_layer, features, cube, aeps, durations, grid_set, depth_or_intensity, id_field, output_folder, climate_scenario, feedback, writer, nearest_cells=None):
 
-    for feature in input_layer.getFeatures():
+    date = datetime.datetime.today().strftime('%d %B %Y')
+    units = f'mm{"/hr" if depth_or_intensity == "Intensity" else ""}'
+    float_format = '%.3f' if depth_or_intensity == 'Intensity' else '%.1f'
+    values = table_values(cube, durations, depth_or_intensity)
+
+    geographic = input_layer.crs().isGeographic()
+    if not geographic:
+        try:
+            zone = input_layer.crs().toProj().split()[1].split("=")[1]
+        except:
+            zone = 0
+
+    column_header = ','.join(['Duration', 'Duration in min'] + [aep_label(aep, 'BOM') for aep in aeps])
+    row_labels = [[duration_label(duration, 'BOM'), f'{duration_minutes(duration):g}'] for duration in durations]
+
+    for i, feature in enumerate(features):
         feature_id = feature[id_field]
+        x, y = feature_location(feature)
+        if nearest_cells is not None and not np.isnan(nearest_cells[i, 0]):
+            near_lat, near_lon = f'{nearest_cells[i, 0]:.4f}', f'{nearest_cells[i, 1]:.4f}'
+        else:
+            near_lat, near_lon = 0, 0
+        if geographic:
+            coordinate = f'Requested coordinate:,Latitude,{y:.4f},Longitude,{x:.4f}'
+        else:
+            coordinate = f'Requested coordinate:,Easting,{x:.1f},Northing,{y:.1f},Zone,{zone}'
+        lines = [
+            f'QRA SEQ 2024 IFD ({grid_set})',
+            '',
+            f'IFD Design Rainfall {depth_or_intensity} ({units}) - {grid_set}',
+            f'Issued:,{date}',
+            f'Location Label:,{feature_id}',
+            coordinate,
+            f'Nearest grid cell:,Latitude,{near_lat},Longitude,{near_lon}',
+            '',
+            ',,Annual Exceedance Probability (AEP)',
+            column_header,
+        ] + format_rows(row_labels, values[i].T, float_format)
 
-        feature_results_dict = results_dict[feature_id]
-        aeps = feature_results_dict.keys()
-        durations = feature_results_dict[list(aeps)[0]].keys()
+        csv_file = os.path.join(output_folder, f'ifd_{grid_set}_{climate_scenario.split(":")[0]}_{feature_id}.csv')
+        writer.write(csv_file, '\n'.join(lines) + '\n')
+
+    return None
 
-        # feedback.pushInfo(str(durations))
-        # feedback.pushInfo(str(numerical_durations))
-        # feedback.pushInfo(str([float(numerical_durations[d]) for d in durations]))
-        
-        df = pd.DataFrame.from_dict(feature_results_dict)
-        df['Duration'] = df.index.map(durations_naming)
-        df.rename(columns=aeps_naming, inplace=True)
 
-        df.set_index('Duration', drop=True, inplace=True)
+def createURBS(input_layer, features, cube, aeps, durations, grid_set, depth_or_intensity, id_field, output_folder, climate_scenario, feedback, writer):
 
-        if depth_or_intensity == 'Intensity':
-            df = df.divide([float(numerical_durations[d])/60.0 for d in durations], axis=0)
+    float_format = '%.3f' if depth_or_intensity == 'Intensity' else '%.1f'
+    values = table_values(cube, durations, depth_or_intensity)
+
+    column_header = ','.join(['Duration'] + [aep_label(aep, 'URBS') for aep in aeps])
+    row_labels = [[duration_label(duration, 'URBS')] for duration in durations]
+
+    for i, feature in enumerate(features):
+        feature_id = feature[id_field]
+        lines = [column_header] + format_rows(row_labels, values[i].T, float_format)
 
         csv_file = os.path.join(output_folder, f'ifd_{grid_set}_{climate_scenario.split(":")[0]}_{feature_id}.ifd')
-        if depth_or_intensity == 'Intensity':
-            df.to_csv(csv_file, mode='w', float_format="%.3f")
-        else:
-            df.to_csv(csv_file, mode='w', float_format="%.1f")
+        writer.write(csv_file, '\n'.join(lines) + '\n')
 
     return None
 
 
+def createLongTable(features, scenario_cubes, aeps, durations, grid_set, depth_or_intensity, id_field, output_folder, file_format, feedback):
+    """
+    Writes one long format table covering every feature, climate scenario, AEP and duration.
+    """
+    values_name = 'intensity_mm_per_hr' if depth_or_intensity == 'Intensity' else 'depth_mm'
+    ids = [feature[id_field] for feature in features]
+    n_features, n_aeps, n_durations = len(ids), len(aeps), len(durations)
+
+    frames = []
+    for climate_scenario, cube in scenario_cubes.items():
+        values = table_values(cube, durations, depth_or_intensity)
+        frames.append(pd.DataFrame({
+            'id': np.repeat(ids, n_aeps * n_durations),
+            'climate': climate_scenario,
+            'warming': CLIMATE_SCENARIOS[climate_scenario],
+            'aep': np.tile(np.repeat(aeps, n_durations), n_features),
+            'duration': np.tile(durations, n_features * n_aeps),
+            'duration_min': np.tile([duration_minutes(d) for d in durations], n_features * n_aeps),
+            values_name: values.ravel(),
+        }))
+    table = pd.concat(frames, ignore_index=True)
+
+    if file_format == 'Parquet':
+        output_file = os.path.join(output_folder, f'ifd_{grid_set}_long.parquet')
+        try:
+            table.to_parquet(output_file, index=False)
+        except ImportError:
+            raise QgsProcessingException("Writing Parquet needs pyarrow or fastparquet installed in the QGIS Python environment.")
+    else:
+        output_file = os.path.join(output_folder, f'ifd_{grid_set}_long.csv')
+        table.to_csv(output_file, index=False, float_format='%.3f' if depth_or_intensity == 'Intensity' else '%.1f')
+    feedback.pushInfo(f"Wrote {len(table)} rows to {output_file}")
+
+    return output_file
+
+
+def write_ifd_tables(input_layer, features, id_field, scenario_cubes, aeps, durations, grid_set_short, output_format, depth_or_intensity, output_folder, feedback, context, nearest_cells=None):
+    """
+    Writes the IFD tables for each climate scenario, straight from the result cubes. nearest_cells holds the
+    (latitude, longitude) of the grid cell nearest each feature for the BoM CSV headers.
+    """
+    if output_format.startswith('Long format'):
+        return createLongTable(features, scenario_cubes, aeps, durations, grid_set_short, depth_or_intensity, id_field, output_folder, output_format.split()[2], feedback)
+
+    if output_format not in ('BoM CSV', 'URBS'):
+        feedback.pushInfo(f"Output format {output_format} not supported or implemented.")
+        return None
+
+    writer = TableWriter()
+    try:
+        for climate_scenario, scenario_cube in scenario_cubes.items():
+            if output_format == 'BoM CSV':
+                createBomCSVs(input_layer, features, scenario_cube, aeps, durations, grid_set_short, depth_or_intensity, id_field, output_folder, climate_scenario, feedback, writer, nearest_cells)
+            else:
+                createURBS(input_layer, features, scenario_cube, aeps, durations, grid_set_short, depth_or_intensity, id_field, output_folder, climate_scenario, feedback, writer)
+    finally:
+        writer.close()
+    feedback.pushInfo(f"Wrote {len(features) * len(scenario_cubes)} IFD tables to {output_folder}")
+
+    return output_folder
+
+HYETOGRAPH_FORMATS = ['URBS', 'WBNM']
+
+# ARR temporal pattern AEP bands (frequent: more frequent than 14.4% AEP, rare: rarer than 3.2% AEP)
+PATTERN_BANDS = {
+    'frequent': (14.4, 100),
+    'intermediate': (3.2, 14.4),
+    'rare': (0, 3.2),
+}
+
+
+def pattern_band(percent):
+    if percent > PATTERN_BANDS['frequent'][0]:
+        return 'frequent'
+    if percent >= PATTERN_BANDS['intermediate'][0]:
+        return 'intermediate'
+    return 'rare'
+
+
+class TemporalPatterns:
+    """
+    A temporal pattern table in the ARR Data Hub layout (Increments.csv): one pattern per row with
+    EventID, Duration (min), TimeStep (min), Region and AEP band columns, followed by the rainfall
+    increments as percentages of the total depth. The AEP column is optional; without it every
+    pattern is applied to every AEP.
+    """
+    def __init__(self, table):
+        columns = list(table.columns)
+        self.has_bands = 'AEP' in table.columns
+        increment_columns = columns[columns.index('AEP' if self.has_bands else 'Region' if 'Region' in columns else 'TimeStep') + 1:]
+        self.patterns = {}
+        for minutes, rows in table.groupby('Duration'):
+            time_step = float(rows['TimeStep'].iloc[0])
+            steps = int(round(float(minutes) / time_step))
+            fractions = rows[increment_columns].to_numpy(dtype='float64')[:, :steps] / 100.0
+            fractions = np.nan_to_num(fractions)
+            bands = [str(band).lower() for band in rows['AEP']] if self.has_bands else [None] * len(rows)
+            self.patterns[float(minutes)] = (time_step, list(rows['EventID']), bands, fractions)
+
+    @classmethod
+    def read(cls, path):
+        return cls(pd.read_csv(path, skipinitialspace=True))
+
+    def for_duration(self, duration, aeps):
+        """
+        Returns (time step, pattern ids (aep, pattern), fractions (aep, pattern, step)) for a duration,
+        selecting each AEP's patterns from its ARR band. Missing patterns are NaN. Returns None if the
+        table has no patterns for the duration.
+        """
+        entry = self.patterns.get(float(duration_minutes(duration)))
+        if entry is None:
+            return None
+        time_step, event_ids, bands, fractions = entry
+        selected = [
+            [i for i, band in enumerate(bands) if band is None or band == pattern_band(aep_percent(aep))]
+            for aep in aeps
+        ]
+        n_patterns = max(len(s) for s in selected)
+        pattern_ids = [[event_ids[i] for i in s] + [None] * (n_patterns - len(s)) for s in selected]
+        stack = np.full((len(aeps), n_patterns, fractions.shape[1]), np.nan)
+        for a, s in enumerate(selected):
+            stack[a, :len(s)] = fractions[s]
+        return time_step, pattern_ids, stack
+
+
+class ArchiveWriter(TableWriter):
+    """
+    Writes files into a single zip archive instead of loose files. Paths are stored relative to root.
+    Compression runs on one background thread so it overlaps formatting.
+    """
+    def __init__(self, archive_path, root, max_pending=256):
+        super().__init__(max_workers=1, max_pending=max_pending)
+        self.root = root
+        self.archive = zipfile.ZipFile(archive_path, 'w', zipfile.ZIP_DEFLATED)
+
+    def _write(self, path, text):
+        self.archive.writestr(os.path.relpath(path, self.root).replace(os.sep, '/'), text)
+
+    def close(self):
+        super().close()
+        self.archive.close()
+
+
+def hyetographs(depths, fractions):
+    """
+    Returns the (feature, aep, pattern, step) rainfall increments for one duration by broadcasting the
+    (feature, aep) depths over the (aep, pattern, step) pattern fractions.
+    """
+    return depths[:, :, np.newaxis, np.newaxis] * fractions[np.newaxis]
+
+
+def createURBSStorms(ids, depths, aeps, duration, time_step, pattern_ids, fractions, grid_set, climate_scenario, output_folder, writer):
+    """
+    Writes one URBS storm file per AEP and pattern with the pattern as the pluviograph and the total depth
+    of every subcatchment.
+    """
+    steps = fractions.shape[2]
+    scenario = climate_scenario.split(":")[0]
+    for a, aep in enumerate(aeps):
+        depth_text = ' '.join('%.1f' % depth for depth in depths[:, a])
+        for p, pattern_id in enumerate(pattern_ids[a]):
+            if pattern_id is None:
+                continue
+            lines = [
+                f'{grid_set} {aep_label(aep, "URBS")} {duration_label(duration, "URBS")} pattern {pattern_id} ({scenario})',
+                f'Time Increment: {time_step / 60:g}',
+                f'Run Duration: {3 * steps * time_step / 60:g}',
+                f'Storm Duration: {steps * time_step / 60:g}',
+                'Pluviograph.',
+                f'Rain Time: {time_step / 60:g}',
+                ' '.join('%.2f' % (100 * f) for f in fractions[a, p]),
+                f'Rain Depths: {depth_text}',
+                f'Subareas: {" ".join(str(i) for i in ids)}',
+            ]
+            storm_file = os.path.join(output_folder, f'storm_{grid_set}_{scenario}_{aep}_{duration}_{pattern_id}.storm')
+            writer.write(storm_file, '\n'.join(lines) + '\n')
+
+
+def wbnm_block_line(marker):
+    """
+    Returns a WBNM runfile block marker, padded like the runfile blocks written by qgis_wbnm_helper.
+    """
+    return f'#####{marker}'.ljust(35, '#') + '|###########|###########|###########|'
+
+
+def createWBNMStorms(ids, rain, aeps, duration, time_step, pattern_ids, grid_set, climate_scenario, output_folder, writer):
+    """
+    Writes one WBNM runfile storm block per AEP and pattern, holding a single storm with the rainfall
+    increments (mm) of every subcatchment as recorded rain, ready to replace the storm block of a runfile.
+    """
+    scenario = climate_scenario.split(":")[0]
+    steps = rain.shape[3]
+    for a, aep in enumerate(aeps):
+        for p, pattern_id in enumerate(pattern_ids[a]):
+            if pattern_id is None:
+                continue
+            lines = [
+                wbnm_block_line('START_STORM_BLOCK'),
+                f'{1:>12}',
+                '#####START_STORM#1',
+                f'{grid_set} {aep_label(aep, "BOM")} {duration_label(duration, "BOM")} pattern {pattern_id} ({scenario})',
+                f'{0:>12.2f}{3 * steps * time_step:>12.2f}{time_step:>12.2f}',
+                '#####START_RECORDED_RAIN',
+                f'{time_step:>12.2f}{steps:>12}',
+                f'{len(ids):>12}',
+            ]
+            for i, feature_id in enumerate(ids):
+                lines.append(f'{str(feature_id):<12}')
+                increments = rain[i, a, p]
+                for row in range(0, steps, 10):
+                    lines.append(''.join(f'{value:>12.2f}' for value in increments[row:row + 10]))
+            lines += [
+                '#####END_RECORDED_RAIN',
+                '#####END_STORM#1',
+                wbnm_block_line('END_STORM_BLOCK'),
+            ]
+            storm_file = os.path.join(output_folder, f'storm_{grid_set}_{scenario}_{aep}_{duration}_{pattern_id}.wbnm')
+            writer.write(storm_file, '\n'.join(lines) + '\n')
+
+
+def write_hyetographs(features, id_field, scenario_cubes, aeps, durations, patterns, grid_set_short, hyetograph_format, output_folder, feedback, archive=False):
+    """
+    Writes design storm rainfall files for every climate scenario, AEP, duration and temporal pattern from
+    the IFD result cubes. With archive, everything goes into one zip in output_folder instead of loose files.
+    Subcatchments without IFD depths (outside the grids or in nodata cells) are reported and left out rather
+    than given zero rainfall.
+    """
+    if isinstance(patterns, str):
+        patterns = TemporalPatterns.read(patterns)
+    ids = [feature[id_field] for feature in features]
+
+    missing = np.zeros(len(ids), dtype=bool)
+    for scenario_cube in scenario_cubes.values():
+        missing |= np.isnan(scenario_cube).any(axis=(1, 2))
+    if missing.all():
+        raise QgsProcessingException("No features have IFD depths for every AEP and duration, so no rainfall files can be written.")
+    if missing.any():
+        feedback.reportError(f"No IFD depths for {', '.join(str(i) for i, m in zip(ids, missing) if m)}; left out of the rainfall files.")
+        ids = [i for i, m in zip(ids, missing) if not m]
+        scenario_cubes = {scenario: scenario_cube[~missing] for scenario, scenario_cube in scenario_cubes.items()}
+
+    hyetograph_folder = os.path.join(output_folder, 'hyetographs')
+    if archive:
+        os.makedirs(output_folder, exist_ok=True)
+        archive_path = os.path.join(output_folder, f'hyetographs_{grid_set_short}_{hyetograph_format}.zip')
+        writer = ArchiveWriter(archive_path, hyetograph_folder)
+    else:
+        os.makedirs(hyetograph_folder, exist_ok=True)
+        writer = TableWriter()
+
+    try:
+        for duration in durations:
+            selection = patterns.for_duration(duration, aeps)
+            if selection is None:
+                feedback.pushInfo(f"No temporal patterns for {duration}, skipping...")
+                continue
+            time_step, pattern_ids, fractions = selection
+            d = durations.index(duration)
+            for climate_scenario, scenario_cube in scenario_cubes.items():
+                if feedback.isCanceled():
+                    return None
+                depths = scenario_cube[:, :, d]
+                if hyetograph_format == 'URBS':
+                    createURBSStorms(ids, depths, aeps, duration, time_step, pattern_ids, fractions, grid_set_short, climate_scenario, hyetograph_folder, writer)
+                else:
+                    createWBNMStorms(ids, hyetographs(depths, fractions), aeps, duration, time_step, pattern_ids, grid_set_short, climate_scenario, hyetograph_folder, writer)
+    finally:
+        writer.close()
+
+    feedback.pushInfo(f"Wrote {hyetograph_format} rainfall files to {archive_path if archive else hyetograph_folder}")
+    return archive_path if archive else hyetograph_folder
+
+
+
 class IFDTool(QgsProcessingAlgorithm):
     """
     Extracts QRA SEQ 2024 IFD data.
@@ -483,9 +1901,13 @@ class IFDTool(QgsProcessingAlgorithm):
             '''
             Extracts QRA SEQ 2024 IFD data.
 
-            Supply either a point or polygon input layer. If a points layer is supplied, the tool uses point inspection (Raster Sampling) to extract IFD values. If a polygon layer is supplied, the tool calculates an area-weighted mean IFD value (Zonal Statistics).
+            Supply either a point or polygon input layer. If a points layer is supplied, the tool uses point inspection (Raster Sampling) to extract IFD values. If a polygon layer is supplied, the tool calculates an area-weighted mean IFD value, weighting each grid cell by the fraction of it covered by the polygon.
 
             The tool will create a GIS layer with IFD attributes, as well as IFD tables in the specified format for each point or polygon feature.
+
+            Non-standard AEPs (%) and durations (minutes) can be added under the advanced parameters. They are interpolated log-log from the neighbouring grids, which are extracted automatically if they weren't selected.
+
+            Several climate scenarios can be selected. The grids are only read once and each scenario is derived from the same base depths. IFD tables are written for each scenario, and the GIS layer holds either scenario suffixed fields or one feature per scenario (long format).
             '''
         )
 
@@ -548,12 +1970,29 @@ class IFDTool(QgsProcessingAlgorithm):
             )
         )
 
+        # optional - non-standard AEPs and durations, interpolated from the extracted grids
+        extra_aeps_parameter = QgsProcessingParameterString(
+            "extra_aeps",
+            self.tr('Additional AEPs to interpolate (%, comma separated)'),
+            optional = True,
+        )
+        extra_aeps_parameter.setFlags(extra_aeps_parameter.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(extra_aeps_parameter)
+
+        extra_durations_parameter = QgsProcessingParameterString(
+            "extra_durations",
+            self.tr('Additional durations to interpolate (minutes, comma separated)'),
+            optional = True,
+        )
+        extra_durations_parameter.setFlags(extra_durations_parameter.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(extra_durations_parameter)
+
         self.addParameter(
             QgsProcessingParameterEnum(
                 "climate",
-                self.tr('Select climate scenario'),
+                self.tr('Select climate scenarios'),
                 options = list(CLIMATE_SCENARIOS.keys()),
-                allowMultiple = False,
+                allowMultiple = True,
                 optional = False,
             )
         )
@@ -569,6 +2008,37 @@ class IFDTool(QgsProcessingAlgorithm):
         grid_folder_parameter.setFlags(grid_folder_parameter.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
         self.addParameter(grid_folder_parameter)
 
+        # optional - local folder to mirror network grids into
+        cache_folder_parameter = QgsProcessingParameterFile(
+            "cache_folder",
+            self.tr('Local IFD grid cache folder (leave blank to read grids directly)'),
+            behavior = 1,
+            optional = True,
+        )
+        cache_folder_parameter.setFlags(cache_folder_parameter.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(cache_folder_parameter)
+
+        cache_size_parameter = QgsProcessingParameterNumber(
+            "cache_size",
+            self.tr('Local IFD grid cache size (GB)'),
+            QgsProcessingParameterNumber.Double,
+            defaultValue = 20,
+            minValue = 0,
+            optional = True,
+        )
+        cache_size_parameter.setFlags(cache_size_parameter.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(cache_size_parameter)
+
+        # use the local IFD query service (python qgis_ifd_tool_seq.py serve) when it's running
+        use_service_parameter = QgsProcessingParameterBoolean(
+            "use_service",
+            self.tr('Use the local IFD query service if it is running'),
+            defaultValue = False,
+            optional = True,
+        )
+        use_service_parameter.setFlags(use_service_parameter.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(use_service_parameter)
+
         # specify grid CRS if none
         crs_parameter = QgsProcessingParameterCrs(
             "CRS",
@@ -583,7 +2053,7 @@ class IFDTool(QgsProcessingAlgorithm):
         output_format_parameter = QgsProcessingParameterEnum(
                 "output_format",
                 self.tr('Output IFD table format'),
-                options = ['BoM CSV', 'URBS'],
+                options = OUTPUT_FORMATS,
                 allowMultiple = False,
                 defaultValue = 'BoM CSV',
                 optional = False,
@@ -591,6 +2061,18 @@ class IFDTool(QgsProcessingAlgorithm):
         output_format_parameter.setFlags(output_format_parameter.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
         self.addParameter(output_format_parameter)
 
+        # layout of the GIS results when more than one climate scenario is selected
+        scenario_layout_parameter = QgsProcessingParameterEnum(
+                "scenario_layout",
+                self.tr('GIS results layout for multiple climate scenarios'),
+                options = SCENARIO_LAYOUTS,
+                allowMultiple = False,
+                defaultValue = 0,
+                optional = False,
+            )
+        scenario_layout_parameter.setFlags(scenario_layout_parameter.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(scenario_layout_parameter)
+
         # drop down to specify output format (defaults to BoM-format CSV)
         depth_or_intensity_parameter = QgsProcessingParameterEnum(
                 "depth_or_intensity",
@@ -603,6 +2085,36 @@ class IFDTool(QgsProcessingAlgorithm):
         depth_or_intensity_parameter.setFlags(depth_or_intensity_parameter.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
         self.addParameter(depth_or_intensity_parameter)
 
+        # optional design storm rainfall files from an ARR temporal pattern table
+        temporal_patterns_parameter = QgsProcessingParameterFile(
+            "temporal_patterns",
+            self.tr('Temporal pattern table for rainfall files (ARR Increments.csv, leave blank for none)'),
+            extension = 'csv',
+            optional = True,
+        )
+        temporal_patterns_parameter.setFlags(temporal_patterns_parameter.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(temporal_patterns_parameter)
+
+        hyetograph_format_parameter = QgsProcessingParameterEnum(
+                "hyetograph_format",
+                self.tr('Rainfall file format'),
+                options = HYETOGRAPH_FORMATS,
+                allowMultiple = False,
+                defaultValue = 0,
+                optional = False,
+            )
+        hyetograph_format_parameter.setFlags(hyetograph_format_parameter.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(hyetograph_format_parameter)
+
+        hyetograph_archive_parameter = QgsProcessingParameterBoolean(
+            "hyetograph_archive",
+            self.tr('Pack rainfall files into a single zip archive'),
+            defaultValue = False,
+            optional = True,
+        )
+        hyetograph_archive_parameter.setFlags(hyetograph_archive_parameter.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(hyetograph_archive_parameter)
+
         # location for output folder
         self.addParameter(
             QgsProcessingParameterFolderDestination(
@@ -614,7 +2126,7 @@ class IFDTool(QgsProcessingAlgorithm):
 
         # location for output file
         self.addParameter(
-            QgsProcessingParameterVectorDestination(
+            QgsProcessingParameterFeatureSink(
                 "OUTPUT",
                 self.tr('Output GIS IFD results'),
                 optional = False,
@@ -645,21 +2157,39 @@ class IFDTool(QgsProcessingAlgorithm):
         )
         durations = [durations_list[i] for i in durations_enums]
 
-        climate_enum = self.parameterAsEnum(
+        extra_aeps = parse_numbers(self.parameterAsString(
+            parameters,
+            'extra_aeps',
+            context
+        ) or '')
+        extra_durations = parse_numbers(self.parameterAsString(
+            parameters,
+            'extra_durations',
+            context
+        ) or '')
+        extract_aeps, extract_durations, aeps, durations = ifd_axes(aeps, durations, extra_aeps, extra_durations)
+
+        climate_enums = self.parameterAsEnums(
             parameters,
             'climate',
             context
         )
-        climate_scenario = list(CLIMATE_SCENARIOS.keys())[climate_enum]
-        degrees_warming = list(CLIMATE_SCENARIOS.values())[climate_enum]
-        feedback.pushInfo(f"Using {climate_scenario}: {degrees_warming} degrees warming.")
+        climate_scenarios = [list(CLIMATE_SCENARIOS.keys())[i] for i in climate_enums]
+        for climate_scenario in climate_scenarios:
+            feedback.pushInfo(f"Using {climate_scenario}: {CLIMATE_SCENARIOS[climate_scenario]} degrees warming.")
+
+        scenario_layout_enum = self.parameterAsEnum(
+            parameters,
+            'scenario_layout',
+            context
+        )
+        scenario_layout = SCENARIO_LAYOUTS[scenario_layout_enum]
 
         grid_set_enum = self.parameterAsEnum(
             parameters,
             'grid_set',
             context
         )
-        grid_set = list(GRID_SETS.values())[grid_set_enum]
         grid_set_short = list(GRID_SETS.keys())[grid_set_enum]
 
         depths_or_intensity_options = [
@@ -674,7 +2204,7 @@ class IFDTool(QgsProcessingAlgorithm):
         )
         depth_or_intensity = depths_or_intensity_options[depth_or_intensity_enum]
 
-        output_format_options = ['BoM CSV', 'URBS']
+        output_format_options = OUTPUT_FORMATS
 
         output_format_enum = self.parameterAsEnum(
             parameters,
@@ -688,8 +2218,6 @@ class IFDTool(QgsProcessingAlgorithm):
             'grid_folder',
             context
         )
-        grid_folder = os.path.join(base_grid_folder, grid_set)
-
         output_folder = self.parameterAsFile(
             parameters,
             'output_folder',
@@ -726,134 +2254,644 @@ class IFDTool(QgsProcessingAlgorithm):
             )
             input_layer.setCrs(input_crs)
 
-        grids = glob.glob(os.path.join(grid_folder, "*.tiff"))
-        grid = QgsRasterLayer(grids[0])
-        if not grid.crs().isValid():
-            grid.setCrs(grid_crs)
-
-        # reproject input layer if not in same CRS as grids
-        if not grid.crs() == input_layer.sourceCrs():
-            layer_to_process = processing.run(
-                "native:reprojectlayer",
-                {
-                    'INPUT': input_layer,
-                    'TARGET_CRS': grid.crs(),
-                    'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-                }
-            )['OUTPUT']
-        else:
-            layer_to_process = input_layer
+        # resolve grids through the local mirror if one is set
+        cache_folder = self.parameterAsFile(
+            parameters,
+            'cache_folder',
+            context
+        )
+        mirror = None
+        if cache_folder:
+            cache_size = self.parameterAsDouble(
+                parameters,
+                'cache_size',
+                context
+            )
+            feedback.pushInfo(f"Using local grid cache {cache_folder}...")
+            mirror = GridMirror(cache_folder, cache_size * 1e9)
 
-        if feedback.isCanceled():
-                    return {}
-
-        # process all AEPs and Durations
-        ids = list(input_layer.uniqueValues(input_layer.fields().indexFromName(id_field)))
-        # feedback.pushInfo(str(ids))
-        results_dict = {i:{aep:{duration:'' for duration in durations} for aep in aeps} for i in ids}
-        # feedback.pushInfo(str(results_dict))
-        first = True
-        for aep in aeps:
-            for duration in durations:
-                if first:
-                    pass
-                else:
-                    layer_to_process = result['OUTPUT']
-                # grid_name = grid_template.format(duration, aep)
-                grid_match = [g for g in grids if f'IFD_{"ARI" if aep in ("2y", "5y") else "AEP"}_{aep}_{duration}' in g]
-                if grid_match:
-                    grid_name = grid_match[0]
-                    grid_layer = QgsRasterLayer(grid_name)
-                    if not grid_layer.crs().isValid():
-                        grid_layer.setCrs(grid_crs)
-                    # feedback.pushInfo(f"{duration} {aep} {grid_name} {grid_layer}")
-                    feedback.pushInfo(f"Working on {aep} {duration} ({grid_name})...")
-
-                    if input_layer.geometryType() == 0: # point
-                        #   run "native:rastersampling" for points
-                        result = processing.run(
-                            'native:rastersampling',
-                            {
-                                'INPUT': layer_to_process,
-                                'RASTERCOPY': grid_layer,
-                                'COLUMN_PREFIX': '{0}_{1}_'.format(aep, duration),
-                                'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT,
-                            }
-                        )
-                    elif input_layer.geometryType() == 2: # polygon
-                        #   run "native:zonalstatisticsfb" (mean) for polygons
-                        result = processing.run(
-                            'native:zonalstatisticsfb',
-                            {
-                                'INPUT': layer_to_process,
-                                'INPUT_RASTER': grid_layer,
-                                'RASTER_BAND': 1,
-                                'COLUMN_PREFIX': '{0}_{1}_'.format(aep, duration),
-                                'STATISTICS': 2,
-                                'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT,
-                            }
-                        )
-                    else:
-                        # TODO raise error if geom type not point or polygon - do it somewhere else
-                        pass
-
-                    ifd_field = [f for f in result['OUTPUT'].fields().names() if f.startswith(f'{aep}_{duration}_')][0]
-                    with edit(result['OUTPUT']):
-                        for feature in result['OUTPUT'].getFeatures():
-                            feature_id = feature[id_field]
-                            feature_ifd = feature[ifd_field]
-                            factor = rainfall_factor(duration, degrees_warming)
-                            new_ifd = feature_ifd * factor
-                            feature[ifd_field] = new_ifd
-                            feedback.pushInfo(f"Apply climate change rainfall factor of {factor:.3f}. Base: {feature_ifd:.3f} -> Adjusted: {new_ifd:.3f}")
-                            results_dict[feature_id][aep][duration] = new_ifd
-                            result['OUTPUT'].updateFeature(feature)
-
-                    first = False
-                else:
+        use_service = self.parameterAsBoolean(
+            parameters,
+            'use_service',
+            context
+        )
+
+        grid_source = IFDGridSource(base_grid_folder, grid_set_short, mirror=mirror, feedback=feedback)
+        available = grid_source.available
+        if grid_source.crs_wkt:
+            grid_crs = QgsCoordinateReferenceSystem.fromWkt(grid_source.crs_wkt)
+
+        for aep in extract_aeps:
+            for duration in extract_durations:
+                if (aep, duration) not in available:
                     feedback.pushInfo(f"No grid found for {aep} {duration}...")
 
-                if feedback.isCanceled():
-                    return {}
+        # locate the features in the grid CRS in memory - the output keeps the original geometries
+        features = list(input_layer.getFeatures())
+        locations = FeatureLocations.from_features(features, input_layer.geometryType(), input_layer.sourceCrs(), grid_crs, context.transformContext())
 
-        #TODO make sure IFD curves don't overlap after climate change adjustments have been applied
+        if feedback.isCanceled():
+            return {}
+
+        # use the local IFD query service for the same grid set if asked to and it's running
+        cube = service_extract(grid_set_short, base_grid_folder, extract_aeps, extract_durations, locations, feedback) if use_service else None
+        if cube is None:
+            # process all AEPs and Durations in one pass over the grids
+            cube = grid_source.extract(extract_aeps, extract_durations, locations, feedback)
+        grid_source.close()
+        cube, available = interpolate_extras(cube, extract_aeps, extract_durations, aeps, durations, available, feedback)
 
         if feedback.isCanceled():
             return {}
 
-        output = self.parameterAsOutputLayer(
+        # the base depths are extracted once and each scenario is derived from them
+        scenario_cubes = apply_climate_scenarios(cube, aeps, durations, climate_scenarios, feedback)
+
+        #TODO make sure IFD curves don't overlap after climate change adjustments have been applied
+
+        # write the results layer through a single sink
+        layout = IFDResultLayout(input_layer.fields(), aeps, durations, available, input_layer.geometryType(), climate_scenarios, scenario_layout, feedback)
+        sink, dest_id = self.parameterAsSink(
             parameters,
             'OUTPUT',
             context,
+            layout.fields,
+            input_layer.wkbType(),
+            input_layer.sourceCrs(),
         )
+        for out_feature in layout.features(features, scenario_cubes):
+            sink.addFeature(out_feature, QgsFeatureSink.FastInsert)
 
-        # reproject result layer to original CRS if not in same CRS as grids
-        if not grid.crs() == input_layer.sourceCrs():
-            save = processing.run(
-                "native:reprojectlayer",
-                {
-                    'INPUT': result['OUTPUT'],
-                    'TARGET_CRS': input_layer.crs(),
-                    'OUTPUT': output
-                }
+        # IFD tables for each scenario
+        nearest_cells = grid_source.nearest_cells(locations, grid_crs)
+        write_ifd_tables(input_layer, features, id_field, scenario_cubes, aeps, durations, grid_set_short, output_format, depth_or_intensity, output_folder, feedback, context, nearest_cells)
+
+        results = {
+            'OUTPUT': dest_id,
+            'IFD table folder': output_folder
+        }
+
+        # design storm rainfall files
+        temporal_patterns = self.parameterAsFile(
+            parameters,
+            'temporal_patterns',
+            context
+        )
+        if temporal_patterns:
+            hyetograph_format = HYETOGRAPH_FORMATS[self.parameterAsEnum(
+                parameters,
+                'hyetograph_format',
+                context
+            )]
+            hyetograph_archive = self.parameterAsBoolean(
+                parameters,
+                'hyetograph_archive',
+                context
             )
+            results['Rainfall files'] = write_hyetographs(features, id_field, scenario_cubes, aeps, durations, temporal_patterns, grid_set_short, hyetograph_format, output_folder, feedback, hyetograph_archive)
+
+        return results
+
+
+class PrintFeedback(QgsProcessingFeedback):
+    """
+    Processing feedback for command line runs, printing messages prefixed with the job name.
+    """
+    def __init__(self, prefix=''):
+        super().__init__()
+        self.prefix = prefix
+
+    def pushInfo(self, info):
+        print(f'{self.prefix}{info}', flush=True)
+
+    def reportError(self, error, fatalError=False):
+        print(f'{self.prefix}ERROR: {error}', flush=True)
+
+
+_QGIS_APP = None
+_WORKER_GRID_SOURCE = None
+
+
+def start_qgis():
+    """
+    Starts a headless QGIS application unless one is already running, so that command line runs use the
+    same user profile (and grid index cache) as the GUI.
+    """
+    global _QGIS_APP
+    if QgsApplication.instance() is None:
+        _QGIS_APP = QgsApplication([], False)
+        _QGIS_APP.initQgis()
+
+
+def _init_worker(settings, local_paths=None):
+    """
+    Starts a headless QGIS application and opens the grid set once for all jobs run by this process.
+    """
+    global _WORKER_GRID_SOURCE
+    start_qgis()
+    _WORKER_GRID_SOURCE = IFDGridSource(
+        settings.get('grid_folder', DEFAULT_GRID_LOCATION),
+        settings.get('grid_set', 'QRA_SEQ'),
+        local_paths=local_paths,
+        keep_open=True,
+    )
+
+
+def job_options(job, key, options, default):
+    """
+    Reads a list of AEPs, durations or climate scenarios from a job, given either by name or by index.
+    """
+    values = job.get(key) or default
+    selected = []
+    for value in values:
+        if isinstance(value, int):
+            selected.append(options[value])
+        elif value in options:
+            selected.append(value)
         else:
-            save = processing.run(
-                "native:savefeatures",
+            raise QgsProcessingException(f"Unknown {key[:-1]} {value!r} in job {job.get('name', job['layer'])}")
+    return selected
+
+
+def job_axes(job):
+    return ifd_axes(
+        job_options(job, 'aeps', AEPS['QRA SEQ'], AEPS['QRA SEQ']),
+        job_options(job, 'durations', DURATIONS['QRA SEQ'], DURATIONS['QRA SEQ']),
+        job.get('extra_aeps', []),
+        job.get('extra_durations', []),
+    )
+
+
+def run_ifd_job(job, settings):
+    """
+    Runs one IFD extraction job in the current process with the process' shared grid source.
+    """
+    name = job.get('name', os.path.basename(job['layer']))
+    feedback = PrintFeedback(f'[{name}] ')
+    grid_source = _WORKER_GRID_SOURCE
+
+    input_layer = QgsVectorLayer(job['layer'], name, 'ogr')
+    if not input_layer.isValid():
+        raise QgsProcessingException(f"Could not load layer {job['layer']}")
+    if not input_layer.crs().isValid():
+        input_layer.setCrs(QgsCoordinateReferenceSystem(settings.get('crs', 'EPSG:4283')))
+    if input_layer.featureCount() == 0:
+        feedback.pushInfo("Input layer is blank. Nothing to process.")
+        return {'name': name, 'features': 0}
+
+    extract_aeps, extract_durations, aeps, durations = job_axes(job)
+    climate_scenarios = job_options(job, 'scenarios', list(CLIMATE_SCENARIOS), ['No adjustment - historic baseline (2010): 0 degrees warming'])
+    grid_crs = QgsCoordinateReferenceSystem.fromWkt(grid_source.crs_wkt) if grid_source.crs_wkt else QgsCoordinateReferenceSystem(settings.get('crs', 'EPSG:4283'))
+
+    features = list(input_layer.getFeatures())
+    locations = FeatureLocations.from_features(features, input_layer.geometryType(), input_layer.crs(), grid_crs)
+    cube = grid_source.extract(extract_aeps, extract_durations, locations, feedback)
+    cube, available = interpolate_extras(cube, extract_aeps, extract_durations, aeps, durations, grid_source.available, feedback)
+    scenario_cubes = apply_climate_scenarios(cube, aeps, durations, climate_scenarios, feedback)
+
+    output_folder = job['output_folder']
+    os.makedirs(output_folder, exist_ok=True)
+    write_ifd_tables(
+        input_layer, features, job['id_field'], scenario_cubes, aeps, durations, settings.get('grid_set', 'QRA_SEQ'), job.get('output_format', 'BoM CSV'), job.get('depth_or_intensity', 'Depth'),
+        output_folder, feedback, None, grid_source.nearest_cells(locations, grid_crs),
+    )
+    if job.get('temporal_patterns'):
+        write_hyetographs(
+            features, job['id_field'], scenario_cubes, aeps, durations, job['temporal_patterns'], settings.get('grid_set', 'QRA_SEQ'),
+            job.get('hyetograph_format', 'URBS'), output_folder, feedback, job.get('hyetograph_archive', False),
+        )
+
+    if job.get('output_layer'):
+        layout = IFDResultLayout(
+            input_layer.fields(), aeps, durations, available, input_layer.geometryType(),
+            climate_scenarios, job.get('scenario_layout', SCENARIO_LAYOUTS[0]), feedback,
+        )
+        options = QgsVectorFileWriter.SaveVectorOptions()
+        options.driverName = QgsVectorFileWriter.driverForExtension(os.path.splitext(job['output_layer'])[1]) or 'GPKG'
+        writer = QgsVectorFileWriter.create(
+            job['output_layer'], layout.fields, input_layer.wkbType(), input_layer.crs(),
+            QgsProject.instance().transformContext(), options,
+        )
+        if writer.hasError():
+            raise QgsProcessingException(f"Could not write {job['output_layer']}: {writer.errorMessage()}")
+        for out_feature in layout.features(features, scenario_cubes):
+            writer.addFeature(out_feature)
+        del writer
+
+    return {'name': name, 'features': len(features), 'output_folder': output_folder}
+
+
+def _run_ifd_job_safe(job, settings):
+    try:
+        return run_ifd_job(job, settings)
+    except Exception as e:
+        return {'name': job.get('name', job.get('layer')), 'error': str(e)}
+
+
+def run_ifd_manifest(manifest, workers=None):
+    """
+    Runs every job in a manifest (a dict or the path to a JSON file) in one batch. The grid set is indexed
+    (and mirrored, if a cache folder is set) once, then jobs are fanned out to a pool of worker processes,
+    each of which opens the grids once and reuses them for all of its jobs.
+
+    Manifest format:
+        {
+            "grid_folder": "H:/.../IFD_data",       (optional, defaults to DEFAULT_GRID_LOCATION)
+            "grid_set": "QRA_SEQ",                  (optional)
+            "crs": "EPSG:4283",                     (optional, CRS of grids and layers that don't define one)
+            "cache_folder": "C:/ifd_cache",         (optional local grid mirror)
+            "cache_size": 20,                       (optional, GB)
+            "workers": 4,                           (optional)
+            "jobs": [
                 {
-                    'INPUT': result['OUTPUT'],
-                    'OUTPUT': output
+                    "name": "Catchment A",
+                    "layer": "C:/project/subcatchments.gpkg",
+                    "id_field": "ID",
+                    "aeps": ["1pct", "2pct"],       (optional, QRA SEQ names or indices, defaults to all)
+                    "durations": ["1hr", "2hr"],    (optional, QRA SEQ names or indices, defaults to all)
+                    "extra_aeps": [3],              (optional, non-standard AEPs (%) to interpolate)
+                    "extra_durations": [100, 240],  (optional, non-standard durations (minutes) to interpolate)
+                    "scenarios": [12, 10],          (optional, CLIMATE_SCENARIOS names or indices)
+                    "scenario_layout": "Long format",
+                    "output_format": "URBS",
+                    "depth_or_intensity": "Depth",
+                    "output_folder": "C:/project/ifd",
+                    "temporal_patterns": "C:/project/Increments.csv",  (optional, writes rainfall files)
+                    "hyetograph_format": "WBNM",    (optional, URBS or WBNM)
+                    "hyetograph_archive": true,     (optional, one zip instead of loose files)
+                    "output_layer": "C:/project/ifd/subcatchments_ifd.gpkg"
                 }
-            )
+            ]
+        }
 
-        if output_format == 'BoM CSV':
-            createBomCSVs(input_layer, results_dict, grid_set_short, depth_or_intensity, id_field, output_folder, climate_scenario, feedback, context)
-        elif output_format == 'URBS':
-            createURBS(input_layer, results_dict, grid_set_short, depth_or_intensity, id_field, output_folder, climate_scenario, feedback, context)
+    Returns a list of job summaries; failed jobs have an 'error' entry.
+    """
+    if not isinstance(manifest, dict):
+        with open(manifest) as infile:
+            manifest = json.load(infile)
+    settings = {key: value for key, value in manifest.items() if key != 'jobs'}
+    jobs = manifest['jobs']
+    workers = workers or settings.get('workers') or 1
+    start_qgis()
+
+    # index and mirror the grids up front so the workers only read them
+    local_paths = None
+    mirror = None
+    if settings.get('cache_folder'):
+        mirror = GridMirror(settings['cache_folder'], settings.get('cache_size', 20) * 1e9)
+    grid_source = IFDGridSource(settings.get('grid_folder', DEFAULT_GRID_LOCATION), settings.get('grid_set', 'QRA_SEQ'), mirror=mirror, feedback=PrintFeedback())
+    if mirror is not None:
+        aeps = sorted({aep for job in jobs for aep in job_axes(job)[0]}, key=AEPS['QRA SEQ'].index)
+        durations = sorted({d for job in jobs for d in job_axes(job)[1]}, key=DURATIONS['QRA SEQ'].index)
+        local_paths = grid_source.mirror_paths(aeps, durations, PrintFeedback())
+    grid_source.close()
+
+    if workers == 1 or len(jobs) == 1:
+        _init_worker(settings, local_paths)
+        return [_run_ifd_job_safe(job, settings) for job in jobs]
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(settings, local_paths)) as executor:
+        return list(executor.map(_run_ifd_job_safe, jobs, [settings] * len(jobs)))
+
+DEFAULT_SERVICE_PORT = 8765
+
+# returned by the service's "info" request so clients know they're talking to a compatible IFD service
+SERVICE_PROTOCOL = 'qra-seq-ifd'
+SERVICE_VERSION = 1
+
+
+class MemoryMappedGrids(IFDCube):
+    """
+    A grid set materialised once as a float32 (aep, duration, y, x) .npy stack and memory-mapped, so
+    queries only touch the pages holding the requested cells. The stack is rebuilt when the grid index
+    or IFD cube it came from changes. Reads as an IFDCube with a single chunk, so it's sampled by the
+    same code (see IFDGridSource.memory_map).
+    """
+    def __init__(self, grid_source, stack_folder=None, feedback=None):
+        self.available = grid_source.available
+        self.crs = grid_source.crs_wkt
+        self.geotransform = grid_source.geotransform
+        self.shape = grid_source.shape
+        self.chunk_size = max(self.shape)
+        self.aeps = [a for a in AEPS['QRA SEQ'] if any((a, d) in self.available for d in DURATIONS['QRA SEQ'])]
+        self.durations = [d for d in DURATIONS['QRA SEQ'] if any((a, d) in self.available for a in AEPS['QRA SEQ'])]
+
+        if grid_source.cube is not None:
+            fingerprint = [grid_source.cube_source_path, os.stat(grid_source.cube.path).st_mtime]
+        else:
+            fingerprint = [grid_source.grid_folder, grid_source.index.folder_mtime, sorted(
+                (entry['path'], entry['size'], entry['mtime']) for entry in grid_source.index.entries.values()
+            )]
+        stack_hash = hashlib.sha1(json.dumps(fingerprint).encode('utf-8')).hexdigest()[:16]
+        stack_folder = stack_folder or grid_cache_folder()
+        os.makedirs(stack_folder, exist_ok=True)
+        self.path = os.path.join(stack_folder, f'ifd_stack_{stack_hash}.npy')
+
+        if not os.path.isfile(self.path):
+            self._materialise(grid_source, feedback)
+        self.stack = np.load(self.path, mmap_mode='r')
+
+    def _materialise(self, grid_source, feedback):
+        if feedback is not None:
+            feedback.pushInfo(f"Building memory-mapped grid stack {self.path}...")
+        temp_path = self.path + '.tmp'
+        stack = np.lib.format.open_memmap(temp_path, mode='w+', dtype='float32', shape=(len(self.aeps), len(self.durations)) + tuple(self.shape))
+        if grid_source.cube is not None:
+            height, width = self.shape
+            size = grid_source.cube.chunk_size
+            for row_0 in range(0, height, size):
+                strip = grid_source.cube.read_window((0, row_0, width, min(size, height - row_0)))
+                for a, aep in enumerate(self.aeps):
+                    for d, duration in enumerate(self.durations):
+                        stack[a, d, row_0:row_0 + strip.shape[2]] = strip[grid_source.cube.aeps.index(aep), grid_source.cube.durations.index(duration)]
         else:
-            feedback.pushInfo(f"Output format {output_format} not supported or implemented.")
+            stack[:] = np.nan
+            grid_paths = grid_source.index.grid_paths(self.aeps, self.durations)
+            resolved = grid_source.mirror_paths(self.aeps, self.durations, feedback)
+            for (aep, duration), grid_path in grid_paths.items():
+                dataset = gdal.Open(resolved[grid_path])
+                stack[self.aeps.index(aep), self.durations.index(duration)] = read_grid(dataset)
+                dataset = None
+        stack.flush()
+        del stack
+        os.replace(temp_path, self.path)
 
-        return {
-            'OUTPUT': save['OUTPUT'],
-            'IFD table folder': output_folder
-        }
\ No newline at end of file
+    def chunk(self, chunk_row, chunk_col):
+        return self.stack
+
+    def close(self):
+        self.stack = None
+
+
+def _json_values(array):
+    return np.where(np.isnan(array), None, np.round(array, 4)).tolist()
+
+
+class IFDRequestHandler(socketserver.StreamRequestHandler):
+    """
+    Handles newline delimited JSON requests to the IFD query service. Requests are:
+
+        {"request": "info"}
+        {"request": "extract", "aeps": [...], "durations": [...], "points": [[x, y], ...]}
+        {"request": "query", "aeps": [...], "durations": [...], "scenarios": [...],
+         "extra_aeps": [...], "extra_durations": [...], "points": [[x, y], ...]}
+
+    Polygons are sent as "polygons": [WKB hex, ...] instead of "points". Coordinates are in the grid CRS
+    (see "info"). "extract" returns base depths as [feature][aep][duration]; "query" applies the
+    interpolation and climate scenarios of IFDTool and returns [scenario][feature][aep][duration].
+    """
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                response = self.server.respond(json.loads(line))
+            except Exception as e:
+                response = {'error': str(e)}
+            self.wfile.write((json.dumps(response) + '\n').encode('utf-8'))
+            self.wfile.flush()
+
+
+class IFDServiceMixin:
+    def respond(self, request):
+        grids = self.grids
+        if request['request'] == 'info':
+            return {
+                'service': SERVICE_PROTOCOL,
+                'version': SERVICE_VERSION,
+                'grid_folder': self.grid_folder,
+                'grid_set': self.grid_set,
+                'crs': grids.crs_wkt,
+                'aeps': grids.cube.aeps,
+                'durations': grids.cube.durations,
+            }
+
+        if 'points' in request:
+            points = np.array(request['points'], dtype='float64').reshape(-1, 2)
+            locations = FeatureLocations(0, xs=points[:, 0], ys=points[:, 1])
+        else:
+            locations = FeatureLocations(2, geometries=[ogr.CreateGeometryFromWkb(bytes.fromhex(g)) for g in request['polygons']])
+
+        request.setdefault('name', request['request'])
+        feedback = QgsProcessingFeedback()
+        if request['request'] == 'extract':
+            return {'values': _json_values(grids.extract(request['aeps'], request['durations'], locations, feedback))}
+
+        if request['request'] == 'query':
+            extract_aeps, extract_durations, aeps, durations = job_axes(request)
+            scenarios = job_options(request, 'scenarios', list(CLIMATE_SCENARIOS), ['No adjustment - historic baseline (2010): 0 degrees warming'])
+            cube = grids.extract(extract_aeps, extract_durations, locations, feedback)
+            cube, _ = interpolate_extras(cube, extract_aeps, extract_durations, aeps, durations, grids.available, feedback)
+            scenario_cubes = apply_climate_scenarios(cube, aeps, durations, scenarios, feedback)
+            return {
+                'aeps': aeps,
+                'durations': durations,
+                'scenarios': scenarios,
+                'values': [_json_values(scenario_cubes[scenario]) for scenario in scenarios],
+            }
+
+        raise ValueError(f"Unknown request {request['request']!r}")
+
+
+class IFDService(IFDServiceMixin, socketserver.ThreadingTCPServer):
+    """
+    Local IFD query service on a loopback TCP port. Keeps the grid set indexed and memory-mapped between
+    requests so point and polygon queries answer in milliseconds. grids is a memory-mapped IFDGridSource.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, grids, grid_folder, grid_set, port=DEFAULT_SERVICE_PORT):
+        self.grids = grids
+        self.grid_folder = grid_folder
+        self.grid_set = grid_set
+        super().__init__(('127.0.0.1', port), IFDRequestHandler)
+
+
+if hasattr(socketserver, 'ThreadingUnixStreamServer'):
+    class IFDUnixService(IFDServiceMixin, socketserver.ThreadingUnixStreamServer):
+        """
+        Same as IFDService but listening on a Unix domain socket.
+        """
+        daemon_threads = True
+
+        def __init__(self, grids, grid_folder, grid_set, socket_path):
+            self.grids = grids
+            self.grid_folder = grid_folder
+            self.grid_set = grid_set
+            super().__init__(socket_path, IFDRequestHandler)
+
+
+class IFDServiceClient:
+    """
+    Thin client for a running IFD query service. Connecting times out after connect_timeout and each
+    request after timeout seconds (socket.timeout, an OSError).
+    """
+    def __init__(self, port=DEFAULT_SERVICE_PORT, socket_path=None, connect_timeout=0.5, timeout=60):
+        if socket_path:
+            self.connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.connection.settimeout(connect_timeout)
+            self.connection.connect(socket_path)
+        else:
+            self.connection = socket.create_connection(('127.0.0.1', port), timeout=connect_timeout)
+        self.connection.settimeout(timeout)
+        self.stream = self.connection.makefile('rwb')
+        self._info = None
+
+    @classmethod
+    def connect(cls, port=DEFAULT_SERVICE_PORT, socket_path=None):
+        """
+        Returns a client if an IFD service is running, otherwise None.
+        """
+        try:
+            client = cls(port, socket_path)
+        except OSError:
+            return None
+        try:
+            client.info()
+        except (OSError, ValueError):
+            client.close()
+            return None
+        return client
+
+    def request(self, request):
+        self.stream.write((json.dumps(request) + '\n').encode('utf-8'))
+        self.stream.flush()
+        response = json.loads(self.stream.readline())
+        if not isinstance(response, dict):
+            raise ValueError("Unexpected response from the IFD service")
+        if 'error' in response:
+            raise QgsProcessingException(f"IFD service error: {response['error']}")
+        return response
+
+    def info(self):
+        """
+        Returns the service's grid folder, grid set and CRS, raising ValueError if the responder isn't a
+        compatible IFD service. The response is only requested once per connection.
+        """
+        if self._info is None:
+            info = self.request({'request': 'info'})
+            if info.get('service') != SERVICE_PROTOCOL or info.get('version') != SERVICE_VERSION:
+                raise ValueError("Not a compatible IFD service")
+            self._info = info
+        return self._info
+
+    def extract(self, aeps, durations, locations):
+        request = {'request': 'extract', 'aeps': aeps, 'durations': durations}
+        if locations.geometry_type == 0:
+            request['points'] = np.column_stack([locations.xs, locations.ys]).tolist()
+        else:
+            request['polygons'] = [bytes(g.ExportToWkb()).hex() for g in locations.geometries]
+        values = self.request(request)['values']
+        return np.array(values, dtype='float64').reshape(locations.count, len(aeps), len(durations))
+
+    def close(self):
+        self.stream.close()
+        self.connection.close()
+
+
+def service_extract(grid_set_short, base_grid_folder, aeps, durations, locations, feedback):
+    """
+    Extracts from the local IFD query service if it's running for the same grid folder and set. Returns
+    None if it isn't, or if it doesn't answer properly, so the caller reads the grids instead.
+    """
+    client = IFDServiceClient.connect()
+    if client is None:
+        return None
+    try:
+        info = client.info()
+        if info['grid_set'] != grid_set_short or os.path.normcase(os.path.abspath(info['grid_folder'])) != os.path.normcase(os.path.abspath(base_grid_folder)):
+            return None
+        feedback.pushInfo("Extracting from the local IFD query service...")
+        return client.extract(aeps, durations, locations)
+    except (OSError, ValueError, KeyError, QgsProcessingException) as e:
+        feedback.pushInfo(f"IFD service failed ({e}), reading the grids instead...")
+        return None
+    finally:
+        client.close()
+
+
+def serve_ifd(grid_folder=DEFAULT_GRID_LOCATION, grid_set='QRA_SEQ', port=DEFAULT_SERVICE_PORT, socket_path=None, cache_folder=None, cache_size=20, stack_folder=None):
+    """
+    Runs the IFD query service until interrupted.
+    """
+    start_qgis()
+    feedback = PrintFeedback()
+    mirror = GridMirror(cache_folder, cache_size * 1e9) if cache_folder else None
+    grid_source = IFDGridSource(grid_folder, grid_set, mirror=mirror, feedback=feedback)
+    grid_source.memory_map(stack_folder, feedback)
+
+    if socket_path:
+        server = IFDUnixService(grid_source, grid_folder, grid_set, socket_path)
+        feedback.pushInfo(f"IFD service listening on {socket_path}")
+    else:
+        server = IFDService(grid_source, grid_folder, grid_set, port)
+        feedback.pushInfo(f"IFD service listening on 127.0.0.1:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        grid_source.close()
+
+
+
+def main(argv=None):
+    """
+    Command line entry point for running the IFD tool outside of the QGIS GUI.
+    """
+    parser = argparse.ArgumentParser(description='QRA SEQ IFD tools')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    build_cube_parser = subparsers.add_parser('build-cube', help='Pack a grid set into a chunked, compressed IFD cube file')
+    build_cube_parser.add_argument('--grid-folder', default=DEFAULT_GRID_LOCATION, help='Base IFD grid folder')
+    build_cube_parser.add_argument('--grid-set', choices=list(GRID_SETS.keys()), default='QRA_SEQ')
+    build_cube_parser.add_argument('--output', help='Output cube file (defaults to <grid set>.ifdcube in the base grid folder)')
+    build_cube_parser.add_argument('--chunk-size', type=int, default=64)
+    build_cube_parser.add_argument('--quantize', action='store_true', help='Store values as scaled int16')
+    build_cube_parser.add_argument('--scale', type=float, default=0.1, help='Quantization step (mm)')
+
+    batch_parser = subparsers.add_parser('batch', help='Run a manifest of IFD extraction jobs')
+    batch_parser.add_argument('manifest', help='JSON job manifest (see run_ifd_manifest)')
+    batch_parser.add_argument('--workers', type=int, help='Number of worker processes')
+
+    serve_parser = subparsers.add_parser('serve', help='Run the local IFD query service')
+    serve_parser.add_argument('--grid-folder', default=DEFAULT_GRID_LOCATION, help='Base IFD grid folder')
+    serve_parser.add_argument('--grid-set', choices=list(GRID_SETS.keys()), default='QRA_SEQ')
+    serve_parser.add_argument('--port', type=int, default=DEFAULT_SERVICE_PORT)
+    serve_parser.add_argument('--socket', help='Listen on this Unix domain socket instead of a loopback port')
+    serve_parser.add_argument('--cache-folder', help='Local grid mirror folder')
+    serve_parser.add_argument('--cache-size', type=float, default=20, help='Local grid mirror size (GB)')
+    serve_parser.add_argument('--stack-folder', help='Folder for the memory-mapped grid stack (defaults to the user profile cache)')
+
+    args = parser.parse_args(argv)
+    start_qgis()
+
+    if args.command == 'build-cube':
+        output = args.output or os.path.join(args.grid_folder, args.grid_set + IFDCube.EXTENSION)
+        build_ifd_cube(
+            os.path.join(args.grid_folder, GRID_SETS[args.grid_set]),
+            output,
+            chunk_size=args.chunk_size,
+            quantize=args.quantize,
+            scale=args.scale,
+        )
+        print(f"Wrote {output}")
+
+    elif args.command == 'batch':
+        results = run_ifd_manifest(args.manifest, workers=args.workers)
+        failed = [result for result in results if 'error' in result]
+        for result in results:
+            if 'error' in result:
+                print(f"{result['name']}: FAILED - {result['error']}")
+            else:
+                print(f"{result['name']}: {result['features']} features")
+        sys.exit(1 if failed else 0)
+
+    elif args.command == 'serve':
+        serve_ifd(args.grid_folder, args.grid_set, args.port, args.socket, args.cache_folder, args.cache_size, args.stack_folder)
+
+
+if __name__ == '__main__':
+    main()
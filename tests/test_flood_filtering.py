@@ -0,0 +1,282 @@
+import collections
+
+import pytest
+
+np = pytest.importorskip('numpy')
+gdal = pytest.importorskip('osgeo.gdal')
+qgis_core = pytest.importorskip('qgis.core')
+
+import qgis_flood_filtering as ff
+
+
+def write_grid(path, values, cell_size=1.0, nodata=-9999):
+    dataset = gdal.GetDriverByName('GTiff').Create(str(path), values.shape[1], values.shape[0], 1, gdal.GDT_Float32)
+    dataset.SetGeoTransform((0, cell_size, 0, values.shape[0] * cell_size, 0, -cell_size))
+    band = dataset.GetRasterBand(1)
+    band.SetNoDataValue(nodata)
+    band.WriteArray(values)
+    dataset = None
+    return str(path)
+
+
+@pytest.fixture
+def event_grids(tmp_path):
+    rng = np.random.default_rng(0)
+    depth = rng.uniform(0, 1, (64, 80)).astype('float32')
+    depth[:8, :8] = -9999
+    velocity = rng.uniform(0, 2, depth.shape).astype('float32')
+    dv = np.where(depth > 0, depth * velocity, -9999).astype('float32')
+    return {
+        'DEPTH': write_grid(tmp_path / 'event_d_Max.tif', depth),
+        'VELOCITY': write_grid(tmp_path / 'event_V_Max.tif', velocity),
+        'DV': write_grid(tmp_path / 'event_DV_Max.tif', dv),
+        'LEVEL': write_grid(tmp_path / 'event_h_Max.tif', depth + 10),
+    }
+
+
+class _Layer:
+    def __init__(self, path):
+        self.path = path
+
+    def source(self):
+        return self.path
+
+
+class _FloodFilter(ff.FloodFilter):
+    """
+    FloodFilter with its parameters read straight from a dict, so processAlgorithm runs without a
+    processing context.
+    """
+    def parameterAsRasterLayer(self, parameters, name, context):
+        return _Layer(parameters[name]) if parameters.get(name) else None
+
+    def parameterAsDouble(self, parameters, name, context):
+        return float(parameters[name])
+
+    def parameterAsBoolean(self, parameters, name, context):
+        return bool(parameters.get(name))
+
+    def parameterAsFile(self, parameters, name, context):
+        return parameters.get(name) or ''
+
+    def parameterAsString(self, parameters, name, context):
+        return parameters.get(name) or ''
+
+    def parameterAsEnum(self, parameters, name, context):
+        return parameters.get(name, 0)
+
+    def parameterAsOutputLayer(self, parameters, name, context):
+        return parameters[name]
+
+
+@pytest.mark.parametrize('mode', [1, 2])
+def test_preview_modes(event_grids, tmp_path, mode):
+    factor = ff.PREVIEW_FACTORS[mode]
+    parameters = {
+        **event_grids,
+        'DEPTH_C1': 0.01, 'DV_C1': 0.125, 'DEPTH_C2': 0.3, 'DV_C2': 0.02, 'AREA': 50, 'CACHE_SIZE': 20,
+        'PREVIEW': mode,
+        'FILTER': str(tmp_path / f'filter_{factor}.tif'),
+        'OUTPUT_FOLDER': str(tmp_path / 'filtered'),
+    }
+    results = _FloodFilter().processAlgorithm(parameters, None, qgis_core.QgsProcessingFeedback())
+
+    dataset = gdal.Open(results['FILTER'])
+    assert (dataset.RasterXSize, dataset.RasterYSize) == (80 // factor, 64 // factor)
+    wet = results['WET_AREA']
+    assert 0 < wet <= 80 * 64
+    assert results['KEPT_AREA'] == pytest.approx(wet - results['CRITERIA_AREA'] - results['SIEVE_REMOVED_AREA'] + results['SIEVE_RESTORED_AREA'])
+    assert results['CRITERIA_AREA'] <= results['CRITERIA_1_AREA'] + results['CRITERIA_2_AREA'] + 1e-9
+
+
+def test_coarse_reader_edges(tmp_path):
+    values = np.arange(90, dtype='float32').reshape(9, 10)
+    dataset = gdal.Open(write_grid(tmp_path / 'grid.tif', values))
+    read_coarse = ff.coarse_reader(dataset.GetRasterBand(1), 4)
+    coarse, valid = read_coarse((0, 0, 3, 3))
+
+    # mean of the cells each coarse cell covers, including those cut short by the grid edge
+    padded = np.full((12, 12), np.nan)
+    padded[:9, :10] = values
+    expected = np.nanmean(padded.reshape(3, 4, 3, 4), axis=(1, 3))
+    assert valid.all()
+    np.testing.assert_allclose(coarse, expected, rtol=1e-6)
+    np.testing.assert_allclose(ff.coarse_coverage((0, 0, 3, 3), 4, 10, 9), np.outer([1, 1, 0.25], [1, 1, 0.5]))
+
+
+def bfs_labels(values, valid, connectivity):
+    """
+    Reference labelling of the connected regions of equal value, by breadth first search.
+    """
+    steps = [(0, 1), (1, 0), (0, -1), (-1, 0)]
+    if connectivity == 8:
+        steps += [(1, 1), (1, -1), (-1, 1), (-1, -1)]
+    labels = np.zeros(values.shape, dtype='int64')
+    n = 0
+    for start in zip(*np.nonzero(valid)):
+        if labels[start]:
+            continue
+        n += 1
+        labels[start] = n
+        queue = collections.deque([start])
+        while queue:
+            row, col = queue.popleft()
+            for d_row, d_col in steps:
+                r, c = row + d_row, col + d_col
+                if 0 <= r < values.shape[0] and 0 <= c < values.shape[1] and valid[r, c] and not labels[r, c] and values[r, c] == values[row, col]:
+                    labels[r, c] = n
+                    queue.append((r, c))
+    return labels
+
+
+def assert_same_regions(labels, expected):
+    """
+    Checks two labellings split the cells the same way, whatever numbers they use.
+    """
+    assert np.array_equal(labels == 0, expected == 0)
+    pairs = np.unique(np.column_stack([labels.ravel(), expected.ravel()]), axis=0)
+    assert len(np.unique(pairs[:, 0])) == len(pairs) == len(np.unique(pairs[:, 1]))
+
+
+def random_grid(seed, shape=(37, 53)):
+    rng = np.random.default_rng(seed)
+    values = rng.integers(0, 3, shape).astype('uint8')
+    valid = rng.uniform(size=shape) > 0.15
+    return values, valid
+
+
+@pytest.mark.parametrize('connectivity', [4, 8])
+@pytest.mark.parametrize('seed', range(3))
+def test_label_tile_matches_bfs(connectivity, seed):
+    values, valid = random_grid(seed)
+    labels, cells, touching = ff.label_tile(values, valid, connectivity)
+    expected = bfs_labels(values, valid, connectivity)
+    assert_same_regions(labels, expected)
+    assert np.array_equal(cells, np.bincount(labels.ravel(), minlength=len(cells)) * (np.arange(len(cells)) > 0))
+
+    # a region is touching if a neighbouring cell of another value holds data
+    padded = np.pad(np.where(valid, values.astype('int16'), -1), 1, constant_values=-1)
+    steps = [(0, 1), (1, 0), (0, -1), (-1, 0)] + ([(1, 1), (1, -1), (-1, 1), (-1, -1)] if connectivity == 8 else [])
+    differs = np.zeros(values.shape, dtype=bool)
+    for d_row, d_col in steps:
+        neighbour = padded[1 + d_row:1 + d_row + values.shape[0], 1 + d_col:1 + d_col + values.shape[1]]
+        differs |= valid & (neighbour >= 0) & (neighbour != values)
+    expected_touching = np.zeros(len(cells), dtype=bool)
+    expected_touching[labels[differs]] = True
+    assert np.array_equal(touching, expected_touching)
+
+
+@pytest.mark.parametrize('connectivity', [4, 8])
+@pytest.mark.parametrize('block_size', [5, 8, 64])
+def test_tiled_components_match_bfs(connectivity, block_size):
+    values, valid = random_grid(block_size)
+    height, width = values.shape
+    windows = list(ff.blocks(width, height, block_size))
+
+    def read_tile(window):
+        col_0, row_0, tile_width, tile_height = window
+        tile = (slice(row_0, row_0 + tile_height), slice(col_0, col_0 + tile_width))
+        return values[tile], valid[tile]
+
+    components = ff.TiledComponents(read_tile, windows, width, connectivity)
+    labels = np.zeros(values.shape, dtype='int64')
+    for i, (col_0, row_0, tile_width, tile_height) in enumerate(windows):
+        labels[row_0:row_0 + tile_height, col_0:col_0 + tile_width] = components.labels(i)
+
+    expected = bfs_labels(values, valid, connectivity)
+    assert_same_regions(labels, expected)
+    assert np.array_equal(components.cells[labels[valid]], np.bincount(expected.ravel())[expected[valid]])
+
+
+def test_connected_components_matches_bfs():
+    rng = np.random.default_rng(1)
+    n = 200
+    a, b = rng.integers(0, n, 150), rng.integers(0, n, 150)
+    labels = ff.connected_components(n, a, b)
+
+    neighbours = collections.defaultdict(set)
+    for i, j in zip(a, b):
+        neighbours[i].add(j)
+        neighbours[j].add(i)
+    for start in range(n):
+        component, queue = {start}, [start]
+        while queue:
+            for j in neighbours[queue.pop()]:
+                if j not in component:
+                    component.add(j)
+                    queue.append(j)
+        # every node is labelled with the smallest node of its component
+        assert labels[start] == min(component)
+
+
+def test_hazard_classes():
+    # (depth, velocity, dv) on and just past each ARR limit
+    depth = np.array([0.1, 0.3, 0.31, 0.5, 0.51, 1.2, 1.21, 2.0, 2.01, 4.0, 4.01, 0.1, 0.1, 0.1])
+    velocity = np.array([0.1, 0.1, 0.1, 0.1, 0.1, 0.1, 0.1, 0.1, 0.1, 0.1, 0.1, 2.0, 2.01, 4.01])
+    dv = np.array([0.01, 0.03, 0.031, 0.05, 0.051, 0.12, 0.121, 0.2, 0.201, 0.4, 0.401, 0.2, 0.201, 0.401])
+    classes = ff.hazard_classes(depth, velocity, dv)
+    assert classes.dtype == np.int16
+    assert classes.tolist() == [1, 1, 2, 2, 3, 3, 4, 4, 5, 5, 6, 1, 5, 6]
+
+    # dv alone raises the class
+    assert ff.hazard_classes(np.array([0.1]), np.array([1.0]), np.array([0.7])).tolist() == [4]
+
+
+def test_filter_matches_calculator_and_sieve(tmp_path):
+    # deep on the left, shallow on the right, with small and large specks of the other in each half
+    depth = np.full((20, 24), 1.0, dtype='float32')
+    depth[:, 12:] = 0.005
+    depth[3, 3] = depth[10, 5] = 0.005
+    depth[14:16, 2:4] = 0.005
+    depth[5, 18] = 1.0
+    depth[12, 16:18] = 1.0
+    depth[16:18, 19:21] = 1.0
+    dv = np.where(depth > 0.5, 1.0, 0.001).astype('float32')
+    grids = {
+        'DEPTH': write_grid(tmp_path / 'event_d_Max.tif', depth),
+        'VELOCITY': write_grid(tmp_path / 'event_V_Max.tif', dv / depth),
+        'DV': write_grid(tmp_path / 'event_DV_Max.tif', dv),
+        'LEVEL': write_grid(tmp_path / 'event_h_Max.tif', depth + 10),
+    }
+    criteria = [(0.01, 0.125), (0.3, 0.02)]
+    outputs = ff.filter_flood_grids(grids, criteria, 3, str(tmp_path / 'filter.tif'), str(tmp_path / 'filtered'), qgis_core.QgsProcessingFeedback(), block_size=8)
+    keep = gdal.Open(outputs['FILTER']).ReadAsArray() == 1
+
+    # the original gdal:rastercalculator criteria, gdal:sieve (4-connected) and A==0 mask
+    removed = np.zeros(depth.shape, dtype='uint8')
+    for depth_cutoff, dv_cutoff in criteria:
+        removed |= (depth < depth_cutoff) & (dv < dv_cutoff)
+    source = gdal.GetDriverByName('MEM').Create('', depth.shape[1], depth.shape[0], 1, gdal.GDT_Byte)
+    source.GetRasterBand(1).WriteArray(removed)
+    sieved = gdal.GetDriverByName('MEM').Create('', depth.shape[1], depth.shape[0], 1, gdal.GDT_Byte)
+    gdal.SieveFilter(source.GetRasterBand(1), None, sieved.GetRasterBand(1), 3, 4)
+    assert np.array_equal(keep, sieved.GetRasterBand(1).ReadAsArray() == 0)
+
+    expected = np.zeros(depth.shape, dtype=bool)
+    expected[:, :12] = True
+    expected[14:16, 2:4] = False
+    expected[16:18, 19:21] = True
+    assert np.array_equal(keep, expected)
+    assert np.array_equal(gdal.Open(outputs['DEPTH']).ReadAsArray(), np.where(keep, depth, -9999))
+
+
+def test_difference_classes(tmp_path):
+    base = np.full((2, 5), 10.0, dtype='float32')
+    developed = base + np.array([[-0.2, -0.07, -0.02, 0, 0.02], [0.07, 0.2, 0, 0, 0]], dtype='float32')
+    base[1, 3:] = -9999
+    developed[1, 2] = developed[1, 4] = -9999
+    feedback = qgis_core.QgsProcessingFeedback()
+    areas = ff.difference_grids(
+        write_grid(tmp_path / 'base.tif', base, cell_size=2),
+        write_grid(tmp_path / 'developed.tif', developed, cell_size=2),
+        str(tmp_path / 'difference.tif'),
+        str(tmp_path / 'difference_class.tif'),
+        feedback,
+    )
+
+    classes = gdal.Open(str(tmp_path / 'difference_class.tif')).ReadAsArray()
+    assert classes.tolist() == [[3, 4, 5, 6, 7], [8, 9, ff.WAS_WET_NOW_DRY, ff.WAS_DRY_NOW_WET, 0]]
+    assert areas == {c: 4.0 for c in ff.afflux_class_names()}
+    difference = gdal.Open(str(tmp_path / 'difference.tif')).ReadAsArray()
+    np.testing.assert_allclose(difference[0], developed[0] - base[0])
+    assert difference[1, 2:].tolist() == [-9999] * 3
@@ -0,0 +1,164 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('pandas')
+pytest.importorskip('osgeo.gdal')
+qgis_core = pytest.importorskip('qgis.core')
+
+from osgeo import ogr
+
+import qgis_ifd_tool_seq as ifd
+
+
+def power_law(aeps, durations):
+    """
+    Depths following a power law in AEP and duration, which log-log interpolation reproduces exactly.
+    """
+    percents = np.array([ifd.aep_percent(a) for a in aeps])
+    minutes = np.array([ifd.duration_minutes(d) for d in durations])
+    scales = np.array([1.0, 2.5, 40.0])
+    return scales[:, None, None] * percents[None, :, None] ** -0.3 * minutes[None, None, :] ** 0.4
+
+
+def test_ifd_axes():
+    extract_aeps, extract_durations, aeps, durations = ifd.ifd_axes(['1pct'], ['1hr'], extra_aeps=[3], extra_durations=[100])
+    assert extract_aeps == ['5pct', '2pct', '1pct']
+    assert extract_durations == ['1hr', '90min', '2hr']
+    assert aeps == ['3pct', '1pct']
+    assert durations == ['1hr', '100min']
+
+
+def test_ifd_axes_standard_extras():
+    # extras matching a standard AEP or duration use its name and need no neighbours
+    extract_aeps, extract_durations, aeps, durations = ifd.ifd_axes(['1pct'], ['2hr'], extra_aeps=[2, 1], extra_durations=[60])
+    assert extract_aeps == ['2pct', '1pct']
+    assert extract_durations == ['1hr', '2hr']
+    assert aeps == ['2pct', '1pct']
+    assert durations == ['1hr', '2hr']
+
+
+@pytest.mark.parametrize('extras', [{'extra_aeps': [80]}, {'extra_aeps': [0.01]}, {'extra_durations': [1]}, {'extra_durations': [20000]}])
+def test_ifd_axes_out_of_range(extras):
+    with pytest.raises(qgis_core.QgsProcessingException):
+        ifd.ifd_axes(['1pct'], ['1hr'], **extras)
+
+
+def test_interpolate_ifd_cube():
+    aeps, durations = ['5pct', '2pct', '1pct'], ['1hr', '90min', '2hr']
+    new_aeps, new_durations = ['5pct', '3pct', '1pct'], ['1hr', '100min', '2hr']
+    cube = power_law(aeps, durations)
+    cube[2, 0, 0] = np.nan
+
+    interpolated = ifd.interpolate_ifd_cube(cube, aeps, durations, new_aeps, new_durations)
+    assert interpolated.shape == (3, 3, 3)
+    expected = power_law(new_aeps, new_durations)
+    np.testing.assert_allclose(interpolated[:2], expected[:2], rtol=1e-12)
+
+    # standard values come through unchanged, and a missing value only spreads to the values interpolated from it
+    np.testing.assert_allclose(interpolated[:, [0, 2]][:, :, [0, 2]], cube[:, [0, 2]][:, :, [0, 2]], rtol=1e-12)
+    assert np.isnan(interpolated[2]).tolist() == [[True, False, False], [True, False, False], [False, False, False]]
+    finite = ~np.isnan(interpolated[2])
+    np.testing.assert_allclose(interpolated[2][finite], expected[2][finite], rtol=1e-12)
+
+
+def test_cell_weight_matrix():
+    # 3 x 3 grid of unit cells, a square offset by half a cell and a square inside the centre cell
+    geotransform = (0, 1, 0, 3, 0, -1)
+    geometries = [
+        ogr.CreateGeometryFromWkt('POLYGON ((0.5 0.5, 2.5 0.5, 2.5 2.5, 0.5 2.5, 0.5 0.5))'),
+        ogr.CreateGeometryFromWkt('POLYGON ((1.2 1.2, 1.7 1.2, 1.7 1.7, 1.2 1.7, 1.2 1.2))'),
+    ]
+    weights = ifd.CellWeightMatrix(geotransform, (3, 3), geometries)
+
+    expected = np.array([[0.25, 0.5, 0.25], [0.5, 1, 0.5], [0.25, 0.5, 0.25]])
+    first = np.zeros(9)
+    np.add.at(first, weights.cell_index[weights.feature_index == 0], weights.weights[weights.feature_index == 0])
+    np.testing.assert_allclose(first.reshape(3, 3), expected)
+    assert weights.cell_index[weights.feature_index == 1].tolist() == [4]
+    np.testing.assert_allclose(weights.weights[weights.feature_index == 1], [0.25])
+
+    values = np.arange(9, dtype='float64').reshape(3, 3) ** 2
+    np.testing.assert_allclose(weights.sample(values), [(expected * values).sum() / expected.sum(), values[1, 1]])
+
+    # missing cells are left out of the weighted mean
+    values[0, 0] = np.nan
+    covered = expected.copy()
+    covered[0, 0] = 0
+    np.testing.assert_allclose(weights.sample(values)[0], np.nansum(covered * values) / covered.sum())
+
+
+def write_ifd_grids(folder, aeps, durations, shape=(10, 13)):
+    """
+    Writes a small IFD grid per AEP and duration, with a nodata cell. Returns the (aep, duration, y, x) values.
+    """
+    rng = np.random.default_rng(0)
+    values = np.empty((len(aeps), len(durations)) + shape)
+    for a, aep in enumerate(aeps):
+        for d, duration in enumerate(durations):
+            grid = (100 * (a + 1) + 10 * (d + 1) + rng.uniform(0, 10, shape)).astype('float32')
+            grid[3, 4] = -9999
+            dataset = ifd.gdal.GetDriverByName('GTiff').Create(str(folder / f'{ifd.grid_name_key(aep, duration)}.tiff'), shape[1], shape[0], 1, ifd.gdal.GDT_Float32)
+            dataset.SetGeoTransform((150, 0.1, 0, -26, 0, -0.1))
+            band = dataset.GetRasterBand(1)
+            band.SetNoDataValue(-9999)
+            band.WriteArray(grid)
+            dataset = None
+            values[a, d] = np.where(grid == -9999, np.nan, grid)
+    return values
+
+
+@pytest.mark.parametrize('quantize', [False, True])
+def test_ifd_cube_round_trip(tmp_path, monkeypatch, quantize):
+    monkeypatch.setattr(ifd, 'grid_cache_folder', lambda: str(tmp_path / 'cache'))
+    grid_folder = tmp_path / 'grids'
+    grid_folder.mkdir()
+    aeps, durations = ['2pct', '1pct'], ['1hr', '2hr']
+    values = write_ifd_grids(grid_folder, aeps, durations)
+    cube_path = ifd.build_ifd_cube(str(grid_folder), str(tmp_path / 'grids.ifdcube'), chunk_size=4, quantize=quantize, scale=0.1)
+    assert not (tmp_path / 'grids.ifdcube.tmp').exists()
+
+    cube = ifd.IFDCube(cube_path)
+    assert (cube.aeps, cube.durations) == (aeps, durations)
+    tolerance = 0.05 + 1e-4 if quantize else 1e-12
+    stack = cube.read_window((0, 0, 13, 10))
+    assert np.array_equal(np.isnan(stack), np.isnan(values))
+    np.testing.assert_allclose(stack, values, rtol=0, atol=tolerance)
+    np.testing.assert_allclose(cube.read_window((3, 2, 7, 5)), values[:, :, 2:7, 3:10], rtol=0, atol=tolerance)
+
+    # cell centres, including the nodata cell and a point outside the grid
+    rows, cols = np.array([0, 3, 9, 5]), np.array([0, 4, 12, 7])
+    xs, ys = 150 + (cols + 0.5) * 0.1, -26 - (rows + 0.5) * 0.1
+    points = cube.sample_points(np.append(xs, 140), np.append(ys, -26))
+    np.testing.assert_allclose(points[:4], np.moveaxis(values[:, :, rows, cols], -1, 0), rtol=0, atol=tolerance)
+    assert np.isnan(points[1]).all() and np.isnan(points[4]).all()
+
+    # polygon means read chunk by chunk match weighting the whole window
+    polygon = ogr.CreateGeometryFromWkt('POLYGON ((150.23 -26.12, 150.97 -26.12, 150.97 -26.81, 150.23 -26.81, 150.23 -26.12))')
+    locations = ifd.FeatureLocations(2, geometries=[polygon])
+    means = ifd.extract_ifd_cube_from_cube(cube, ['1pct'], ['2hr', '1hr'], locations, qgis_core.QgsProcessingFeedback())
+    weights = ifd.CellWeightMatrix(cube.geotransform, cube.shape, [polygon])
+    np.testing.assert_allclose(means[0, 0], [weights.sample(stack[1, 1]), weights.sample(stack[1, 0])])
+    cube.close()
+
+
+def test_memory_mapped_grid_source(tmp_path, monkeypatch):
+    monkeypatch.setattr(ifd, 'grid_cache_folder', lambda: str(tmp_path / 'cache'))
+    grid_folder = tmp_path / ifd.GRID_SETS['QRA_SEQ']
+    grid_folder.mkdir(parents=True)
+    aeps, durations = ['2pct', '1pct'], ['1hr', '2hr']
+    write_ifd_grids(grid_folder, aeps, durations)
+    feedback = qgis_core.QgsProcessingFeedback()
+    polygon = ogr.CreateGeometryFromWkt('POLYGON ((150.23 -26.12, 150.97 -26.12, 150.97 -26.81, 150.23 -26.81, 150.23 -26.12))')
+    all_locations = [
+        ifd.FeatureLocations(0, xs=np.array([150.05, 150.45, 151.25, 140]), ys=np.array([-26.05, -26.35, -26.95, -26])),
+        ifd.FeatureLocations(2, geometries=[polygon]),
+    ]
+
+    # the memory-mapped stack is sampled by the same code as cubes and gives the values read from the grids
+    grid_source = ifd.IFDGridSource(str(tmp_path), 'QRA_SEQ', keep_open=True)
+    expected = [grid_source.extract(['1pct'], durations, locations, feedback) for locations in all_locations]
+    grid_source.memory_map(str(tmp_path / 'stack'))
+    assert isinstance(grid_source.cube, ifd.MemoryMappedGrids)
+    for locations, values in zip(all_locations, expected):
+        np.testing.assert_allclose(grid_source.extract(['1pct'], durations, locations, feedback), values)
+    grid_source.close()